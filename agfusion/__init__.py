@@ -1,8 +1,57 @@
-from .cli import *
-from .model import *
+import importlib
+import sys
+
 from .utils import *
 from .database import *
 from .exceptions import *
-from .plot import *
 from .parsers import *
 from ._version import __version__
+
+# the modules below import matplotlib, Biopython or pyensembl, so
+# on Python 3.7+ they are only imported once one of their names is used
+
+_LAZY_MODULES = {
+    'cli': [
+        'list_available_databases', 'downloaddb', 'annotate', 'batch_mode',
+        'render', 'builddb', 'optimizedb', 'convertdb', 'add_common_flags',
+        'add_plot_flags', 'parse_plot_flags', 'main'
+    ],
+    'model': [
+        'EnsemblIndex', 'GeneResolver', 'Fusion', 'SavedFusion',
+        'FusionTranscript', 'TranscriptCoordinates'
+    ],
+    'plot': [
+        'close_figures', 'PlotWTExons', 'PlotFusionExons',
+        'PlotFusionProtein', 'PlotWTProtein'
+    ]
+}
+
+_LAZY_NAMES = dict(
+    (name, module)
+    for module, names in _LAZY_MODULES.items()
+    for name in names
+)
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name in _LAZY_MODULES:
+            return importlib.import_module('.' + name, __name__)
+        if name in _LAZY_NAMES:
+            module = importlib.import_module(
+                '.' + _LAZY_NAMES[name],
+                __name__
+            )
+            return getattr(module, name)
+        raise AttributeError(
+            "module '{}' has no attribute '{}'".format(__name__, name)
+        )
+
+    def __dir__():
+        return sorted(
+            list(globals().keys()) + list(_LAZY_MODULES.keys()) +
+            list(_LAZY_NAMES.keys())
+        )
+else:
+    from .cli import *
+    from .model import *
+    from .plot import *
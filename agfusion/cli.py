@@ -2,20 +2,29 @@
 Command line interface
 """
 
-from os.path import split, exists, join
-from os import mkdir, remove
+from os.path import split, exists, join, getsize, relpath, isdir, dirname, \
+    abspath
+from os import mkdir, remove, rename, walk, fsync
 import argparse
-import gzip
-import shutil
+import hashlib
+import json
+import re
+import time
+import zlib
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from multiprocessing.util import Finalize
 from future.standard_library import install_aliases
 install_aliases()
-from urllib.request import urlopen
-from urllib.error import HTTPError
+from urllib.request import urlopen, Request, pathname2url
+from urllib.error import HTTPError, URLError
+from http.client import HTTPException, IncompleteRead
 
-import pyensembl
 import agfusion
 from agfusion import exceptions
-from agfusion.utils import AGFUSION_DB_URL, AVAILABLE_ENSEMBL_SPECIES, GENOME_SHORTCUTS
+from agfusion.utils import AGFUSION_DB_URL, AVAILABLE_ENSEMBL_SPECIES, GENOME_SHORTCUTS, \
+    BATCH_MANIFEST, ANNOTATION_SUFFIX, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_RETRIES, \
+    DOWNLOAD_RETRY_WAIT, DOWNLOAD_TIMEOUT
 
 
 def list_available_databases():
@@ -41,6 +50,205 @@ def list_available_databases():
     exit()
 
 
+class _DatabaseDownload():
+    """
+    Streams a gzipped AGFusion database to disk, decompressing it as it
+    arrives. The compressed bytes are kept in a .gz.part file until the
+    download is verified, so that a dropped transfer is resumed with an HTTP
+    Range request, by this or a later run, instead of starting from zero.
+    """
+
+    def __init__(self, url, file_path):
+
+        self.url = url
+        self.file_path = file_path
+        self.part_path = file_path + '.gz.part'
+        self.db_part_path = file_path + '.part'
+        self.expected_md5 = None
+
+        self.part = open(self.part_path, 'ab')
+        self.fout = open(self.db_part_path, 'wb')
+        self.md5 = hashlib.md5()
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.size = 0
+
+        # decompress what an earlier run already downloaded, starting over
+        # if it is corrupt
+
+        try:
+            with open(self.part_path, 'rb') as fin:
+                for chunk in iter(lambda: fin.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    self._decompress(chunk)
+        except zlib.error:
+            self._reset()
+
+    def _reset(self):
+        self.part.seek(0)
+        self.part.truncate()
+        self.fout.seek(0)
+        self.fout.truncate()
+        self.md5 = hashlib.md5()
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.size = 0
+
+    def _decompress(self, chunk):
+        self.md5.update(chunk)
+        self.size += len(chunk)
+
+        data = self.decompressor.decompress(chunk)
+
+        # a gzip file can have more than one member
+
+        while self.decompressor.eof and self.decompressor.unused_data:
+            unused_data = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data += self.decompressor.decompress(unused_data)
+
+        self.fout.write(data)
+
+    def _fetch(self):
+        """
+        Download the rest of the file, from the end of the .gz.part file
+        """
+
+        request = Request(self.url)
+        if self.size > 0:
+            request.add_header('Range', 'bytes={}-'.format(self.size))
+
+        try:
+            response = urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+        except HTTPError as e:
+
+            # the .gz.part file already has the whole file
+
+            if e.code == 416 and self.size > 0:
+                return
+            raise
+
+        if self.expected_md5 is None:
+            self.expected_md5 = self._find_md5(response)
+
+        # servers that do not support Range requests (and file:// URLs)
+        # send the whole file
+
+        if self.size > 0 and response.getcode() != 206:
+            self._reset()
+
+        length = response.info().get('Content-Length')
+        received = 0
+
+        for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b''):
+            self.part.write(chunk)
+            self._decompress(chunk)
+            received += len(chunk)
+
+        response.close()
+
+        # reading a response in chunks does not fail if the connection
+        # drops before the end
+
+        if length is not None and received < int(length):
+            raise IncompleteRead(b'', int(length) - received)
+
+    def _find_md5(self, response):
+        """
+        The MD5 checksum of the gzipped database, from a .md5 file next to
+        it or else from the ETag of the response, which S3 sets to the MD5
+        checksum of files uploaded in one part
+        """
+
+        try:
+            md5 = urlopen(self.url + '.md5', timeout=DOWNLOAD_TIMEOUT)
+            md5 = md5.read().decode('utf-8').split()
+            if md5:
+                return md5[0].lower()
+        except (HTTPError, URLError, IOError):
+            pass
+
+        etag = (response.info().get('ETag') or '').strip('"').lower()
+        if re.match('^[0-9a-f]{32}$', etag):
+            return etag
+
+        return None
+
+    def run(self):
+        """
+        Download, decompress and verify the database. Returns an error
+        message, or None if the database was downloaded
+        """
+
+        wait = DOWNLOAD_RETRY_WAIT
+        retry = 0
+
+        while True:
+            try:
+                self._fetch()
+                break
+            except zlib.error as e:
+                self._close(keep_part=False)
+                return "The download of {} is corrupt ({})!".format(
+                    self.url,
+                    e
+                )
+            except (IOError, OSError, HTTPException) as e:
+
+                # HTTP errors and missing local files are not retried
+
+                if isinstance(e, HTTPError) or (
+                        isinstance(e, URLError) and
+                        self.url.startswith('file:')):
+                    self._close(keep_part=self.size > 0)
+                    return "Was unable to download the file {}!".format(
+                        self.url
+                    )
+                if retry == DOWNLOAD_RETRIES:
+                    self._close(keep_part=self.size > 0)
+                    return "The download of {} failed ({}). Run the " \
+                        "same command again to resume it.".format(self.url, e)
+
+                print(
+                    "The download was interrupted ({}), resuming in {} "
+                    "seconds...".format(e, wait)
+                )
+
+                time.sleep(wait)
+                wait *= 2
+                retry += 1
+
+        self.part.close()
+        self.fout.close()
+
+        md5 = self.md5.hexdigest()
+
+        if self.expected_md5 is not None and md5 != self.expected_md5:
+            error = "The download of {} is corrupt (MD5 {} instead of {})!" \
+                .format(self.url, md5, self.expected_md5)
+        elif not self.decompressor.eof:
+            error = "The download of {} is incomplete!".format(self.url)
+        else:
+            rename(self.db_part_path, self.file_path)
+            remove(self.part_path)
+            return None
+
+        remove(self.part_path)
+        remove(self.db_part_path)
+
+        return error
+
+    def _close(self, keep_part):
+        """
+        Close the files of a failed download, keeping the .gz.part file for
+        the next run to resume from if keep_part is set
+        """
+
+        self.part.close()
+        self.fout.close()
+
+        remove(self.db_part_path)
+        if not keep_part:
+            remove(self.part_path)
+
+
 def downloaddb(args):
     """
     Download the AGFusion database from github
@@ -62,26 +270,28 @@ def downloaddb(args):
 
     file_path = join(
         args.dir,
-        'agfusion.' + species + '.' + release + '.db.gz')
+        'agfusion.' + species + '.' + release + '.db')
 
     print("Downloading the AGFusion database to {}...".format(file_path))
 
-    db_url = AGFUSION_DB_URL + species + '.' + release + '.db.gz'
+    if args.mirror is None:
+        db_url = AGFUSION_DB_URL + species + '.' + release + '.db.gz'
+    else:
+        mirror = args.mirror
 
-    try:
-        response = urlopen(db_url)
-    except HTTPError:
-        print("Was unable to downloade the file {}!".format(db_url))
-        exit()
+        # a directory rather than a URL
+
+        if not re.match('^[a-zA-Z][a-zA-Z0-9+.-]*://', mirror):
+            mirror = 'file:' + pathname2url(abspath(mirror))
 
-    fout = open(file_path, 'wb')
-    fout.write(response.read())
-    fout.close()
+        db_url = mirror.rstrip('/') + '/agfusion.' + species + '.' + \
+            release + '.db.gz'
 
-    with gzip.open(file_path, 'rb') as f_in, open(file_path.replace('.gz', ''), 'wb') as f_out:
-        shutil.copyfileobj(f_in, f_out)
+    error = _DatabaseDownload(db_url, file_path).run()
 
-    remove(file_path)
+    if error is not None:
+        print(error)
+        exit()
 
 
 def annotate(gene5prime, junction5prime, gene3prime, junction3prime,
@@ -125,22 +335,288 @@ def annotate(gene5prime, junction5prime, gene3prime, junction3prime,
         middlestar=args.middlestar
     )
 
-    fusion.save_images(
-        out_dir=outdir,
-        file_type=args.type,
-        scale=scale,
-        colors=colors,
-        rename=rename,
-        fontsize=args.fontsize,
-        height=args.height,
-        width=args.width,
-        dpi=args.dpi,
-        no_domain_labels=args.no_domain_labels,
-        plot_WT=args.WT,
-        exclude=args.exclude_domain
-        )
+    if args.annotation_only:
+        fusion.save_annotation(out_dir=outdir)
+    else:
+        fusion.save_images(
+            out_dir=outdir,
+            file_type=args.type,
+            scale=scale,
+            colors=colors,
+            rename=rename,
+            fontsize=args.fontsize,
+            height=args.height,
+            width=args.width,
+            dpi=args.dpi,
+            no_domain_labels=args.no_domain_labels,
+            plot_WT=args.WT,
+            exclude=args.exclude_domain
+            )
     fusion.save_tables(out_dir=outdir)
 
+    return outdir
+
+
+def _annotate_batch_fusion(fusion, agfusion_db, pyensembl_data, args,
+                           rename, colors):
+    """
+    Annotate one fusion read by a batch parser. Returns the fusion's output
+    directory and the error message if the fusion could not be annotated,
+    otherwise None.
+    """
+
+    try:
+        outdir = annotate(
+            gene5prime=fusion['gene5prime'],
+            junction5prime=fusion['gene5prime_junction'],
+            gene3prime=fusion['gene3prime'],
+            junction3prime=fusion['gene3prime_junction'],
+            agfusion_db=agfusion_db,
+            pyensembl_data=pyensembl_data,
+            args=args,
+            colors=colors,
+            rename=rename,
+            scale=None,
+            batch_out_dir=args.out
+        )
+    except exceptions.GeneIDException as e:
+        return None, str(e)
+    except exceptions.JunctionException as e:
+        return None, str(e)
+    except exceptions.TooManyGenesException as e:
+        return None, str(e)
+
+    return outdir, None
+
+
+class _BatchManifest():
+    """
+    Checkpoint manifest of a batch run, kept in the output directory. Each
+    line records a finished fusion, the files written for it and a hash of
+    the options it was annotated with, so that an interrupted run can be
+    resumed without redoing the fusions it already finished.
+    """
+
+    def __init__(self, out_dir, options, resume=False):
+
+        self.out_dir = out_dir
+        self.path = join(out_dir, BATCH_MANIFEST)
+        self.options_hash = hashlib.sha1(
+            json.dumps(options, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+        self.records = {}
+        self.skipped = 0
+
+        if resume and exists(self.path):
+            for line in open(self.path, 'r'):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+
+                    # the last line of a killed run may be incomplete
+
+                    continue
+                self.records[record['key']] = record
+
+        # rewrite the manifest with the records that could be read, so that
+        # new records are not appended to an incomplete line
+
+        self.fout = open(self.path, 'w')
+
+        for record in self.records.values():
+            self.fout.write(json.dumps(record, sort_keys=True) + '\n')
+        self.fout.flush()
+
+    @staticmethod
+    def key(fusion):
+        return json.dumps([
+            fusion['gene5prime'],
+            fusion['gene5prime_junction'],
+            fusion['gene3prime'],
+            fusion['gene3prime_junction']
+        ])
+
+    def is_complete(self, fusion):
+        """
+        Whether a previous run finished the fusion with the same options
+        and all of its output files are still there in full
+        """
+
+        record = self.records.get(self.key(fusion))
+
+        if record is None or record['options'] != self.options_hash:
+            return False
+
+        for name, size in record['files'].items():
+            path = join(self.out_dir, record['outdir'], name)
+            if not exists(path) or getsize(path) != size:
+                return False
+
+        self.skipped += 1
+
+        return True
+
+    def record(self, fusion, outdir):
+        """
+        Record the fusion as finished along with the files in its output
+        directory
+        """
+
+        files = {}
+
+        for root, dirs, names in walk(outdir):
+            for name in names:
+                path = join(root, name)
+                files[relpath(path, outdir)] = getsize(path)
+
+        record = {
+            'key': self.key(fusion),
+            'options': self.options_hash,
+            'outdir': relpath(outdir, self.out_dir),
+            'files': files
+        }
+        self.records[record['key']] = record
+
+        self.fout.write(json.dumps(record, sort_keys=True) + '\n')
+        self.fout.flush()
+        fsync(self.fout.fileno())
+
+    def close(self):
+        self.fout.close()
+
+
+# database connection and pyensembl data opened once by each worker process
+
+_worker_data = {}
+
+
+def _open_database(database, args):
+    """
+    Open the AGFusion database for annotating fusions, read-only or in
+    memory if asked
+    """
+
+    mmap_size = cache_size = None
+
+    # SQLite takes the mmap size in bytes and a negative cache size in KiB
+
+    if args.mmap_size is not None:
+        mmap_size = args.mmap_size * 1024 * 1024
+    if args.cache_size is not None:
+        cache_size = -args.cache_size
+
+    return agfusion.AGFusionDB(
+        database,
+        debug=args.debug,
+        read_only=args.read_only,
+        mmap_size=mmap_size,
+        cache_size=cache_size,
+        in_memory=args.in_memory
+    )
+
+
+def _init_batch_worker(database, species, release, args):
+    """
+    Initialize a batch worker process with its own AGFusion database
+    connection and pyensembl data
+    """
+
+    import pyensembl
+
+    agfusion_db = _open_database(database, args)
+    agfusion_db.build = species + '_' + str(release)
+
+    _worker_data['agfusion_db'] = agfusion_db
+    _worker_data['pyensembl_data'] = pyensembl.EnsemblRelease(
+        release,
+        species
+    )
+
+    # release the worker's pooled figures when the pool shuts it down
+
+    Finalize(None, agfusion.close_figures, exitpriority=0)
+
+
+def _batch_worker(task):
+    """
+    Annotate one fusion within a batch worker process
+    """
+
+    fusion, args, rename, colors = task
+
+    outdir, error = _annotate_batch_fusion(
+        fusion,
+        _worker_data['agfusion_db'],
+        _worker_data['pyensembl_data'],
+        args,
+        rename,
+        colors
+    )
+
+    return fusion, outdir, error
+
+
+def _resolve_batch_genes(fusions, agfusion_db, pyensembl_data):
+    """
+    Resolve the genes of all fusions read by a batch parser at once and
+    report the ones that cannot be resolved. Returns the fusions whose
+    genes were all resolved.
+    """
+
+    resolver = agfusion.GeneResolver.get(agfusion_db, pyensembl_data)
+    errors = resolver.resolve_all([
+        fusion[i] for fusion in fusions for i in ['gene5prime', 'gene3prime']
+        if type(fusion[i]) == str
+    ])
+
+    if not errors:
+        return fusions
+
+    for error in errors.values():
+        agfusion_db.logger.error(error)
+
+    # some parsers give a list of candidate genes, which are left to be
+    # resolved one by one like resolve_all does
+
+    resolved = [
+        fusion for fusion in fusions
+        if not any(
+            type(fusion[i]) == str and fusion[i] in errors
+            for i in ['gene5prime', 'gene3prime']
+        )
+    ]
+
+    agfusion_db.logger.warn(
+        'Could not resolve {} gene(s). Skipping the {} fusion(s) ' \
+        'involving them.'.format(len(errors), len(fusions) - len(resolved))
+    )
+
+    return resolved
+
+
+def _batch_options(args, rename, colors):
+    """
+    The options that change the output of a batch run
+    """
+
+    return {
+        'database': split(args.database)[1],
+        'protein_databases': args.protein_databases,
+        'noncanonical': args.noncanonical,
+        'middlestar': args.middlestar,
+        'type': args.type,
+        'fontsize': args.fontsize,
+        'height': args.height,
+        'width': args.width,
+        'dpi': args.dpi,
+        'no_domain_labels': args.no_domain_labels,
+        'WT': args.WT,
+        'exclude_domain': args.exclude_domain,
+        'annotation_only': args.annotation_only,
+        'rename': rename,
+        'colors': colors
+    }
+
 
 def batch_mode(args, agfusion_db, pyensembl_data, rename, colors):
     """
@@ -150,6 +626,10 @@ def batch_mode(args, agfusion_db, pyensembl_data, rename, colors):
 
     if not exists(args.out):
         mkdir(args.out)
+    elif args.resume:
+        agfusion_db.logger.info(
+            'Resuming the annotation of the fusions in {}.'.format(args.out)
+        )
     else:
         agfusion_db.logger.warn(
             'Output directory {} already exists! Overwriting...'
@@ -157,29 +637,100 @@ def batch_mode(args, agfusion_db, pyensembl_data, rename, colors):
         )
 
     if args.algorithm in agfusion.parsers:
-        for fusion in agfusion.parsers[args.algorithm](args.file,
-                                                       agfusion_db.logger):
+        fusions = agfusion.parsers[args.algorithm](
+            args.file,
+            agfusion_db.logger,
+            stream=args.stream
+        )
+
+        # skip the fusions a previous run already finished
+
+        manifest = _BatchManifest(
+            args.out,
+            _batch_options(args, rename, colors),
+            resume=args.resume
+        )
+
+        if args.stream:
+            fusions = (i for i in fusions if not manifest.is_complete(i))
+        else:
+            fusions = [i for i in fusions if not manifest.is_complete(i)]
+
+            # resolve every gene before annotating any fusion, so that the
+            # genes that cannot be found are reported straight away
+
+            fusions = _resolve_batch_genes(
+                fusions,
+                agfusion_db,
+                pyensembl_data
+            )
+
+        if args.workers > 1:
+
+            # fan the fusions out to a pool of worker processes, each one
+            # opens its own database connection and pyensembl data
+
+            agfusion_db.logger.info(
+                'Annotating fusions with {} worker processes.'
+                .format(args.workers)
+            )
+
+            pool = Pool(
+                processes=args.workers,
+                initializer=_init_batch_worker,
+                initargs=(
+                    agfusion_db.database,
+                    pyensembl_data.species.latin_name,
+                    pyensembl_data.release,
+                    args
+                )
+            )
+            tasks = ((fusion, args, rename, colors) for fusion in fusions)
 
             try:
-                annotate(
-                    gene5prime=fusion['gene5prime'],
-                    junction5prime=fusion['gene5prime_junction'],
-                    gene3prime=fusion['gene3prime'],
-                    junction3prime=fusion['gene3prime_junction'],
-                    agfusion_db=agfusion_db,
-                    pyensembl_data=pyensembl_data,
-                    args=args,
-                    colors=colors,
-                    rename=rename,
-                    scale=None,
-                    batch_out_dir=args.out
+                for fusion, outdir, error in pool.imap_unordered(
+                        _batch_worker, tasks):
+                    if error is not None:
+                        agfusion_db.logger.error(error)
+                    else:
+                        manifest.record(fusion, outdir)
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            for fusion in fusions:
+                outdir, error = _annotate_batch_fusion(
+                    fusion,
+                    agfusion_db,
+                    pyensembl_data,
+                    args,
+                    rename,
+                    colors
+                )
+                if error is not None:
+                    agfusion_db.logger.error(error)
+                else:
+                    manifest.record(fusion, outdir)
+
+            agfusion.close_figures()
+
+            agfusion_db.logger.info(
+                'Protein feature cache: {} hits, {} misses.'.format(
+                    agfusion_db.protein_feature_cache.hits,
+                    agfusion_db.protein_feature_cache.misses
                 )
-            except exceptions.GeneIDException as e:
-                agfusion_db.logger.error(e)
-            except exceptions.JunctionException as e:
-                agfusion_db.logger.error(e)
-            except exceptions.TooManyGenesException as e:
-                agfusion_db.logger.error(e)
+            )
+
+        manifest.close()
+
+        if manifest.skipped:
+            agfusion_db.logger.info(
+                'Skipped {} fusion(s) finished by a previous run.'
+                .format(manifest.skipped)
+            )
     else:
         agfusion_db.logger.error(
             ('\'{}\' is not an available option for -a! Choose one of the ' +
@@ -191,32 +742,198 @@ def batch_mode(args, agfusion_db, pyensembl_data, rename, colors):
         exit()
 
 
+def _find_annotations(paths):
+    """
+    The annotation files among paths, searching directories recursively
+    """
+
+    annotations = []
+
+    for path in paths:
+        if isdir(path):
+            for root, dirs, names in walk(path):
+                annotations += sorted([
+                    join(root, name) for name in names
+                    if name.endswith(ANNOTATION_SUFFIX)
+                ])
+        else:
+            annotations.append(path)
+
+    return annotations
+
+
+def _render_fusion(task):
+    """
+    Draw the images of one annotated fusion
+    """
+
+    annotation, args, rename, colors = task
+
+    fusion = agfusion.SavedFusion(annotation)
+
+    if args.out is not None:
+        outdir = join(args.out, split(dirname(annotation))[1])
+    else:
+        outdir = dirname(annotation)
+
+    fusion.save_images(
+        out_dir=outdir,
+        file_type=args.type,
+        scale=args.scale,
+        colors=colors,
+        rename=rename,
+        fontsize=args.fontsize,
+        height=args.height,
+        width=args.width,
+        dpi=args.dpi,
+        no_domain_labels=args.no_domain_labels,
+        plot_WT=args.WT,
+        exclude=args.exclude_domain
+    )
+
+
+def render(args):
+    """
+    Draw the images of fusions annotated with --annotation_only
+    """
+
+    logger = agfusion.get_logger(args.debug)
+    rename, colors = parse_plot_flags(args, logger)
+
+    annotations = _find_annotations(args.input)
+
+    if not annotations:
+        logger.warn('Found no annotations to render.')
+        return
+
+    if args.out is not None and not exists(args.out):
+        mkdir(args.out)
+
+    tasks = ((annotation, args, rename, colors) for annotation in annotations)
+
+    if args.threads > 1:
+
+        # matplotlib is not bound to a global figure manager, so the images
+        # can be drawn by a pool of threads that each have their own figures
+
+        logger.info('Rendering fusions with {} threads.'.format(args.threads))
+
+        pool = ThreadPool(processes=args.threads)
+
+        try:
+            for _ in pool.imap_unordered(_render_fusion, tasks):
+                pass
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            agfusion.close_figures()
+    else:
+        for task in tasks:
+            _render_fusion(task)
+
+        agfusion.close_figures()
+
+    logger.info('Rendered {} fusion(s).'.format(len(annotations)))
+
+
 def builddb(args):
     """
     Build a AGFusion database
     """
 
-    agfusion_db = agfusion.AGFusionDBBManager(
-        args.dir,
-        args.species,
-        args.release,
-        args.pfam,
-        args.server
+    if args.dumps is not None:
+        agfusion_db = agfusion.AGFusionDumpDBBManager(
+            args.dir,
+            args.species,
+            args.release,
+            args.pfam,
+            args.dumps,
+            processes=args.processes,
+            incremental=args.incremental,
+            bulk_load=args.bulk_load
+        )
+    else:
+        agfusion_db = agfusion.AGFusionDBBManager(
+            args.dir,
+            args.species,
+            args.release,
+            args.pfam,
+            args.server,
+            incremental=args.incremental,
+            bulk_load=args.bulk_load
+        )
+
+    # close the connections, and remove the temporary copy of the Ensembl
+    # tables of a build from dumps, even if the build fails
+
+    try:
+        agfusion_db.logger.info('Fetching alternative gene names...')
+
+        agfusion_db.fetch_gene_names()
+
+        agfusion_db.logger.info('Fetching transcript tables...')
+
+        agfusion_db.fetch_transcript_table()
+
+        agfusion_db.fetch_refseq_table()
+
+        agfusion_db.logger.info('Fetching protein annotation data...')
+
+        agfusion_db.fetch_protein_annotation(connections=args.connections)
+
+        agfusion_db.finish()
+    finally:
+        agfusion_db.close()
+
+    if args.index:
+        index_db = agfusion.AGFusionDB(agfusion_db.database)
+        index_db.build = agfusion_db.build
+        index_db.convert(re.sub(r'\.db$', '', index_db.database) + '.index')
+
+
+def optimizedb(args):
+    """
+    Add the lookup indexes to an existing AGFusion database
+    """
+
+    db_file = split(args.database)[1]
+    species = db_file.split('.')[1]
+    release = db_file.split('.')[2]
+
+    agfusion_db = agfusion.AGFusionDB(args.database, debug=args.debug)
+    agfusion_db.build = species + '_' + str(release)
+
+    agfusion_db.logger.info(
+        'Adding indexes to the database {}...'.format(agfusion_db.database)
     )
 
-    agfusion_db.logger.info('Fetching alternative gene names...')
+    agfusion_db.optimize()
 
-    agfusion_db.fetch_gene_names()
 
-    agfusion_db.logger.info('Fetching transcript tables...')
+def convertdb(args):
+    """
+    Write the binary index of an existing AGFusion database
+    """
+
+    db_file = split(args.database)[1]
+    species = db_file.split('.')[1]
+    release = db_file.split('.')[2]
 
-    agfusion_db.fetch_transcript_table()
+    agfusion_db = agfusion.AGFusionDB(args.database, debug=args.debug)
+    agfusion_db.build = species + '_' + str(release)
 
-    agfusion_db.fetch_refseq_table()
+    if args.out is None:
+        args.out = re.sub(r'\.db$', '', agfusion_db.database) + '.index'
 
-    agfusion_db.logger.info('Fetching protein annotation data...')
+    agfusion_db.logger.info(
+        'Writing the index of the database {} to {}...'
+        .format(agfusion_db.database, args.out)
+    )
 
-    agfusion_db.fetch_protein_annotation()
+    agfusion_db.convert(args.out)
 
 
 def add_common_flags(parser):
@@ -261,6 +978,62 @@ def add_common_flags(parser):
         'pirsf, and signalp (signal peptide regions) ' +
         '(default: --protein_databases pfam and tmhmm).'
     )
+    add_plot_flags(parser)
+    parser.add_argument(
+        '-ms',
+        '--middlestar',
+        action='store_true',
+        required=False,
+        help='(Optional) Insert a * at the junction position for the ' +
+        'cdna, cds, and protein sequences (default False).')
+    parser.add_argument(
+        '--annotation_only',
+        action='store_true',
+        required=False,
+        help='(Optional) Do not draw the images. Instead save the data ' +
+        'needed to draw them later with \'agfusion render\'.')
+    parser.add_argument(
+        '--read_only',
+        action='store_true',
+        required=False,
+        help='(Optional) Open the database read-only and without file ' +
+        'locks, and memory-map it so that all --workers share one copy ' +
+        'in the OS page cache. The database must not be changed while ' +
+        'AGFusion runs.')
+    parser.add_argument(
+        '--mmap_size',
+        type=int,
+        required=False,
+        default=None,
+        help='(Optional) Megabytes of the database to memory-map ' +
+        '(default: 1024 with --read_only, otherwise none).')
+    parser.add_argument(
+        '--cache_size',
+        type=int,
+        required=False,
+        default=None,
+        help='(Optional) Kilobytes of SQLite page cache per database ' +
+        'connection (default: the SQLite default of 2000).')
+    parser.add_argument(
+        '--in_memory',
+        action='store_true',
+        required=False,
+        help='(Optional) Copy the database into memory at startup so that ' +
+        'lookups never read from disk. Each of the --workers holds its ' +
+        'own copy. The load time and size are logged.')
+    parser.add_argument(
+        '--debug',
+        default=False,
+        action='store_true',
+        help='(Optional) Enable debugging logging.'
+    )
+
+
+def add_plot_flags(parser):
+    """
+    Add command line flags that change how the images are drawn
+    """
+
     parser.add_argument(
         '--recolor',
         type=str,
@@ -327,25 +1100,65 @@ def add_common_flags(parser):
         required=False,
         help='(Optional) Include this to plot wild-type architechtures ' +
         'of the 5\' and 3\' genes')
-    parser.add_argument(
-        '-ms',
-        '--middlestar',
-        action='store_true',
-        required=False,
-        help='(Optional) Insert a * at the junction position for the ' +
-        'cdna, cds, and protein sequences (default False).')
     parser.add_argument(
         '-ndl',
         '--no_domain_labels',
         action='store_true',
         required=False,
         help='(Optional) Do not label domains.')
-    parser.add_argument(
-        '--debug',
-        default=False,
-        action='store_true',
-        help='(Optional) Enable debugging logging.'
-    )
+
+
+def parse_plot_flags(args, logger):
+    """
+    Parse the re-naming and re-coloring of domains and check the image file
+    type. Returns the re-naming and re-coloring dictionaries.
+    """
+
+    colors = {}
+    rename = {}
+
+    if args.rename is not None:
+        for i in args.rename:
+            pair = i.split(';')
+
+            assert len(pair) == 2, " did not properly specify --rename"
+
+            if pair[0] in rename:
+                logger.warn(
+                    "WARNING - you rename {} twice."
+                    .format(pair[0])
+                )
+
+            rename[pair[0]] = pair[1]
+
+    if args.recolor is not None:
+        for i in args.recolor:
+            pair = i.split(';')
+
+            assert len(pair) == 2, " did not properly specify --colors"
+
+            if pair[0] in colors:
+                logger.warn(
+                    "You specified colors for {} twice."
+                    .format(pair[0])
+                )
+
+            if pair[0] in rename:
+                colors[rename[pair[0]]] = pair[1]
+            else:
+                colors[pair[0]] = pair[1]
+
+    # check image file type is valid
+
+    if args.type not in ['png', 'pdf', 'jpeg']:
+        logger.error(
+            "ERROR - provided an incorrect image file type: {}."
+            .format(args.type)
+        )
+        exit()
+
+    return rename, colors
+
 
 def main():
     """
@@ -425,8 +1238,81 @@ def main():
         help='The fusion-finding algorithm. Can be one of the following: ' +
         ', '.join(agfusion.parsers.keys()) + '.'
     )
+    batch_parser.add_argument(
+        '--workers',
+        type=int,
+        required=False,
+        default=1,
+        help='(Optional) Number of worker processes to annotate fusions ' +
+        'with in parallel. Each worker opens its own connection to the ' +
+        'database (default 1).'
+    )
+    batch_parser.add_argument(
+        '--stream',
+        action='store_true',
+        required=False,
+        help='(Optional) Annotate fusions while the input file is still ' +
+        'being read instead of reading the whole file first. Genes that ' +
+        'cannot be resolved are then reported fusion by fusion rather than ' +
+        'all up front.'
+    )
+    batch_parser.add_argument(
+        '--resume',
+        action='store_true',
+        required=False,
+        help='(Optional) Resume an interrupted run into the same output ' +
+        'directory, skipping the fusions it finished with the same options.'
+    )
     add_common_flags(batch_parser)
 
+    # draw the images of annotated fusions
+
+    render_parser = subparsers.add_parser(
+        'render',
+        help='Draw the images of fusions annotated with --annotation_only.')
+    render_parser.add_argument(
+        '-i',
+        '--input',
+        type=str,
+        required=True,
+        nargs='+',
+        help='Annotation files (*' + ANNOTATION_SUFFIX + ') or ' +
+        'directories to search for them, e.g. the output directory of ' +
+        '\'agfusion batch\'.'
+    )
+    render_parser.add_argument(
+        '-o',
+        '--out',
+        type=str,
+        required=False,
+        default=None,
+        help='(Optional) Directory to save the images to. By default each ' +
+        'fusion\'s images are saved next to its annotation file.'
+    )
+    add_plot_flags(render_parser)
+    render_parser.add_argument(
+        '--threads',
+        type=int,
+        required=False,
+        default=1,
+        help='(Optional) Number of threads to draw images with in ' +
+        'parallel (default 1).'
+    )
+    render_parser.add_argument(
+        '--scale',
+        type=int,
+        required=False,
+        default=None,
+        help='(Optional) Set maximum width (in amino acids) of the ' +
+        'figure to rescale the fusion (default: max length of ' +
+        'fusion product)')
+    render_parser.add_argument(
+        '--debug',
+        default=False,
+        action='store_true',
+        help='(Optional) Enable debugging logging.'
+    )
+
     # download database
 
     database_parser = subparsers.add_parser(
@@ -465,6 +1351,14 @@ def main():
         action='store_true',
         required=False,
         help='List available species and ensembl releases.')
+    database_parser.add_argument(
+        '--mirror',
+        type=str,
+        required=False,
+        default=None,
+        help='(Optional) Download the database from a mirror of the ' +
+             'AGFusion databases instead, given as a URL (e.g. ' +
+             'file:///data/agfusion/) or a directory.')
 
     # build database parser
 
@@ -505,6 +1399,107 @@ def main():
         default='ensembldb.ensembl.org',
         help='(optional) Ensembl server (default ensembldb.ensembl.org)'
     )
+    build_database_parser.add_argument(
+        '--dumps',
+        type=str,
+        required=False,
+        default=None,
+        help='(Optional) Build the database from the table dumps of the ' +
+        'Ensembl core database in this directory (the *.txt.gz files and ' +
+        'the <database>.sql.gz schema) instead of querying the Ensembl ' +
+        'server.'
+    )
+    build_database_parser.add_argument(
+        '--processes',
+        type=int,
+        required=False,
+        default=1,
+        help='(Optional) Number of processes to parse the table dumps ' +
+        'given with --dumps with (default 1).'
+    )
+    build_database_parser.add_argument(
+        '--connections',
+        type=int,
+        required=False,
+        default=1,
+        help='(Optional) Number of connections to the Ensembl server to ' +
+        'fetch the protein annotations over concurrently (default 1).'
+    )
+    build_database_parser.add_argument(
+        '--bulk_load',
+        action='store_true',
+        required=False,
+        help='(Optional) Load the tables without journaling or indexes ' +
+        'and create the indexes at the end, then analyze and compact the ' +
+        'database.'
+    )
+    build_database_parser.add_argument(
+        '--index',
+        action='store_true',
+        required=False,
+        help='(Optional) Also write the binary index of the database ' +
+        '(see agfusion db convert).'
+    )
+    build_database_parser.add_argument(
+        '--incremental',
+        action='store_true',
+        required=False,
+        help='(Optional) Keep the tables that a previous build of the same ' +
+        'release into the same directory completed, and only fetch the ' +
+        'missing or incomplete ones.'
+    )
+
+    # manage an existing database
+
+    db_parser = subparsers.add_parser(
+        'db',
+        help='Manage an existing AGFusion database.')
+    db_subparsers = db_parser.add_subparsers(
+        help='Database programs.',
+        dest='db_command')
+    optimize_parser = db_subparsers.add_parser(
+        'optimize',
+        help='Add lookup indexes to a database built or downloaded ' +
+        'without them.')
+    optimize_parser.add_argument(
+        '-db',
+        '--database',
+        type=str,
+        required=True,
+        help='Path to the AGFusion database (e.g. --db /path/to/agfusion.homo_sapiens.87.db)'
+    )
+    optimize_parser.add_argument(
+        '--debug',
+        default=False,
+        action='store_true',
+        help='(Optional) Enable debugging logging.'
+    )
+    convert_parser = db_subparsers.add_parser(
+        'convert',
+        help='Write a binary index of a database, which can be passed to ' +
+        '--database instead of the database for faster lookups.')
+    convert_parser.add_argument(
+        '-db',
+        '--database',
+        type=str,
+        required=True,
+        help='Path to the AGFusion database (e.g. --db /path/to/agfusion.homo_sapiens.87.db)'
+    )
+    convert_parser.add_argument(
+        '-o',
+        '--out',
+        type=str,
+        required=False,
+        default=None,
+        help='(Optional) Path of the index (default: the path of the ' +
+        'database with .index in place of .db).'
+    )
+    convert_parser.add_argument(
+        '--debug',
+        default=False,
+        action='store_true',
+        help='(Optional) Enable debugging logging.'
+    )
 
     # agfusion version number
 
@@ -525,6 +1520,17 @@ def main():
         else:
             downloaddb(args)
         exit()
+    elif args.subparser_name == 'render':
+        render(args)
+        exit()
+    elif args.subparser_name == 'db':
+        if args.db_command == 'optimize':
+            optimizedb(args)
+        elif args.db_command == 'convert':
+            convertdb(args)
+        else:
+            db_parser.print_help()
+        exit()
 
     # single or batch mode
 
@@ -540,11 +1546,13 @@ def main():
 
     assert species in AVAILABLE_ENSEMBL_SPECIES, 'unsupported species!'
 
-    agfusion_db = agfusion.AGFusionDB(args.database, debug=args.debug)
+    agfusion_db = _open_database(args.database, args)
     agfusion_db.build = species + '_' + str(release)
 
     # get the pyensembl data
 
+    import pyensembl
+
     pyensembl_data = pyensembl.EnsemblRelease(release, species)
 
     try:
@@ -556,50 +1564,7 @@ def main():
         )
         exit()
 
-    # parse the re-coloring and re-naming
-
-    colors = {}
-    rename = {}
-
-    if args.rename is not None:
-        for i in args.rename:
-            pair = i.split(';')
-
-            assert len(pair) == 2, " did not properly specify --rename"
-
-            if pair[0] in rename:
-                agfusion_db.logger.warn(
-                    "WARNING - you rename {} twice."
-                    .format(pair[0])
-                )
-
-            rename[pair[0]] = pair[1]
-
-    if args.recolor is not None:
-        for i in args.recolor:
-            pair = i.split(';')
-
-            assert len(pair) == 2, " did not properly specify --colors"
-
-            if pair[0] in colors:
-                agfusion_db.logger.warn(
-                    "You specified colors for {} twice."
-                    .format(pair[0])
-                )
-
-            if pair[0] in rename:
-                colors[rename[pair[0]]] = pair[1]
-            else:
-                colors[pair[0]] = pair[1]
-
-    # check image file type is valid
-
-    if args.type not in ['png', 'pdf', 'jpeg']:
-        agfusion_db.logger.error(
-            "ERROR - provided an incorrect image file type: {}."
-            .format(args.type)
-        )
-        exit()
+    rename, colors = parse_plot_flags(args, agfusion_db.logger)
 
     if args.subparser_name == 'annotate':
         annotate(
@@ -1,10 +1,594 @@
+import os
 import sys
 import gzip
-from os.path import abspath, exists, join, split
+import array
+import bisect
+import hashlib
+import json
+import mmap
+import queue
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import namedtuple, OrderedDict
+from contextlib import closing
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from os.path import abspath, exists, join, split, getsize, dirname
 import sqlite3
 import logging
 
-from agfusion.utils import PROTEIN_ANNOTATIONS, ENSEMBL_MYSQL_TABLES
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+
+from agfusion import exceptions
+from agfusion.utils import PROTEIN_ANNOTATIONS, ENSEMBL_MYSQL_TABLES, \
+    ENSEMBL_DUMP_TABLES
+
+# rows of the AGFusion database tables
+
+GeneRow = namedtuple(
+    'GeneRow',
+    ['gene_id', 'stable_id', 'entrez_id', 'gene_name',
+     'canonical_transcript_id']
+)
+
+TranscriptRow = namedtuple(
+    'TranscriptRow',
+    ['transcript_id', 'gene_id', 'transcript_stable_id', 'translation_id']
+)
+
+RefSeqRow = namedtuple(
+    'RefSeqRow',
+    ['transcript_id', 'transcript_stable_id', 'refseq_id']
+)
+
+ProteinFeatureRow = namedtuple(
+    'ProteinFeatureRow',
+    ['translation_id', 'stable_id', 'hit_id', 'seq_start', 'seq_end',
+     'hit_description', 'hit_name']
+)
+
+# number of compiled SQLite statements kept per connection
+
+SQLITE_CACHED_STATEMENTS = 256
+
+# bytes of a read-only database that SQLite memory-maps by default. Mapped
+# pages are read from the OS page cache, which holds one copy of the
+# database for every process that has it open, instead of being copied
+# into the page cache of each connection
+
+SQLITE_MMAP_SIZE = 1 << 30
+
+# most parameters bound to one SQLite statement (the limit of SQLite
+# versions before 3.32)
+
+SQLITE_MAX_VARIABLES = 999
+
+# number of (translation_id, protein_database) entries kept in the
+# protein feature cache of an AGFusionDB
+
+PROTEIN_FEATURE_CACHE_SIZE = 8192
+
+# binary index written by AGFusionDB.convert: a magic string and the size of
+# the JSON header that follows, the format version, and how the fields of a
+# row and NULL values are stored
+
+INDEX_MAGIC = b'AGFusionIndex'
+INDEX_HEADER = '<13sQ'
+INDEX_FORMAT = 1
+INDEX_SEPARATOR = '\x1f'
+INDEX_NULL = '\x00'
+
+_INDEX_TYPES = {
+    'text': [str],
+    'integer': [int],
+    'real': [int, float]
+}
+
+_INDEX_CONVERTERS = {
+    'text': str,
+    'integer': int,
+    'real': float
+}
+
+# times a query to the Ensembl MySQL server is retried after the connection
+# drops, and seconds to wait before reconnecting (doubled on each retry)
+
+MYSQL_RETRIES = 5
+MYSQL_RETRY_WAIT = 5
+
+# number of rows streamed from the Ensembl MySQL server and inserted into
+# SQLite at a time while building a database
+
+BUILD_CHUNK_SIZE = 10000
+
+# SQLite settings for bulk loading a database: the journal and syncing to
+# disk cost more than they protect while a build can be rerun, and a large
+# page cache speeds up inserting and creating the indexes
+
+BULK_LOAD_PRAGMAS = [
+    'PRAGMA journal_mode=OFF',
+    'PRAGMA synchronous=OFF',
+    'PRAGMA cache_size=-262144',
+    'PRAGMA temp_store=MEMORY'
+]
+
+
+class LRUCache():
+    """
+    A dictionary holding at most maxsize items, evicting the least recently
+    used item when full. Counts the lookups that hit and missed the cache.
+    """
+
+    def __init__(self, maxsize):
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """
+        Return the item for key, marking it as the most recently used
+        """
+
+        if key not in self._items:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        value = self._items.pop(key)
+        self._items[key] = value
+        return value
+
+    def put(self, key, value):
+        """
+        Add or replace the item for key, evicting the least recently used
+        items if the cache is full
+        """
+
+        if self.maxsize <= 0:
+            return
+
+        self._items.pop(key, None)
+        self._items[key] = value
+
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all items and reset the hit and miss counters
+        """
+
+        self._items.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+def _index_columns(build):
+    """
+    The (table, column) pairs that AGFusion looks up rows by
+    """
+
+    columns = [
+        (build, 'gene_id'),
+        (build, 'stable_id'),
+        (build, 'entrez_id'),
+        (build, 'canonical_transcript_id'),
+        (build + '_transcript', 'transcript_id'),
+        (build + '_transcript', 'gene_id'),
+        (build + '_transcript', 'transcript_stable_id'),
+        (build + '_refseq', 'refseq_id')
+    ]
+
+    for protein_annotation in PROTEIN_ANNOTATIONS:
+        columns.append((build + '_' + protein_annotation, 'translation_id'))
+
+    return columns
+
+
+def _create_indexes(sqlite3_db, build, logger):
+    """
+    Create the indexes on the lookup columns of a build's tables. Tables
+    that do not exist and columns that are already the table's primary key
+    are skipped.
+    """
+
+    cursor = sqlite3_db.cursor()
+
+    cursor.execute("SELECT name FROM sqlite_master WHERE type=='table'")
+    tables = set([i[0] for i in cursor.fetchall()])
+
+    for table, column in _index_columns(build):
+
+        if table not in tables:
+            logger.debug('SQLite - no table ' + table + ', skipping index')
+            continue
+
+        cursor.execute('PRAGMA table_info(' + table + ')')
+        primary_keys = [i[1] for i in cursor.fetchall() if i[5]]
+
+        if primary_keys == [column]:
+            continue
+
+        sqlite3_command = "CREATE INDEX IF NOT EXISTS " + table + "_" + \
+            column + " ON " + table + " (" + column + ");"
+
+        logger.info('SQLite - ' + sqlite3_command)
+
+        cursor.execute(sqlite3_command)
+
+    sqlite3_db.commit()
+
+
+def get_logger(debug=False):
+    """
+    The AGFusion logger, logging to stderr
+    """
+
+    logger = logging.getLogger('AGFusion')
+    if debug:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    # batch worker processes inherit the parent's handler, so only add
+    # one if the logger does not have one yet
+
+    if not logger.handlers:
+        ch = logging.StreamHandler()
+        if debug:
+            ch.setLevel(logging.DEBUG)
+        else:
+            ch.setLevel(logging.INFO)
+        formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        )
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+
+    return logger
+
+
+class AGFusionIndex():
+    """
+    Read-only binary index of an AGFusion database, written by
+    AGFusionDB.convert. The index is a single file that is memory-mapped,
+    so opening it only reads its header and a lookup only touches the pages
+    it needs, without copying them.
+
+    Each table is stored as its rows, serialized one after another, and the
+    offset of each row. Each lookup column has the sorted CRC32 hashes of
+    its distinct values, each pointing to the rows that hold the value in
+    row order, so that rows come out in the same order as from SQLite.
+    """
+
+    def __init__(self, filename):
+
+        self.filename = filename
+
+        with open(filename, 'rb') as fin:
+            self._mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, header_size = struct.unpack_from(INDEX_HEADER, self._mmap, 0)
+        start = struct.calcsize(INDEX_HEADER)
+        header = json.loads(
+            self._mmap[start:start + header_size].decode('utf-8')
+        )
+
+        if magic != INDEX_MAGIC or header['format'] != INDEX_FORMAT or \
+                header['byteorder'] != sys.byteorder:
+            raise exceptions.DataBaseError(
+                '{} is not an AGFusion index of format {} for this ' \
+                'machine!'.format(filename, INDEX_FORMAT)
+            )
+
+        self.build = header['build']
+        self.tables = header['tables']
+        self._base = _align(start + header_size)
+        self._view = memoryview(self._mmap)
+        self._lookups = {}
+
+    def _section(self, section):
+        offset, size, typecode = section
+        offset += self._base
+
+        return self._view[offset:offset + size].cast(typecode)
+
+    def _lookup(self, table, column):
+        """
+        The sections of a table and of the hashes of one of its lookup
+        columns
+        """
+
+        if (table, column) not in self._lookups:
+            if table not in self.tables:
+                raise exceptions.DataBaseError(
+                    'The index {} has no table {}!'.format(
+                        self.filename,
+                        table
+                    )
+                )
+
+            meta = self.tables[table]
+
+            if column not in meta['keys']:
+                raise exceptions.DataBaseError(
+                    'The index {} has no lookup column {}.{}!'.format(
+                        self.filename,
+                        table,
+                        column
+                    )
+                )
+
+            key = meta['keys'][column]
+            self._lookups[(table, column)] = (
+                self._base + meta['data'][0],
+                self._section(meta['offsets']),
+                self._section(key['hashes']),
+                self._section(key['starts']),
+                self._section(key['order']),
+                meta['columns'].index(column),
+                [_INDEX_CONVERTERS[i] for i in meta['types']],
+                set(meta['types']) == set(['text'])
+            )
+
+        return self._lookups[(table, column)]
+
+    def _row(self, data, offsets, row, converters, text_only):
+        fields = self._mmap[data + offsets[row]:data + offsets[row + 1]] \
+            .decode('utf-8')
+
+        if INDEX_NULL in fields:
+            fields = [
+                None if i == INDEX_NULL else i
+                for i in fields.split(INDEX_SEPARATOR)
+            ]
+        else:
+            fields = fields.split(INDEX_SEPARATOR)
+
+        if not text_only:
+            fields = [
+                i if i is None else convert(i)
+                for i, convert in zip(fields, converters)
+            ]
+
+        return tuple(fields)
+
+    def rows(self, table, column, values):
+        """
+        The rows of a table whose column equals each of values, as a list of
+        lists of row tuples
+        """
+
+        data, offsets, hashes, starts, order, index, converters, \
+            text_only = self._lookup(table, column)
+        rows = []
+
+        for value in values:
+            found = []
+            rows.append(found)
+
+            # like SQLite, compare values with the text of a text column and
+            # never match NULL
+
+            if value is None:
+                continue
+
+            key = str(value)
+            key_hash = zlib.crc32(key.encode('utf-8')) & 0xffffffff
+            group = bisect.bisect_left(hashes, key_hash)
+
+            # values with the same hash are told apart by the first of
+            # their rows
+
+            while group < len(hashes) and hashes[group] == key_hash:
+                group_rows = order[starts[group]:starts[group + 1]]
+                first = self._row(
+                    data,
+                    offsets,
+                    group_rows[0],
+                    converters,
+                    True
+                )
+
+                if first[index] == key:
+                    for row in group_rows:
+                        found.append(self._row(
+                            data,
+                            offsets,
+                            row,
+                            converters,
+                            text_only
+                        ))
+                    break
+
+                group += 1
+
+        return rows
+
+    @staticmethod
+    def write(sqlite3_db, build, filename, logger):
+        """
+        Write the index of a build's tables in an AGFusion database to
+        filename
+        """
+
+        cursor = sqlite3_db.cursor()
+
+        cursor.execute("SELECT name FROM sqlite_master WHERE type=='table'")
+        tables = [
+            i[0] for i in cursor.fetchall()
+            if i[0] in [build, build + '_transcript', build + '_refseq'] +
+            [build + '_' + j for j in PROTEIN_ANNOTATIONS]
+        ]
+
+        if build not in tables:
+            raise exceptions.DataBaseError(
+                'The database has no table {}!'.format(build)
+            )
+
+        header = {
+            'format': INDEX_FORMAT,
+            'byteorder': sys.byteorder,
+            'build': build,
+            'tables': {}
+        }
+        sections = []
+        size = [0]
+
+        def add_section(data, typecode='B'):
+            if typecode != 'B':
+                data = array.array(typecode, data)
+                data = data.tobytes() if hasattr(data, 'tobytes') \
+                    else data.tostring()
+
+            sections.append(data + b'\0' * (_align(len(data)) - len(data)))
+            size[0] += len(sections[-1])
+
+            return [size[0] - len(sections[-1]), len(data), typecode]
+
+        for table in sorted(tables):
+            logger.info('Writing the index of the table ' + table)
+
+            cursor.execute('PRAGMA table_info(' + table + ')')
+            columns = [i[1] for i in cursor.fetchall()]
+
+            cursor.execute('SELECT * FROM ' + table + ' ORDER BY rowid')
+            rows = cursor.fetchall()
+
+            types = []
+            for column, values in zip(columns, list(zip(*rows)) or
+                                      [[]] * len(columns)):
+                kinds = set([type(i) for i in values if i is not None])
+                for column_type in ['text', 'integer', 'real']:
+                    if kinds <= set(_INDEX_TYPES[column_type]):
+                        types.append(column_type)
+                        break
+                else:
+                    raise exceptions.DataBaseError(
+                        'Cannot index the column {}.{} holding {}!'.format(
+                            table,
+                            column,
+                            ', '.join(sorted([i.__name__ for i in kinds]))
+                        )
+                    )
+
+            # serialize the rows, their fields separated by a character
+            # that Ensembl data does not hold
+
+            data = []
+            offsets = [0]
+
+            for row in rows:
+                fields = []
+                for value, column_type in zip(row, types):
+                    if value is None:
+                        fields.append(INDEX_NULL)
+                    elif column_type == 'real':
+                        fields.append(repr(value))
+                    elif column_type == 'integer':
+                        fields.append(str(value))
+                    elif INDEX_SEPARATOR in value or INDEX_NULL in value:
+                        raise exceptions.DataBaseError(
+                            'Cannot index the value {} of {}!'.format(
+                                repr(value),
+                                table
+                            )
+                        )
+                    else:
+                        fields.append(value)
+
+                data.append(INDEX_SEPARATOR.join(fields).encode('utf-8'))
+                offsets.append(offsets[-1] + len(data[-1]))
+
+            offset_type = 'I' if offsets[-1] < 1 << 32 else 'Q'
+            meta = {
+                'columns': columns,
+                'types': types,
+                'rows': len(rows),
+                'data': add_section(b''.join(data)),
+                'offsets': add_section(offsets, offset_type),
+                'keys': {}
+            }
+
+            # group the rows by the hash of each lookup column's values
+
+            for column in [j for i, j in _index_columns(build)
+                           if i == table and j in columns]:
+                index = columns.index(column)
+                groups = OrderedDict()
+
+                for i, row in enumerate(rows):
+                    if row[index] is not None:
+                        groups.setdefault(str(row[index]), []).append(i)
+
+                groups = sorted(
+                    [(zlib.crc32(key.encode('utf-8')) & 0xffffffff, rows)
+                     for key, rows in groups.items()],
+                    key=lambda i: i[0]
+                )
+
+                starts = [0]
+                order = []
+                for key_hash, group_rows in groups:
+                    order += group_rows
+                    starts.append(len(order))
+
+                meta['keys'][column] = {
+                    'hashes': add_section([i[0] for i in groups], 'I'),
+                    'starts': add_section(starts, 'I'),
+                    'order': add_section(order, 'I')
+                }
+
+            header['tables'][table] = meta
+
+        # write to a temporary file first, so a partly written index is
+        # never used
+
+        header = json.dumps(header, sort_keys=True).encode('utf-8')
+        start = struct.calcsize(INDEX_HEADER) + len(header)
+
+        with open(filename + '.part', 'wb') as fout:
+            fout.write(struct.pack(INDEX_HEADER, INDEX_MAGIC, len(header)))
+            fout.write(header)
+            fout.write(b'\0' * (_align(start) - start))
+            for section in sections:
+                fout.write(section)
+
+        os.rename(filename + '.part', filename)
+
+
+def _align(size):
+    """
+    Round size up to a multiple of 8 bytes
+    """
+
+    return (size + 7) // 8 * 8
+
+
+def is_index(filename):
+    """
+    Whether a file is an AGFusion index rather than an SQLite database
+    """
+
+    with open(filename, 'rb') as fin:
+        return fin.read(len(INDEX_MAGIC)) == INDEX_MAGIC
+
 
 class AGFusionDB():
     """
@@ -15,28 +599,520 @@ class AGFusionDB():
     reference_name
     """
 
-    def __init__(self, database=None, debug=False):
+    def __init__(self, database=None, debug=False,
+                 feature_cache_size=PROTEIN_FEATURE_CACHE_SIZE,
+                 read_only=False, mmap_size=None, cache_size=None,
+                 in_memory=False):
 
         self.database = abspath(database)
         self.fastas = {}
 
-        self.logger = logging.getLogger('AGFusion')
-        if debug:
-            self.logger.setLevel(logging.DEBUG)
+        # protein features keyed by (translation_id, protein_database),
+        # shared by every fusion annotated with this database
+
+        self.protein_feature_cache = LRUCache(feature_cache_size)
+
+        # model.GeneResolver objects keyed by the pyensembl data they
+        # resolve genes against
+
+        self.gene_resolvers = {}
+
+        self.logger = get_logger(debug)
+
+        assert exists(self.database), "AGFusion database at %s does not exist! Either run \'agfusion download\' or specify the location of the AGFusion database with the --dbpath flag." % database
+
+        self.build = ''
+
+        # a binary index written by convert is read instead of the SQLite
+        # database
+
+        self.index = None
+
+        if is_index(self.database):
+            self.index = AGFusionIndex(self.database)
+            self.sqlite3_db = self.sqlite3_cursor = None
+
+            self.logger.debug('Opened the index ' + self.database)
+
+            return
+
+        # queries are issued with bound parameters so that sqlite can
+        # reuse the compiled statements from its cache
+
+        if read_only:
+
+            # an immutable database is read without taking any file locks,
+            # so it must not be changed while it is open
+
+            self.sqlite3_db = sqlite3.connect(
+                'file:' + pathname2url(self.database) +
+                '?mode=ro&immutable=1',
+                cached_statements=SQLITE_CACHED_STATEMENTS,
+                uri=True
+            )
+            if mmap_size is None:
+                mmap_size = SQLITE_MMAP_SIZE
         else:
-            self.logger.setLevel(logging.INFO)
-        ch = logging.StreamHandler()
-        if debug:
-            ch.setLevel(logging.DEBUG)
+            self.sqlite3_db = sqlite3.connect(
+                self.database,
+                cached_statements=SQLITE_CACHED_STATEMENTS
+            )
+
+        if in_memory:
+            self._load_into_memory()
+
+        self.sqlite3_cursor = self.sqlite3_db.cursor()
+
+        # cache_size is in pages, or in KiB if negative
+
+        if mmap_size is not None:
+            self.sqlite3_cursor.execute(
+                'PRAGMA mmap_size={:d}'.format(mmap_size)
+            )
+        if cache_size is not None:
+            self.sqlite3_cursor.execute(
+                'PRAGMA cache_size={:d}'.format(cache_size)
+            )
+
+        self.logger.debug(
+            'Connected to the database ' + self.database +
+            (' (in memory)' if in_memory else '') +
+            (' (read-only)' if read_only and not in_memory else '')
+        )
+
+    def _load_into_memory(self):
+        """
+        Copy the database into an in-memory database with the SQLite backup
+        API, so that lookups never touch the disk, and close the connection
+        to the file. Python versions before 3.7 lack the backup API, so
+        there the database is copied by replaying its SQL dump instead.
+        """
+
+        start_time = time.time()
+
+        sqlite3_db = sqlite3.connect(
+            ':memory:',
+            cached_statements=SQLITE_CACHED_STATEMENTS
+        )
+
+        if hasattr(self.sqlite3_db, 'backup'):
+            self.sqlite3_db.backup(sqlite3_db)
         else:
-            ch.setLevel(logging.INFO)
+            sqlite3_db.executescript('\n'.join(self.sqlite3_db.iterdump()))
+
+        self.sqlite3_db.close()
+        self.sqlite3_db = sqlite3_db
+
+        page_count = sqlite3_db.execute('PRAGMA page_count').fetchone()[0]
+        page_size = sqlite3_db.execute('PRAGMA page_size').fetchone()[0]
+
+        self.logger.info(
+            'Loaded the database into memory in {:.1f} seconds ({:.1f} MB).'
+            .format(
+                time.time() - start_time,
+                page_count * page_size / 1024. / 1024.
+            )
+        )
+
+    def _fetch(self, table, column, value, row_type):
+        """
+        Fetch the rows of a table whose column equals value
+        """
+
+        if self.index is not None:
+            return [
+                row_type(*i)
+                for i in self.index.rows(table, column, [value])[0]
+            ]
+
+        sqlite3_command = "SELECT * FROM " + table + " WHERE " + \
+            column + "==?"
+        self.logger.debug(
+            'SQLite - ' + sqlite3_command + ' (' + str(value) + ')'
+        )
+        self.sqlite3_cursor.execute(sqlite3_command, (value,))
+
+        return [row_type(*i) for i in self.sqlite3_cursor.fetchall()]
+
+    def _fetch_many(self, table, column, values, row_type):
+        """
+        Fetch the rows of a table whose column equals any of values. Returns
+        a dictionary mapping each value to its rows.
+        """
+
+        values = list(OrderedDict.fromkeys(values))
+        rows = OrderedDict((value, []) for value in values)
+        index = row_type._fields.index(column)
+
+        if self.index is not None:
+            for value, value_rows in zip(
+                    values,
+                    self.index.rows(table, column, values)):
+                for row in value_rows:
+                    rows.setdefault(row[index], []).append(row_type(*row))
+
+            return rows
+
+        for i in range(0, len(values), SQLITE_MAX_VARIABLES):
+            chunk = values[i:i + SQLITE_MAX_VARIABLES]
+
+            sqlite3_command = "SELECT * FROM " + table + " WHERE " + \
+                column + " IN (" + ','.join(['?'] * len(chunk)) + ")"
+            self.logger.debug(
+                'SQLite - ' + sqlite3_command + ' (' +
+                ','.join([str(j) for j in chunk]) + ')'
+            )
+            self.sqlite3_cursor.execute(sqlite3_command, chunk)
+
+            for row in self.sqlite3_cursor.fetchall():
+                rows.setdefault(row[index], []).append(row_type(*row))
+
+        return rows
+
+    def gene_by_stable_id(self, stable_id):
+        """
+        The gene with the Ensembl gene ID, or None if there is none
+        """
+
+        genes = self._fetch(self.build, 'stable_id', stable_id, GeneRow)
+
+        return genes[0] if genes else None
+
+    def genes_by_entrez_id(self, entrez_id):
+        """
+        All genes with the Entrez gene ID
+        """
+
+        return self._fetch(self.build, 'entrez_id', entrez_id, GeneRow)
+
+    def transcript_by_id(self, transcript_id):
+        """
+        The transcript with the internal database transcript ID, or None
+        """
+
+        transcripts = self._fetch(
+            self.build + '_transcript',
+            'transcript_id',
+            transcript_id,
+            TranscriptRow
+        )
+
+        return transcripts[0] if transcripts else None
+
+    def transcript_by_stable_id(self, stable_id):
+        """
+        The transcript with the Ensembl transcript ID, or None
+        """
+
+        transcripts = self._fetch(
+            self.build + '_transcript',
+            'transcript_stable_id',
+            stable_id,
+            TranscriptRow
+        )
+
+        return transcripts[0] if transcripts else None
+
+    def transcripts_by_gene_id(self, gene_id):
+        """
+        All transcripts of the gene with the internal database gene ID
+        """
+
+        return self._fetch(
+            self.build + '_transcript',
+            'gene_id',
+            gene_id,
+            TranscriptRow
+        )
+
+    def refseqs_by_id(self, refseq_id):
+        """
+        All transcripts with the RefSeq ID
+        """
+
+        return self._fetch(
+            self.build + '_refseq',
+            'refseq_id',
+            refseq_id,
+            RefSeqRow
+        )
+
+    def genes_by_stable_ids(self, stable_ids):
+        """
+        The genes with each of the Ensembl gene IDs
+        """
+
+        return self._fetch_many(self.build, 'stable_id', stable_ids, GeneRow)
+
+    def genes_by_entrez_ids(self, entrez_ids):
+        """
+        The genes with each of the Entrez gene IDs
+        """
+
+        return self._fetch_many(self.build, 'entrez_id', entrez_ids, GeneRow)
+
+    def transcripts_by_ids(self, transcript_ids):
+        """
+        The transcripts with each of the internal database transcript IDs
+        """
+
+        return self._fetch_many(
+            self.build + '_transcript',
+            'transcript_id',
+            transcript_ids,
+            TranscriptRow
+        )
+
+    def transcripts_by_stable_ids(self, stable_ids):
+        """
+        The transcripts with each of the Ensembl transcript IDs
+        """
+
+        return self._fetch_many(
+            self.build + '_transcript',
+            'transcript_stable_id',
+            stable_ids,
+            TranscriptRow
+        )
+
+    def refseqs_by_ids(self, refseq_ids):
+        """
+        The transcripts with each of the RefSeq IDs
+        """
+
+        return self._fetch_many(
+            self.build + '_refseq',
+            'refseq_id',
+            refseq_ids,
+            RefSeqRow
+        )
+
+    def translation_id_for_transcript(self, stable_id):
+        """
+        The translation ID of the transcript with the Ensembl transcript ID
+        """
+
+        transcript = self.transcript_by_stable_id(stable_id)
+
+        return transcript.translation_id if transcript is not None else None
+
+    def protein_features(self, translation_id, protein_database):
+        """
+        The features of a protein from one protein annotation database
+        (e.g. pfam)
+        """
+
+        return self.fetch_protein_features(
+            [translation_id],
+            [protein_database]
+        )[(translation_id, protein_database)]
+
+    def fetch_protein_features(self, translation_ids, protein_databases):
+        """
+        Fetch the features of several proteins from several protein
+        annotation databases with a single query. Returns a dictionary
+        keyed by (translation_id, protein_database) holding each protein's
+        features from that database, in database order. Features already
+        in the protein feature cache are not queried again.
+        """
+
+        translation_ids = list(OrderedDict.fromkeys(translation_ids))
+        protein_databases = list(OrderedDict.fromkeys(protein_databases))
+
+        for protein_database in protein_databases:
+            if protein_database not in PROTEIN_ANNOTATIONS:
+                raise exceptions.DataBaseError(
+                    '{} is not an available protein database! Choose ' \
+                    'from: {}'.format(
+                        protein_database,
+                        ', '.join(PROTEIN_ANNOTATIONS)
+                    )
+                )
+
+        features = OrderedDict()
+        missing_translation_ids = []
+        missing_protein_databases = []
+
+        for translation_id in translation_ids:
+            for protein_database in protein_databases:
+                key = (translation_id, protein_database)
+                features[key] = self.protein_feature_cache.get(key)
+
+                if features[key] is None:
+                    if translation_id not in missing_translation_ids:
+                        missing_translation_ids.append(translation_id)
+                    if protein_database not in missing_protein_databases:
+                        missing_protein_databases.append(protein_database)
+
+        if missing_translation_ids:
+            fetched = self._query_protein_features(
+                missing_translation_ids,
+                missing_protein_databases
+            )
+
+            for key, value in fetched.items():
+                self.protein_feature_cache.put(key, value)
+                if key in features:
+                    features[key] = value
+
+        # cached features are stored as tuples, so hand out copies that the
+        # caller is free to change
+
+        return OrderedDict(
+            (key, list(value)) for key, value in features.items()
+        )
+
+    def _query_protein_features(self, translation_ids, protein_databases):
+        """
+        Query the protein annotation tables for the features of several
+        proteins from several protein databases
+        """
+
+        features = OrderedDict(
+            ((translation_id, protein_database), [])
+            for translation_id in translation_ids
+            for protein_database in protein_databases
+        )
+
+        if self.index is not None:
+            for protein_database in protein_databases:
+                for translation_id, rows in zip(
+                        translation_ids,
+                        self.index.rows(
+                            self.build + '_' + protein_database,
+                            'translation_id',
+                            translation_ids)):
+                    for row in rows:
+                        features.setdefault(
+                            (row[0], protein_database), []
+                        ).append(ProteinFeatureRow(*row))
+
+            return OrderedDict(
+                (key, tuple(value)) for key, value in features.items()
+            )
+
+        # one SELECT per annotation table, tagged with the table it came
+        # from, combined into a single statement
+
+        placeholders = ','.join(['?'] * len(translation_ids))
+        selects = []
+        parameters = []
+
+        for protein_database in protein_databases:
+            selects.append(
+                "SELECT ?,* FROM " + self.build + "_" + protein_database +
+                " WHERE translation_id IN (" + placeholders + ")"
+            )
+            parameters += [protein_database] + translation_ids
+
+        sqlite3_command = " UNION ALL ".join(selects)
+        self.logger.debug(
+            'SQLite - ' + sqlite3_command + ' (' +
+            ','.join([str(i) for i in parameters]) + ')'
+        )
+        self.sqlite3_cursor.execute(sqlite3_command, parameters)
+
+        for row in self.sqlite3_cursor.fetchall():
+            features.setdefault((row[1], row[0]), []).append(
+                ProteinFeatureRow(*row[1:])
+            )
+
+        return OrderedDict(
+            (key, tuple(value)) for key, value in features.items()
+        )
+
+    def _check_sqlite(self):
+        if self.index is not None:
+            raise exceptions.DataBaseError(
+                '{} is an index, not an SQLite database!'.format(
+                    self.database
+                )
+            )
+
+    def optimize(self):
+        """
+        Add the lookup indexes to a database that was built or downloaded
+        without them, then gather statistics for the query planner
+        """
+
+        self._check_sqlite()
+
+        _create_indexes(self.sqlite3_db, self.build, self.logger)
+
+        self.logger.info('SQLite - ANALYZE;')
+        self.sqlite3_cursor.execute('ANALYZE;')
+        self.sqlite3_db.commit()
+
+    def convert(self, filename):
+        """
+        Write the tables of the database to a binary index, which AGFusionDB
+        reads instead of the database when given its filename
+        """
+
+        self._check_sqlite()
+
+        start_time = time.time()
+
+        AGFusionIndex.write(self.sqlite3_db, self.build, filename, self.logger)
+
+        self.logger.info(
+            'Wrote the index {} in {:.1f} seconds ({:.1f} MB).'.format(
+                filename,
+                time.time() - start_time,
+                getsize(filename) / 1024. / 1024.
+            )
+        )
+
+
+class AGFusionDBBManager():
+    """
+    Class to handle methods managing the SQLite3 database
+
+    name: name of the database
+    reference
+    incremental: keep the tables a previous build of the same release
+        completed (see _check_for_tables) instead of fetching them again
+    bulk_load: load the tables with BULK_LOAD_PRAGMAS and without indexes,
+        which finish() then creates before compacting the database
+    """
+
+    def __init__(self, db_dir, species, release, pfam, server,
+                 incremental=False, bulk_load=False):
+
+        self.species = species
+        self.release = release
+        self.server = server
+        self.build = self.species + '_' + str(self.release)
+        self.table = ENSEMBL_MYSQL_TABLES[self.species][self.release]
+        self.incremental = incremental
+        self.bulk_load = bulk_load
+        self.start_time = time.time()
+        self._ensembl = threading.local()
+        self.provenance_table = self.build + '_provenance'
+        self.completed_tables = set()
+
+        self.database = join(
+            abspath(db_dir),
+            'agfusion.' + self.species + '.' + str(self.release) + '.db'
+        )
+        self.fastas = {}
+
+        self.logger = logging.getLogger('AGFusion')
+        self.logger.setLevel(logging.INFO)
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.INFO)
         formatter = logging.Formatter(
             '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
         )
         ch.setFormatter(formatter)
         self.logger.addHandler(ch)
 
-        assert exists(self.database), "AGFusion database at %s does not exist! Either run \'agfusion download\' or specify the location of the AGFusion database with the --dbpath flag." % database
+        if not exists(self.database):
+            fout = open(abspath(self.database), 'a')
+            fout.close()
+            self.logger.info(
+                "Created the database " + abspath(self.database)
+            )
 
         self.sqlite3_db = sqlite3.connect(
             abspath(self.database)
@@ -44,172 +1120,386 @@ class AGFusionDB():
         self.sqlite3_cursor = self.sqlite3_db.cursor()
         self.sqlite3_db.commit()
 
-        self.logger.debug(
+        self.logger.info(
             'Connected to the database ' + abspath(self.database)
         )
 
-        self.build = ''
+        if self.bulk_load:
+            for sqlite3_command in BULK_LOAD_PRAGMAS:
+                self.logger.info('SQLite - ' + sqlite3_command + ';')
+                self.sqlite3_cursor.execute(sqlite3_command)
 
+        self._connect_ensembl()
 
-class AGFusionDBBManager():
-    """
-    Class to handle methods managing the SQLite3 database
+        self._check_for_tables()
 
-    name: name of the database
-    reference
-    """
+        #load the PFAM mappings
+
+        self.pfam_mapping = dict()
+
+        for line in open(pfam, 'r'):
+            line = line.rstrip().split('\t')
+
+            pfam_id = line[0]
+            pfam_name = line[1]
+            pfam_desc = line[3]
+
+            self.pfam_mapping[pfam_id] = {
+                'name': pfam_name,
+                'desc': pfam_desc
+            }
+
+    @property
+    def ensembl_db(self):
+        """
+        The current thread's connection to the Ensembl MySQL server
+        """
+
+        if not hasattr(self._ensembl, 'db'):
+            self._connect_ensembl()
+
+        return self._ensembl.db
+
+    @property
+    def ensembl_cursor(self):
+        """
+        A cursor of the current thread's connection to the Ensembl MySQL
+        server
+        """
+
+        if not hasattr(self._ensembl, 'cursor'):
+            self._connect_ensembl()
+
+        return self._ensembl.cursor
+
+    def _connect_ensembl(self):
+        """
+        (Re)connect the current thread to the Ensembl MySQL server
+        """
+
+        import MySQLdb
+
+        # a connection that dropped is replaced, so close what is left of it
+
+        if hasattr(self._ensembl, 'db'):
+            try:
+                self._ensembl.db.close()
+            except MySQLdb.Error:
+                pass
+
+        self._ensembl.db = MySQLdb.connect(self.server, 'anonymous')
+        self._ensembl.cursor = self._ensembl.db.cursor()
+        self._ensembl.cursor.execute('use ' + self.table + ';')
+
+        self.logger.info(
+            'Connected to the ensembl MySQL server at ' + self.server
+        )
+        self.logger.info('MySQL - use ' +  self.table + ';')
+
+    def _close_ensembl(self):
+        """
+        Close the current thread's connection to the Ensembl MySQL server
+        """
+
+        if hasattr(self._ensembl, 'db'):
+            self._ensembl.db.close()
+            del self._ensembl.db
+            del self._ensembl.cursor
+
+    def close(self):
+        """
+        Close the current thread's connection to the Ensembl MySQL server
+        """
+
+        self._close_ensembl()
+
+    def _stream_ensembl(self, mysql_command, on_retry=None):
+        """
+        Run a query on the Ensembl MySQL server with a server-side cursor
+        and yield its rows in chunks of BUILD_CHUNK_SIZE, so they are never
+        all held in memory. If the connection drops the query is run again
+        on a new connection, after calling on_retry to undo what was done
+        with the chunks already yielded.
+        """
+
+        import MySQLdb
+        import MySQLdb.cursors
+
+        self.logger.info('MySQL - ' + mysql_command)
+
+        wait = MYSQL_RETRY_WAIT
+        retry = 0
+
+        while True:
+            try:
+                cursor = self.ensembl_db.cursor(MySQLdb.cursors.SSCursor)
+
+                # the cursor is closed however the query ends, or the rest
+                # of its unbuffered result would be left on the connection
+                # and the thread's next query would fail
+
+                try:
+                    cursor.execute(mysql_command)
+
+                    rows = cursor.fetchmany(BUILD_CHUNK_SIZE)
+                    while rows:
+                        yield rows
+                        rows = cursor.fetchmany(BUILD_CHUNK_SIZE)
+                finally:
+                    try:
+                        cursor.close()
+                    except MySQLdb.Error:
+                        pass
+
+                return
+            except MySQLdb.OperationalError as e:
+                if retry == MYSQL_RETRIES:
+                    raise
+
+                self.logger.warn(
+                    'Lost the connection to the ensembl MySQL server ' +
+                    '({}), reconnecting in {} seconds...'.format(e, wait)
+                )
+
+                time.sleep(wait)
+                wait *= 2
+                retry += 1
+
+                try:
+                    self._connect_ensembl()
+                except MySQLdb.OperationalError as e:
+                    self.logger.warn(
+                        'Could not reconnect to the ensembl MySQL ' +
+                        'server ({}).'.format(e)
+                    )
+
+                if on_retry is not None:
+                    on_retry()
+
+    def _insert_rows(self, table, mysql_command, transform):
+        """
+        Stream the rows of an Ensembl query into a table, inserting each
+        chunk in its own transaction
+        """
+
+        def clear_table():
+            self.sqlite3_cursor.execute('DELETE FROM ' + table)
+            self.sqlite3_db.commit()
+
+        sqlite3_command = None
+
+        for rows in self._stream_ensembl(mysql_command, clear_table):
+            rows = [transform(i) for i in rows]
+
+            if sqlite3_command is None:
+                sqlite3_command = 'INSERT INTO ' + table + ' VALUES (' + \
+                    ','.join(['?'] * len(rows[0])) + ')'
+
+            self.sqlite3_cursor.executemany(sqlite3_command, rows)
+            self.sqlite3_db.commit()
+
+    def _update_rows(self, table, column, key, mysql_command):
+        """
+        Stream (key, value) rows of an Ensembl query into the column of the
+        table's rows with that key, each chunk in its own transaction. Later
+        rows overwrite earlier ones with the same key.
+        """
+
+        sqlite3_command = 'UPDATE ' + table + ' SET ' + column + '=? ' + \
+            'WHERE ' + key + '=?'
+
+        self.logger.info('SQLite - ' + sqlite3_command)
+
+        for rows in self._stream_ensembl(mysql_command):
+            self.sqlite3_cursor.executemany(
+                sqlite3_command,
+                [(i[1], i[0]) for i in rows]
+            )
+            self.sqlite3_db.commit()
+
+    def _table_provenance(self, table):
+        """
+        The number of rows and the checksum of a table's contents
+        """
+
+        md5 = hashlib.md5()
+        row_count = 0
+
+        self.sqlite3_cursor.execute(
+            'SELECT * FROM ' + table + ' ORDER BY rowid'
+        )
+        for row in self.sqlite3_cursor:
+            row = json.dumps(row, default=repr) + '\n'
+            md5.update(row.encode('utf-8'))
+            row_count += 1
 
-    def __init__(self, db_dir, species, release, pfam, server):
+        return row_count, md5.hexdigest()
 
-        self.species = species
-        self.release = release
-        self.server = server
-        self.build = self.species + '_' + str(self.release)
-        self.table = ENSEMBL_MYSQL_TABLES[self.species][self.release]
+    def _is_complete(self, table):
+        """
+        Whether a previous build of this release completed the table and it
+        still holds the rows that build recorded
+        """
 
-        self.database = join(
-            abspath(db_dir),
-            'agfusion.' + self.species + '.' + str(self.release) + '.db'
+        self.sqlite3_cursor.execute(
+            'SELECT release,row_count,checksum FROM ' +
+            self.provenance_table + ' WHERE table_name=?',
+            [table]
         )
-        self.fastas = {}
+        provenance = self.sqlite3_cursor.fetchone()
 
-        self.logger = logging.getLogger('AGFusion')
-        self.logger.setLevel(logging.INFO)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.INFO)
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        )
-        ch.setFormatter(formatter)
-        self.logger.addHandler(ch)
+        if provenance is None or provenance[0] != self.release:
+            return False
 
-        if not exists(self.database):
-            fout = open(abspath(self.database), 'a')
-            fout.close()
-            self.logger.info(
-                "Created the database " + abspath(self.database)
-            )
+        return tuple(provenance[1:]) == self._table_provenance(table)
 
-        self.sqlite3_db = sqlite3.connect(
-            abspath(self.database)
+    def _record_provenance(self, table):
+        """
+        Record that a table was completed, then commit it together with
+        the table's rows
+        """
+
+        row_count, checksum = self._table_provenance(table)
+
+        self.sqlite3_cursor.execute(
+            'INSERT OR REPLACE INTO ' + self.provenance_table +
+            ' VALUES (?,?,?,?,?)',
+            [table, self.release, row_count, checksum,
+             time.strftime('%Y-%m-%d %H:%M:%S')]
         )
-        self.sqlite3_cursor = self.sqlite3_db.cursor()
         self.sqlite3_db.commit()
 
         self.logger.info(
-            'Connected to the database ' + abspath(self.database)
+            'Completed table {} ({} rows).'.format(table, row_count)
         )
 
-        import MySQLdb
+    def _create_table(self, table, sqlite3_command):
+        """
+        (Re)create a table, unless this is an incremental build and a
+        previous build already completed it
+        """
 
-        self.ensembl_db = MySQLdb.connect(server, 'anonymous')
-        self.ensembl_cursor = self.ensembl_db.cursor()
-        self.ensembl_cursor.execute('use ' + self.table + ';')
+        if self.incremental and self._is_complete(table):
+            self.logger.info(
+                'Table {} is already complete, skipping it.'.format(table)
+            )
+            self.completed_tables.add(table)
+            return
 
-        self.logger.info(
-            'Connected to the ensembl MySQL server at ' + server
+        self.sqlite3_cursor.execute('drop table if exists ' + table)
+        self.sqlite3_cursor.execute(
+            'DELETE FROM ' + self.provenance_table + ' WHERE table_name=?',
+            [table]
         )
-        self.logger.info('MySQL - use ' +  self.table + ';')
 
-        self._check_for_tables()
-
-        #load the PFAM mappings
-
-        self.pfam_mapping = dict()
+        self.logger.info('SQLite - ' + sqlite3_command)
 
-        for line in open(pfam, 'r'):
-            line = line.rstrip().split('\t')
+        self.sqlite3_cursor.execute(
+            sqlite3_command
+        )
+        self.sqlite3_db.commit()
 
-            pfam_id = line[0]
-            pfam_name = line[1]
-            pfam_desc = line[3]
+    def _check_for_tables(self):
+        """
+        Create the build's tables. Each table that is completed is recorded
+        in the provenance table with the release, its row count and a
+        checksum of its rows, so an incremental build can keep it.
+        """
+
+        sqlite3_command = "CREATE TABLE IF NOT EXISTS " + \
+            self.provenance_table + " (" + \
+            "table_name text PRIMARY KEY," + \
+            "release integer," + \
+            "row_count integer," + \
+            "checksum text," + \
+            "completed text);"
 
-            self.pfam_mapping[pfam_id] = {
-                'name': pfam_name,
-                'desc': pfam_desc
-            }
+        self.logger.info('SQLite - ' + sqlite3_command)
 
-    def _check_for_tables(self):
+        self.sqlite3_cursor.execute(
+            sqlite3_command
+        )
+        self.sqlite3_db.commit()
 
-        self.sqlite3_cursor.execute('drop table if exists ' + self.build)
+        # gene table
 
         sqlite3_command = "CREATE TABLE " + self.build + " (" + \
-            "gene_id text," + \
+            "gene_id text PRIMARY KEY," + \
             "stable_id text," + \
             "entrez_id text," + \
             "gene_name text," + \
             "canonical_transcript_id text);"
 
-        self.logger.info('SQLite - ' + sqlite3_command)
-
-        self.sqlite3_cursor.execute(
-            sqlite3_command
-        )
-        self.sqlite3_db.commit()
+        self._create_table(self.build, sqlite3_command)
 
         # transcript table
 
-        self.sqlite3_cursor.execute(
-            'drop table if exists ' +
-            self.build + '_transcript'
-        )
-
         sqlite3_command = "CREATE TABLE " + self.build + "_transcript (" + \
-            "transcript_id text," + \
+            "transcript_id text PRIMARY KEY," + \
             "gene_id text," + \
             "transcript_stable_id text," + \
             "translation_id text);"
 
-        self.logger.info('SQLite - ' + sqlite3_command)
-
-        self.sqlite3_cursor.execute(
-            sqlite3_command
-        )
-        self.sqlite3_db.commit()
+        self._create_table(self.build + '_transcript', sqlite3_command)
 
         # refseq table
 
-        self.sqlite3_cursor.execute(
-            'drop table if exists ' +
-            self.build + '_refseq'
-        )
-
         sqlite3_command = "CREATE TABLE " + self.build + "_refseq (" + \
             "transcript_id text," + \
             "transcript_stable_id text," + \
             "refseq_id text);"
 
-        self.logger.info('SQLite - ' + sqlite3_command)
-
-        self.sqlite3_cursor.execute(
-            sqlite3_command
-        )
-        self.sqlite3_db.commit()
+        self._create_table(self.build + '_refseq', sqlite3_command)
 
         # protein annotation tables
 
         for protein_annotation in PROTEIN_ANNOTATIONS:
-            self.sqlite3_cursor.execute(
-                'drop table if exists ' +
-                self.build + '_' + protein_annotation
-            )
-
             sqlite3_command = "CREATE TABLE {}_{} (" \
                 "translation_id text,stable_id text,hit_id text," \
                 "seq_start integer,seq_end integer,hit_description text," \
                 "hit_name text);".format(self.build,protein_annotation)
 
-            self.logger.info('SQLite - ' + sqlite3_command)
-
-            self.sqlite3_cursor.execute(
+            self._create_table(
+                self.build + '_' + protein_annotation,
                 sqlite3_command
             )
-            self.sqlite3_db.commit()
 
+        # indexes on the columns genes, transcripts and protein features
+        # are looked up by (a bulk load creates them in finish, once the
+        # tables are filled)
+
+        if not self.bulk_load:
+            _create_indexes(self.sqlite3_db, self.build, self.logger)
+
+    def finish(self):
+        """
+        Finish a build. A bulk load gets the indexes it deferred, statistics
+        for the query planner and is compacted with the default journal
+        restored. The build time and the size of the database are logged.
+        """
+
+        if self.bulk_load:
+            _create_indexes(self.sqlite3_db, self.build, self.logger)
+
+            for sqlite3_command in [
+                    'ANALYZE', 'PRAGMA journal_mode=DELETE',
+                    'PRAGMA synchronous=FULL', 'VACUUM']:
+                self.logger.info('SQLite - ' + sqlite3_command + ';')
+                self.sqlite3_cursor.execute(sqlite3_command)
+                self.sqlite3_db.commit()
+
+        self.logger.info(
+            'Built {} in {:.1f} seconds ({:.1f} MB).'.format(
+                self.database,
+                time.time() - self.start_time,
+                getsize(self.database) / 1e6
+            )
+        )
 
     def fetch_gene_names(self):
 
-        genes = {}
+        if self.build in self.completed_tables:
+            return
 
         # fetch all gene stable ids
 
@@ -218,28 +1508,22 @@ class AGFusionDBBManager():
         else:
             mysql_command = "SELECT gene.gene_id, gene.stable_id, gene.canonical_transcript_id FROM gene;"
 
-        self.logger.info('MySQL - ' + mysql_command)
+        self.logger.info(
+            'SQLite - INSERT INTO ' +
+            self.build + ' VALUES (gene_id,stable_id,entrez_id,gene_name,canonical_transcript_id)'
+        )
 
-        self.ensembl_cursor.execute(
-            mysql_command
+        self._insert_rows(
+            self.build,
+            mysql_command,
+            lambda g: [g[0], g[1], '', '', g[2]]
         )
-        for g in self.ensembl_cursor.fetchall():
-            genes[g[0]] = {
-                'stable_id': g[1],
-                'canonical_transcript_id': g[2],
-                'entrez_id': '',
-                'gene_name': ''
-            }
 
         # fetch entrez IDS
 
         mysql_command = "SELECT gene.gene_id, xref.dbprimary_acc FROM gene, object_xref, xref,external_db WHERE gene.gene_id = object_xref.ensembl_id AND object_xref.ensembl_object_type = 'Gene' AND object_xref.xref_id = xref.xref_id AND xref.external_db_id = external_db.external_db_id AND external_db.db_name = 'EntrezGene';"
-        self.logger.info('MySQL - ' + mysql_command)
 
-        self.ensembl_cursor.execute(mysql_command)
-
-        for g in self.ensembl_cursor.fetchall():
-            genes[g[0]]['entrez_id'] = g[1]
+        self._update_rows(self.build, 'entrez_id', 'gene_id', mysql_command)
 
         # fetch gene names
 
@@ -255,36 +1539,15 @@ class AGFusionDBBManager():
 
         mysql_command = """SELECT gene.gene_id, xref.display_label FROM gene, object_xref, xref,external_db WHERE gene.gene_id = object_xref.ensembl_id AND object_xref.ensembl_object_type = 'Gene' AND object_xref.xref_id = xref.xref_id AND xref.external_db_id = external_db.external_db_id AND external_db.db_name = '""" + gene_name_db + """';"""
 
-        self.logger.info('MySQL - ' + mysql_command)
-
-        self.ensembl_cursor.execute(mysql_command)
-
-        for g, e in self.ensembl_cursor.fetchall():
-            genes[g]['gene_name'] = e
-
-        genes = [
-            [
-                i,
-                genes[i]['stable_id'],
-                genes[i]['entrez_id'],
-                genes[i]['gene_name'],
-                genes[i]['canonical_transcript_id']
-            ] for i in list(genes.keys())
-        ]
-
-        self.logger.info(
-            'SQLite - INSERT INTO ' +
-            self.build + ' VALUES (gene_id,stable_id,entrez_id,gene_name,canonical_transcript_id)'
-        )
-
-        self.sqlite3_cursor.executemany(
-            'INSERT INTO ' + self.build + ' VALUES (?,?,?,?,?)', genes
-        )
+        self._update_rows(self.build, 'gene_name', 'gene_id', mysql_command)
 
-        self.sqlite3_db.commit()
+        self._record_provenance(self.build)
 
     def fetch_transcript_table(self):
 
+        if self.build + '_transcript' in self.completed_tables:
+            return
+
         # Fetch all transcripts
 
         if self.release < 65:
@@ -292,123 +1555,574 @@ class AGFusionDBBManager():
         else:
             mysql_command = "SELECT transcript.transcript_id, transcript.gene_id, transcript.stable_id FROM transcript;"
 
-        self.logger.info('MySQL - ' + mysql_command)
-        self.ensembl_cursor.execute(
-            mysql_command
+        self.logger.info(
+            'SQLite - INSERT INTO ' +
+            self.build + '_transcript VALUES (transcript_id,gene_id,transcript_stable_id,translation_id)'
         )
-        transcripts = {}
-        for transcript in self.ensembl_cursor.fetchall():
-            transcripts[transcript[0]] = {
-                'gene_id': transcript[1],
-                'transcript_stable_id': transcript[2],
-                'translation_id': ''
-            }
-
-        # Fetch all transcripts with tranlstions
 
-        mysql_command = "SELECT transcript.transcript_id, translation.translation_id FROM transcript, translation WHERE transcript.transcript_id = translation.transcript_id;"
-        self.logger.info('MySQL - ' + mysql_command)
-        self.ensembl_cursor.execute(
-            mysql_command
+        self._insert_rows(
+            self.build + '_transcript',
+            mysql_command,
+            lambda t: [t[0], t[1], t[2], '']
         )
-        for transcript in self.ensembl_cursor.fetchall():
-            transcripts[transcript[0]]['translation_id'] = transcript[1]
 
-        transcripts = [
-            [
-                i,
-                transcripts[i]['gene_id'],
-                transcripts[i]['transcript_stable_id'],
-                transcripts[i]['translation_id']
-            ] for i in list(transcripts.keys())
-        ]
+        # Fetch all transcripts with tranlstions
 
-        self.logger.info(
-            'SQLite - INSERT INTO ' +
-            self.build + '_transcript VALUES (transcript_id,gene_id,transcript_stable_id,translation_id)'
-        )
+        mysql_command = "SELECT transcript.transcript_id, translation.translation_id FROM transcript, translation WHERE transcript.transcript_id = translation.transcript_id;"
 
-        self.sqlite3_cursor.executemany(
-            'INSERT INTO ' + self.build + '_transcript VALUES (?,?,?,?)', transcripts
+        self._update_rows(
+            self.build + '_transcript',
+            'translation_id',
+            'transcript_id',
+            mysql_command
         )
 
-        self.sqlite3_db.commit()
+        self._record_provenance(self.build + '_transcript')
 
     def fetch_refseq_table(self):
 
+        if self.build + '_refseq' in self.completed_tables:
+            return
+
         # fetch RefSeq IDS
 
         if self.release < 65:
             mysql_command = "SELECT transcript.transcript_id, transcript_stable_id.stable_id, xref.display_label FROM transcript, transcript_stable_id, object_xref, xref, external_db WHERE transcript.transcript_id = transcript_stable_id.transcript_id and transcript.transcript_id = object_xref.ensembl_id AND object_xref.ensembl_object_type = \'Transcript\' AND object_xref.xref_id = xref.xref_id AND xref.external_db_id = external_db.external_db_id AND external_db.db_name = \'RefSeq_mRNA\';"
         else:
             mysql_command = "SELECT transcript.transcript_id, transcript.stable_id, xref.display_label FROM transcript, object_xref, xref, external_db WHERE transcript.transcript_id = object_xref.ensembl_id AND object_xref.ensembl_object_type = \'Transcript\' AND object_xref.xref_id = xref.xref_id AND xref.external_db_id = external_db.external_db_id AND external_db.db_name = \'RefSeq_mRNA\';"
-        self.logger.info('MySQL - ' + mysql_command)
-        self.ensembl_cursor.execute(
-            mysql_command
-        )
-
-        refseqs = [
-            [
-                i[0],
-                i[1],
-                i[2]
-            ] for i in self.ensembl_cursor.fetchall()
-        ]
 
         self.logger.info(
             'SQLite - INSERT INTO ' +
             self.build + '_refseq VALUES (transcript_id,transcript_stable_id,refseq_id)'
         )
 
-        self.sqlite3_cursor.executemany(
-            'INSERT INTO ' + self.build + '_refseq VALUES (?,?,?)', refseqs
+        self._insert_rows(
+            self.build + '_refseq',
+            mysql_command,
+            lambda i: [i[0], i[1], i[2]]
         )
 
-        self.sqlite3_db.commit()
+        self._record_provenance(self.build + '_refseq')
 
-    def fetch_protein_annotation(self):
+    def _protein_feature_row(self, protein_annotation, row):
+        """
+        A protein_feature row as a row of a protein annotation table.
+        Releases before 70 have no hit description, and Pfam hits get their
+        name and description from the Pfam mapping.
+        """
 
-        for protein_annotation in PROTEIN_ANNOTATIONS:
+        row = list(row)
+
+        if self.release < 70:
+            row.append(None)
 
-            if self.release < 70:
-                mysql_command = "SELECT translation.translation_id, translation_stable_id.stable_id, protein_feature.hit_name, protein_feature.seq_start, protein_feature.seq_end FROM analysis, analysis_description, protein_feature, translation, translation_stable_id WHERE translation_stable_id.translation_id = translation.translation_id AND protein_feature.translation_id = translation.translation_id AND protein_feature.analysis_id = analysis.analysis_id AND analysis.analysis_id = analysis_description.analysis_id AND analysis.logic_name = \'" + protein_annotation + "\';"
+        if protein_annotation == 'pfam':
+            if row[2] in self.pfam_mapping:
+                row.append(self.pfam_mapping[row[2]]['name'])
+                row[5] = self.pfam_mapping[row[2]]['desc']
             else:
-                mysql_command = "SELECT translation.translation_id, translation.stable_id, protein_feature.hit_name, protein_feature.seq_start, protein_feature.seq_end, protein_feature.hit_description FROM analysis, analysis_description, protein_feature, translation WHERE protein_feature.translation_id = translation.translation_id AND protein_feature.analysis_id = analysis.analysis_id AND analysis.analysis_id = analysis_description.analysis_id AND analysis.logic_name = \'" + protein_annotation + "\';"
+                row.append('')
+        else:
+            row.append(None)
 
-            self.logger.info('MySQL - ' + mysql_command)
+        return row
 
-            self.ensembl_cursor.execute(
-                mysql_command
-            )
+    def _protein_feature_query(self, protein_annotation):
+        """
+        The Ensembl query for the protein features of a protein annotation
+        """
 
-            data = list(self.ensembl_cursor.fetchall())
+        if self.release < 70:
+            mysql_command = "SELECT translation.translation_id, translation_stable_id.stable_id, protein_feature.hit_name, protein_feature.seq_start, protein_feature.seq_end FROM analysis, analysis_description, protein_feature, translation, translation_stable_id WHERE translation_stable_id.translation_id = translation.translation_id AND protein_feature.translation_id = translation.translation_id AND protein_feature.analysis_id = analysis.analysis_id AND analysis.analysis_id = analysis_description.analysis_id AND analysis.logic_name = \'" + protein_annotation + "\';"
+        else:
+            mysql_command = "SELECT translation.translation_id, translation.stable_id, protein_feature.hit_name, protein_feature.seq_start, protein_feature.seq_end, protein_feature.hit_description FROM analysis, analysis_description, protein_feature, translation WHERE protein_feature.translation_id = translation.translation_id AND protein_feature.analysis_id = analysis.analysis_id AND analysis.analysis_id = analysis_description.analysis_id AND analysis.logic_name = \'" + protein_annotation + "\';"
 
-            if self.release < 70:
-                data = [i + (None,) for i in data]
+        return mysql_command
 
-            if protein_annotation=='pfam':
-                for i in range(0,len(data)):
-                    tmp = list(data[i])
-                    if tmp[2] in self.pfam_mapping:
-                        tmp.append(self.pfam_mapping[tmp[2]]['name'])
-                        tmp[5] = self.pfam_mapping[tmp[2]]['desc']
-                    else:
-                        tmp.append('')
-                    data[i] = tmp
-            else:
-                for i in range(0,len(data)):
-                    tmp = list(data[i])
-                    tmp.append(None)
-                    data[i] = tmp
+    def fetch_protein_annotation(self, connections=1):
+        """
+        Fetch the protein features of each protein annotation. With more
+        than one connection the annotations are queried concurrently, each
+        on its own connection to the Ensembl MySQL server, while this
+        thread alone writes the rows to SQLite.
+        """
+
+        protein_annotations = [
+            i for i in PROTEIN_ANNOTATIONS
+            if self.build + '_' + i not in self.completed_tables
+        ]
+
+        if connections > 1 and len(protein_annotations) > 1:
+            self._fetch_protein_annotation_concurrently(
+                protein_annotations,
+                connections
+            )
+            return
+
+        for protein_annotation in protein_annotations:
+
+            table = self.build + '_' + protein_annotation
 
             self.logger.info(
                 'SQLite - INSERT INTO ' +
                 self.build + '_' + protein_annotation + ' VALUES (translation_id,stable_id,hit_id,seq_start,seq_end,hit_description,hit_name)'
             )
 
-            self.sqlite3_cursor.executemany(
-                'INSERT INTO ' + self.build +
-                '_' + protein_annotation + ' VALUES (?,?,?,?,?,?,?)', data
+            self._insert_rows(
+                table,
+                self._protein_feature_query(protein_annotation),
+                lambda i: self._protein_feature_row(protein_annotation, i)
             )
 
-            self.sqlite3_db.commit()
+            self._record_provenance(table)
+
+    def _fetch_protein_annotation_concurrently(self, protein_annotations,
+                                              connections):
+        """
+        Query the protein annotations over a pool of connections. The
+        fetching threads put (table, message, rows) tuples on a bounded
+        queue that this thread writes to SQLite: 'rows' with a chunk of
+        rows, 'clear' when a query is rerun after its connection dropped,
+        'done' when a table is complete and 'error' with the exception a
+        query failed with.
+        """
+
+        chunks = queue.Queue(maxsize=2 * connections)
+        stop = threading.Event()
+
+        def fetch(protein_annotation):
+            table = self.build + '_' + protein_annotation
+
+            # nothing is queued once this thread stopped writing to SQLite,
+            # so the remaining annotations are not queried at all
+
+            if stop.is_set():
+                return
+
+            # the query is closed when the thread stops early, so its
+            # cursor does not hold on to the rest of the result, and so is
+            # the thread's own connection once the query is done
+
+            try:
+                with closing(self._stream_ensembl(
+                        self._protein_feature_query(protein_annotation),
+                        lambda: chunks.put((table, 'clear', None)))) as query:
+                    for rows in query:
+                        if stop.is_set():
+                            return
+                        chunks.put((
+                            table,
+                            'rows',
+                            [self._protein_feature_row(protein_annotation, i)
+                             for i in rows]
+                        ))
+            except Exception as e:
+                if not stop.is_set():
+                    chunks.put((table, 'error', e))
+            else:
+                if not stop.is_set():
+                    chunks.put((table, 'done', None))
+            finally:
+                self._close_ensembl()
+
+        self.logger.info(
+            'Fetching {} protein annotations over {} connections.'
+            .format(len(protein_annotations), connections)
+        )
+
+        pool = ThreadPool(processes=connections)
+        result = pool.map_async(fetch, protein_annotations)
+        pool.close()
+
+        try:
+            pending = len(protein_annotations)
+
+            while pending:
+                table, message, rows = chunks.get()
+
+                if message == 'rows':
+                    self.sqlite3_cursor.executemany(
+                        'INSERT INTO ' + table + ' VALUES (?,?,?,?,?,?,?)',
+                        rows
+                    )
+                    self.sqlite3_db.commit()
+                elif message == 'clear':
+                    self.sqlite3_cursor.execute('DELETE FROM ' + table)
+                    self.sqlite3_db.commit()
+                elif message == 'done':
+                    self._record_provenance(table)
+                    pending -= 1
+                else:
+                    raise rows
+        except BaseException:
+
+            # stop the fetching threads and unblock the ones waiting to
+            # put rows on the queue so the pool can shut down
+
+            stop.set()
+            while not result.ready():
+                try:
+                    chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            raise
+        finally:
+            pool.join()
+
+
+# MySQL column types that are stored with integer and real affinity when an
+# Ensembl table dump is loaded into SQLite
+
+DUMP_INTEGER_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'bigint')
+DUMP_REAL_TYPES = ('float', 'double', 'decimal')
+
+DUMP_ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t',
+                'Z': '\x1a'}
+
+# a field of a table dump: anything up to the next tab that is not escaped
+
+DUMP_FIELD = re.compile(r'(?:[^\\\t]|\\.)*', re.S)
+
+
+def _read_dump_schema(filename):
+    """
+    Read the CREATE TABLE statements of an Ensembl database's schema dump
+    (<database>.sql.gz) into a dict of table name to the SQLite statements
+    creating the table and its indexes
+    """
+
+    schema = {}
+    table = None
+
+    with gzip.open(filename, 'rt') as fin:
+        for line in fin:
+            line = line.strip()
+
+            match = re.match(r'CREATE TABLE `(\w+)`', line)
+            if match:
+                table = match.group(1)
+                columns = []
+                primary_key = None
+                indexes = []
+                continue
+
+            if table is None:
+                continue
+
+            if line.startswith(')'):
+                sqlite3_command = 'CREATE TABLE ' + table + ' (' + \
+                    ','.join(columns)
+                if primary_key is not None:
+                    sqlite3_command += ',PRIMARY KEY (' + primary_key + ')'
+                sqlite3_command += ');'
+
+                schema[table] = [sqlite3_command] + [
+                    'CREATE INDEX ' + table + '_' + name + ' ON ' + table +
+                    ' (' + index_columns + ');'
+                    for name, index_columns in indexes
+                ]
+                table = None
+                continue
+
+            match = re.match(r'`(\w+)` (\w+)', line)
+            if match:
+                column, column_type = match.groups()
+                if column_type.lower() in DUMP_INTEGER_TYPES:
+                    column += ' integer'
+                elif column_type.lower() in DUMP_REAL_TYPES:
+                    column += ' real'
+                else:
+                    column += ' text'
+                columns.append(column)
+                continue
+
+            # indexes, dropping MySQL's index prefix lengths
+
+            match = re.match(r'(PRIMARY |UNIQUE )?KEY (`\w+` )?\((.*)\)', line)
+            if match:
+                index_columns = re.sub(r'\(\d+\)', '', match.group(3))
+                index_columns = index_columns.replace('`', '')
+                if match.group(1) == 'PRIMARY ':
+                    primary_key = index_columns
+                else:
+                    indexes.append((
+                        match.group(2).strip(' `'),
+                        index_columns
+                    ))
+
+    return schema
+
+
+def _unescape_dump_field(field):
+    """
+    Undo MySQL's escaping of a field of a table dump
+    """
+
+    if field == '\\N':
+        return None
+
+    if '\\' not in field:
+        return field
+
+    return re.sub(
+        r'\\(.)',
+        lambda i: DUMP_ESCAPES.get(i.group(1), i.group(1)),
+        field,
+        flags=re.S
+    )
+
+
+def _dump_rows(filename):
+    """
+    Yield the rows of an Ensembl table dump (<table>.txt.gz), the output of
+    MySQL's SELECT ... INTO OUTFILE: tab separated fields in which tabs,
+    newlines and backslashes are escaped with a backslash and NULL is \\N
+    """
+
+    with gzip.open(filename, 'rt') as fin:
+        record = ''
+
+        for line in fin:
+            record += line
+
+            if record.endswith('\n'):
+
+                # a newline escaped by a backslash is part of the field
+
+                backslashes = len(record) - 1 - \
+                    len(record[:-1].rstrip('\\'))
+                if backslashes % 2 == 1:
+                    continue
+
+                record = record[:-1]
+
+            if '\\' not in record:
+                yield [None if i == '\\N' else i for i in record.split('\t')]
+            else:
+                fields = []
+                position = 0
+
+                while True:
+                    field = DUMP_FIELD.match(record, position)
+                    fields.append(_unescape_dump_field(field.group()))
+                    position = field.end() + 1
+                    if position > len(record):
+                        break
+
+                yield fields
+
+            record = ''
+
+
+def _load_dump(task):
+    """
+    Load an Ensembl table dump into its own SQLite database
+    """
+
+    dump, database, table, sqlite3_commands = task
+
+    sqlite3_db = sqlite3.connect(database)
+    cursor = sqlite3_db.cursor()
+    cursor.execute('PRAGMA synchronous=OFF')
+    cursor.execute('PRAGMA journal_mode=OFF')
+    cursor.execute(sqlite3_commands[0])
+
+    sqlite3_command = None
+    rows = []
+    n_rows = 0
+
+    for row in _dump_rows(dump):
+        if sqlite3_command is None:
+            sqlite3_command = 'INSERT INTO ' + table + ' VALUES (' + \
+                ','.join(['?'] * len(row)) + ')'
+
+        rows.append(row)
+
+        if len(rows) == BUILD_CHUNK_SIZE:
+            cursor.executemany(sqlite3_command, rows)
+            n_rows += len(rows)
+            rows = []
+
+    if rows:
+        cursor.executemany(sqlite3_command, rows)
+        n_rows += len(rows)
+
+    sqlite3_db.commit()
+    sqlite3_db.close()
+
+    return table, n_rows
+
+
+class AGFusionDumpDBBManager(AGFusionDBBManager):
+    """
+    Builds the database from the table dumps of an Ensembl core database
+    (the <table>.txt.gz files and the <database>.sql.gz schema in
+    pub/release-<release>/mysql/<database> of the Ensembl FTP site) rather
+    than from the Ensembl MySQL server. The dumps are parsed in parallel
+    into a temporary SQLite copy of the Ensembl tables that the builder's
+    queries then run on.
+
+    dump_dir: directory holding the dumps
+    processes: number of processes parsing the dumps
+    """
+
+    def __init__(self, db_dir, species, release, pfam, dump_dir,
+                 processes=1, **kwargs):
+
+        self.dump_dir = dump_dir
+        self.processes = processes
+        self.ensembl_database = None
+        self._dumps_lock = threading.Lock()
+
+        AGFusionDBBManager.__init__(
+            self,
+            db_dir,
+            species,
+            release,
+            pfam,
+            None,
+            **kwargs
+        )
+
+    def _load_dumps(self):
+        """
+        Parse the dumps of the Ensembl tables AGFusion needs into a
+        temporary SQLite database, each table in its own process. The
+        temporary directory is removed if parsing fails.
+        """
+
+        schema = _read_dump_schema(
+            join(self.dump_dir, self.table + '.sql.gz')
+        )
+        tables = [i for i in ENSEMBL_DUMP_TABLES if i in schema]
+
+        directory = tempfile.mkdtemp(
+            prefix=self.table + '.',
+            dir=dirname(self.database)
+        )
+        database = join(directory, self.table + '.db')
+
+        self.logger.info(
+            'Parsing {} Ensembl table dumps from {} with {} processes...'
+            .format(len(tables), self.dump_dir, self.processes)
+        )
+
+        tasks = [
+            (
+                join(self.dump_dir, table + '.txt.gz'),
+                join(directory, table + '.db'),
+                table,
+                schema[table]
+            ) for table in tables
+        ]
+
+        try:
+            pool = Pool(processes=self.processes)
+
+            try:
+                for table, n_rows in pool.imap_unordered(_load_dump, tasks):
+                    self.logger.info(
+                        'Parsed {} rows of the {} table.'
+                        .format(n_rows, table)
+                    )
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+            # gather the tables into one database
+
+            sqlite3_db = sqlite3.connect(database)
+            cursor = sqlite3_db.cursor()
+
+            for table in tables:
+                cursor.execute(schema[table][0])
+                cursor.execute(
+                    'ATTACH DATABASE ? AS dump',
+                    [join(directory, table + '.db')]
+                )
+                cursor.execute(
+                    'INSERT INTO main.' + table +
+                    ' SELECT * FROM dump.' + table
+                )
+                sqlite3_db.commit()
+                cursor.execute('DETACH DATABASE dump')
+
+                for sqlite3_command in schema[table][1:]:
+                    cursor.execute(sqlite3_command)
+                sqlite3_db.commit()
+
+                os.remove(join(directory, table + '.db'))
+
+            cursor.execute('ANALYZE')
+            sqlite3_db.commit()
+            sqlite3_db.close()
+        except BaseException:
+            shutil.rmtree(directory)
+            raise
+
+        return database
+
+    def _connect_ensembl(self):
+        """
+        Connect the current thread to the SQLite copy of the Ensembl
+        tables. The dumps are only parsed once a query needs them (see
+        _stream_ensembl), so an incremental build whose tables are all
+        complete never parses them.
+        """
+
+        if self.ensembl_database is None:
+            return
+
+        self._ensembl.db = sqlite3.connect(self.ensembl_database)
+        self._ensembl.cursor = self._ensembl.db.cursor()
+
+        self.logger.info(
+            'Connected to the Ensembl tables in ' + self.ensembl_database
+        )
+
+    def _stream_ensembl(self, mysql_command, on_retry=None):
+        """
+        Run a query on the SQLite copy of the Ensembl tables and yield its
+        rows in chunks of BUILD_CHUNK_SIZE, parsing the dumps the first time
+        """
+
+        with self._dumps_lock:
+            if self.ensembl_database is None:
+                self.ensembl_database = self._load_dumps()
+
+        self.logger.info('SQLite - ' + mysql_command)
+
+        cursor = self.ensembl_db.cursor()
+
+        try:
+            cursor.execute(mysql_command)
+
+            rows = cursor.fetchmany(BUILD_CHUNK_SIZE)
+            while rows:
+                yield rows
+                rows = cursor.fetchmany(BUILD_CHUNK_SIZE)
+        finally:
+            cursor.close()
+
+    def close(self):
+        """
+        Close the current thread's connection to the SQLite copy of the
+        Ensembl tables and remove the copy
+        """
+
+        AGFusionDBBManager.close(self)
+
+        if self.ensembl_database is not None:
+            shutil.rmtree(dirname(self.ensembl_database))
+            self.ensembl_database = None
+
+    def finish(self):
+        """
+        Finish the build and remove the SQLite copy of the Ensembl tables
+        """
+
+        AGFusionDBBManager.finish(self)
+        self.close()
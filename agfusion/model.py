@@ -1,200 +1,370 @@
+import bisect
 import itertools
+import json
 import os
 import re
 import sys
+import weakref
+from collections import OrderedDict
 
 from agfusion import utils, exceptions, plot
-import pandas
 from Bio import Seq, SeqIO, SeqRecord, SeqUtils
 
-# matplotlib.rcParams['interactive'] = False
+from agfusion.utils import STANDARD_CHROMOSOMES, MIN_DOMAIN_LENGTH, \
+    ANNOTATION_SUFFIX
 
-from agfusion.utils import STANDARD_CHROMOSOMES, MIN_DOMAIN_LENGTH
-
-class _Gene():
+class EnsemblIndex():
     """
-    Stores the necessary information to specify the architecture of either
-    wild-type genes or fusion gene.
+    Frozensets of the gene names, gene IDs and transcript IDs of an Ensembl
+    release, so that identifiers can be checked with a hash lookup instead
+    of scanning pyensembl's lists. Each set is built the first time it is
+    needed. Use EnsemblIndex.get to share one index per pyensembl data.
     """
 
-    def __init__(self, genes=None, junction=0, pyensembl_data=None,
-                 genome='', gene5prime=False, db=None, noncanonical=False):
+    _indexes = weakref.WeakKeyDictionary()
+
+    def __init__(self, pyensembl_data=None):
+        """
+        pyensembl_data : None
         """
-        genes : str or list
-            Provide one gene (str) or list of genes (list). In the case of a
-            list of genes, it will seach each gene until it finds a hit.
 
-        junction : int
+        self._pyensembl_data = weakref.ref(pyensembl_data)
+        self._gene_names = None
+        self._gene_ids = None
+        self._transcript_ids = None
 
-        pyensembl_data : None
+    @classmethod
+    def get(cls, pyensembl_data):
+        """
+        The index shared by everything using pyensembl_data
+        """
 
-        genome : str
+        index = cls._indexes.get(pyensembl_data)
 
-        gene5prime : bool
+        if index is None:
+            index = cls(pyensembl_data)
+            cls._indexes[pyensembl_data] = index
 
-        db : None
+        return index
 
-        noncanonical : bool
-        """
+    @property
+    def gene_names(self):
+        if self._gene_names is None:
+            self._gene_names = frozenset(self._pyensembl_data().gene_names())
+        return self._gene_names
 
-        if type(genes)==str:
-            genes = [genes]
-        elif type(genes)!=list:
-            db.logger.error(
-                'parameter \'gene\' to _Gene is not string or list: {}'
-                .format(genes)
-            )
-            exit()
-        if type(junction)!=int:
-            db.logger.error(
-                'parameter \'junction\' to _Gene is not int: {}'
-                .format(junction)
+    @property
+    def gene_ids(self):
+        if self._gene_ids is None:
+            self._gene_ids = frozenset(self._pyensembl_data().gene_ids())
+        return self._gene_ids
+
+    @property
+    def transcript_ids(self):
+        if self._transcript_ids is None:
+            self._transcript_ids = frozenset(
+                self._pyensembl_data().transcript_ids()
             )
-            exit()
+        return self._transcript_ids
 
-        self.gene_found = False
-        self.provided_transcript = False # indicates user if user provided transcript
+class GeneResolver():
+    """
+    Resolves gene identifiers (RefSeq, Entrez and Ensembl IDs or gene
+    symbols) to an Ensembl gene and the transcripts to process. Every
+    resolution is remembered, so genes recurring across the fusions of a
+    batch are only looked up once. Use GeneResolver.get to share one
+    resolver per AGFusion database and pyensembl data.
+    """
 
-        self.domains = []
-        self.transcripts = {} # stores transcripts and their DB keys
-        self.gene = None
+    def __init__(self, db=None, pyensembl_data=None, genome=''):
+        """
+        db : None
+
+        pyensembl_data : None
+
+        genome : str
+        """
+
+        self.db = db
         self.pyensembl_data = pyensembl_data
         self.genome = genome
-        self.gene5prime = gene5prime
-        self.db = db
-        self.noncanonical = noncanonical
+        self.ensembl_index = EnsemblIndex.get(pyensembl_data)
 
-        # find the appropriate Ensembl gene ID
+        self._resolutions = {}
+        self._gene_rows = {}
+        self._canonical_transcripts = {}
+        self._transcripts = {}
 
-        for gene in genes:
+        # database entries fetched in bulk by resolve_all
 
-            if re.findall('^NM_',gene) or re.findall('^NR_',gene):
-                self._search_by_refseq(gene)
-            if gene.isdigit() and not self.gene_found:
-                self._search_as_entrez(gene)
-            if re.findall('(^ENS.*G)', gene.upper()) and not self.gene_found:
-                self._search_as_ensembl_id(gene)
-            if re.findall('(^ENS.*T)', gene.upper()) and not self.gene_found:
-                self._search_as_ensembl_transcript_id(gene)
+        self._refseq_rows = {}
+        self._entrez_rows = {}
+        self._transcript_rows = {}
 
-            if not self.gene_found:
+    @staticmethod
+    def get(db, pyensembl_data, genome=''):
+        """
+        The resolver shared by everything resolving genes against db and
+        pyensembl_data
+        """
 
-                # else check if it is a gene symbol
+        key = (id(pyensembl_data), genome)
+        resolver = db.gene_resolvers.get(key)
 
-                self._search_by_symbol(gene)
+        if resolver is None or resolver.pyensembl_data is not pyensembl_data:
+            resolver = GeneResolver(db, pyensembl_data, genome)
+            db.gene_resolvers[key] = resolver
 
-                if not self.gene_found:
-                    gene = gene.capitalize()
-                    self._search_by_symbol(gene)
+        return resolver
 
-                if not self.gene_found:
-                    gene = gene.upper()
-                    self._search_by_symbol(gene)
+    def resolve(self, genes):
+        """
+        Find the Ensembl gene of the first identifier in genes that can be
+        identified. Returns the gene, whether a transcript was provided
+        instead of a gene and the transcripts found while searching.
+        """
+
+        key = tuple(genes)
 
-            if self.gene_found:
-                break
+        if key not in self._resolutions:
+            try:
+                self._resolutions[key] = self._search(genes)
+            except exceptions.TooManyGenesException as e:
+                self._resolutions[key] = e
 
-        # if gene has not been identified yet
+        resolution = self._resolutions[key]
 
-        if not self.gene_found:
+        if resolution is None:
             raise exceptions.GeneIDException(','.join(genes))
+        elif isinstance(resolution, Exception):
+            resolution.__traceback__ = None
+            raise resolution
 
-        # else continue with processing
+        gene, provided_transcript, transcripts = resolution
 
-        self.junction = junction
+        return gene, provided_transcript, dict(transcripts)
 
-        if not self.gene.contains(self.gene.contig,self.junction,self.junction):
-            raise exceptions.JunctionException(self.gene.name, self.junction)
+    def resolve_all(self, identifiers):
+        """
+        Resolve many gene identifiers at once, fetching their database
+        entries with one query per type of identifier, so that later calls
+        to resolve are answered from memory. Returns a dictionary mapping
+        the identifiers that cannot be resolved, or are ambiguous, to the
+        reason why.
+        """
 
-        # fetch the entrez gene id and canonical transcript id
+        identifiers = list(OrderedDict.fromkeys(identifiers))
+        pending = [i for i in identifiers if (i,) not in self._resolutions]
+        errors = OrderedDict()
+
+        self._refseq_rows.update(self.db.refseqs_by_ids(
+            [i for i in pending
+             if re.findall('^NM_',i) or re.findall('^NR_',i)]
+        ))
+        self._entrez_rows.update(self.db.genes_by_entrez_ids(
+            [i for i in pending if i.isdigit()]
+        ))
+        self._transcript_rows.update(
+            (key, value[0] if value else None)
+            for key, value in self.db.transcripts_by_stable_ids(
+                [i for i in pending if re.findall('(^ENS.*T)', i.upper())]
+            ).items()
+        )
 
-        sqlite3_command = "SELECT * FROM " + self.db.build + " WHERE stable_id==\"" + self.gene.gene_id + "\""
-        self.db.logger.debug('SQLite - ' + sqlite3_command)
-        self.db.sqlite3_cursor.execute(
-            sqlite3_command
+        genes = OrderedDict()
+
+        for identifier in identifiers:
+            if len(self._refseq_rows.get(identifier, [])) > 1:
+                errors[identifier] = 'Found too many RefSeq entries for ' \
+                    '{}!'.format(identifier)
+                continue
+            elif len(self._entrez_rows.get(identifier, [])) > 1:
+                errors[identifier] = 'Found too many Entrez gene ID ' \
+                    'entries for {}!'.format(identifier)
+                continue
+
+            try:
+                genes[identifier] = self.resolve([identifier])[0]
+            except (exceptions.GeneIDException,
+                    exceptions.TooManyGenesException) as e:
+                errors[identifier] = str(e)
+
+        # the database entries of the genes and their canonical transcripts
+
+        gene_rows = self.db.genes_by_stable_ids(
+            [i.gene_id for i in genes.values()
+             if i.gene_id not in self._gene_rows]
         )
-        tmp = self.db.sqlite3_cursor.fetchall()
 
-        self.gene_id = tmp[0][0]
-        self.entrez_id = tmp[0][2]
-        self.canonical_transcript_id = tmp[0][4]
+        for gene_id, rows in gene_rows.items():
+            self._gene_rows[gene_id] = rows[0] if rows else None
 
-        # get the transcripts that will be processed and annotated
+        canonical_transcripts = self.db.transcripts_by_ids(
+            [self._gene_rows[i.gene_id].canonical_transcript_id
+             for i in genes.values()
+             if self._gene_rows[i.gene_id] is not None and
+             self._gene_rows[i.gene_id].gene_id
+             not in self._canonical_transcripts]
+        )
 
-        if not noncanonical and not self.provided_transcript:
+        for identifier, gene in genes.items():
+            gene_row = self._gene_rows[gene.gene_id]
 
-            # if only want the canonical and did not specify a certain transcript
+            if gene_row is None:
+                errors[identifier] = str(
+                    exceptions.GeneIDException(gene.gene_id)
+                )
+                continue
 
-            sqlite3_command = "SELECT * FROM " + self.db.build + "_transcript WHERE transcript_id==\"" + self.canonical_transcript_id + "\""
-            self.db.logger.debug('SQLite - ' + sqlite3_command)
-            self.db.sqlite3_cursor.execute(
-                sqlite3_command
+            transcripts = canonical_transcripts.get(
+                gene_row.canonical_transcript_id
             )
-            tmp = db.sqlite3_cursor.fetchall()
-            self.transcripts[tmp[0][2]] = tmp[0][0]
-        elif not noncanonical and self.provided_transcript:
-            pass
-        else:
-            if self.provided_transcript and noncanonical:
-                self.db.logger.warn("You provided a transcript ID as well as specified --noncanonical flag. Will process all the gene's transcripts.")
 
-            # fetch transcript ids
+            if transcripts:
+                self._canonical_transcripts[gene_row.gene_id] = {
+                    transcripts[0].transcript_stable_id:
+                        transcripts[0].transcript_id
+                }
 
-            sqlite3_command = "SELECT * FROM " + self.db.build + "_transcript WHERE gene_id==\"" + self.gene_id + "\""
-            self.db.logger.debug('SQLite - ' + sqlite3_command)
-            self.db.sqlite3_cursor.execute(
-                sqlite3_command
+        return errors
+
+    def gene_row(self, gene):
+        """
+        The AGFusion database entry of an Ensembl gene
+        """
+
+        if gene.gene_id not in self._gene_rows:
+            self._gene_rows[gene.gene_id] = \
+                self.db.gene_by_stable_id(gene.gene_id)
+
+        gene_row = self._gene_rows[gene.gene_id]
+
+        if gene_row is None:
+            raise exceptions.GeneIDException(gene.gene_id)
+
+        return gene_row
+
+    def canonical_transcripts(self, gene_row):
+        """
+        The canonical transcript of a gene, mapped from its Ensembl ID to
+        its database key
+        """
+
+        if gene_row.gene_id not in self._canonical_transcripts:
+            transcript = self.db.transcript_by_id(
+                gene_row.canonical_transcript_id
             )
-            tmp = self.db.sqlite3_cursor.fetchall()
+            self._canonical_transcripts[gene_row.gene_id] = {
+                transcript.transcript_stable_id: transcript.transcript_id
+            }
+
+        return dict(self._canonical_transcripts[gene_row.gene_id])
 
-            for transcript in tmp:
-                self.transcripts[transcript[2]] = transcript[0]
+    def transcripts(self, gene_row):
+        """
+        All transcripts of a gene, mapped from their Ensembl IDs to their
+        database keys
+        """
+
+        if gene_row.gene_id not in self._transcripts:
+            self._transcripts[gene_row.gene_id] = {}
+            for transcript in self.db.transcripts_by_gene_id(gene_row.gene_id):
+                self._transcripts[gene_row.gene_id][
+                    transcript.transcript_stable_id
+                ] = transcript.transcript_id
+
+        return dict(self._transcripts[gene_row.gene_id])
+
+    def _search(self, genes):
+        """
+        Search for each identifier in genes until one is found. Returns
+        None if none are found.
+        """
+
+        transcripts = {}
+
+        for gene in genes:
+
+            found = None
 
-    def _search_as_ensembl_transcript_id(self,gene):
+            if re.findall('^NM_',gene) or re.findall('^NR_',gene):
+                found = self._search_by_refseq(gene, transcripts)
+            if gene.isdigit() and found is None:
+                found = self._search_as_entrez(gene)
+            if re.findall('(^ENS.*G)', gene.upper()) and found is None:
+                found = self._search_as_ensembl_id(gene)
+            if re.findall('(^ENS.*T)', gene.upper()) and found is None:
+                found = self._search_as_ensembl_transcript_id(
+                    gene,
+                    transcripts
+                )
+
+            if found is None:
+
+                # else check if it is a gene symbol
+
+                found = self._search_by_symbol(gene)
+
+                if found is None:
+                    gene = gene.capitalize()
+                    found = self._search_by_symbol(gene)
+
+                if found is None:
+                    gene = gene.upper()
+                    found = self._search_by_symbol(gene)
+
+            if found is not None:
+                return found[0], found[1], transcripts
+
+        return None
+
+    def _search_as_ensembl_transcript_id(self, gene, transcripts):
         # if it is ensembl transcript id
 
-        if gene in self.pyensembl_data.transcript_ids():
+        found = None
+
+        if gene in self.ensembl_index.transcript_ids:
             transcript = self.pyensembl_data.transcript_by_id(gene.upper())
-            self.gene = transcript.gene
+            found = (transcript.gene, True)
 
-            self.db.logger.debug('Found Ensembl transcript entry for %s: %s' % (gene,self.gene.id))
-            self.gene_found = True
-            self.provided_transcript = True
+            self.db.logger.debug('Found Ensembl transcript entry for %s: %s' % (gene,transcript.gene.id))
         else:
             self.db.logger.debug('Found no Ensembl transcript entry for %s' % gene)
 
-        sqlite3_command = "SELECT * FROM " + self.db.build + "_transcript WHERE transcript_stable_id==\"" + gene + "\""
-        self.db.logger.debug('SQLite - ' + sqlite3_command)
-        self.db.sqlite3_cursor.execute(
-            sqlite3_command
-        )
-        tmp = self.db.sqlite3_cursor.fetchall()
-        self.transcripts[tmp[0][2]] = tmp[0][0]
+        if gene in self._transcript_rows:
+            transcript = self._transcript_rows[gene]
+        else:
+            transcript = self.db.transcript_by_stable_id(gene)
+        if transcript is not None:
+            transcripts[transcript.transcript_stable_id] = \
+                transcript.transcript_id
 
-    def _search_as_ensembl_id(self,gene):
+        return found
+
+    def _search_as_ensembl_id(self, gene):
         # if it is ensembl gene id
 
-        if gene in self.pyensembl_data.gene_ids():
-            self.gene = self.pyensembl_data.gene_by_id(gene.upper())
-            self.db.logger.debug('Found Enrez gene ID entry for %s: %s' % (gene,self.gene.id))
-            self.gene_found = True
+        if gene in self.ensembl_index.gene_ids:
+            ensembl_gene = self.pyensembl_data.gene_by_id(gene.upper())
+            self.db.logger.debug('Found Enrez gene ID entry for %s: %s' % (gene,ensembl_gene.id))
+            return ensembl_gene, False
         else:
             self.db.logger.debug('Cannot find Ensembl gene id %s in database!' % gene)
 
-    def _search_as_entrez(self,gene):
+        return None
+
+    def _search_as_entrez(self, gene):
         # if it is an entrez gene ID
 
-        sqlite3_command = "SELECT * FROM " + self.db.build + " WHERE entrez_id==\"" + gene + "\""
-        self.db.logger.debug('SQLite - ' + sqlite3_command)
-        self.db.sqlite3_cursor.execute(
-            sqlite3_command
-        )
-        tmp = self.db.sqlite3_cursor.fetchall()
+        if gene in self._entrez_rows:
+            tmp = self._entrez_rows[gene]
+        else:
+            tmp = self.db.genes_by_entrez_id(gene)
 
         if len(tmp)==1:
-            self.gene = self.pyensembl_data.gene_by_id(tmp[0][1])
-            self.db.logger.debug('Found Entrez gene ID entry for %s: %s' % (gene,self.gene.id))
-            self.gene_found = True
+            ensembl_gene = self.pyensembl_data.gene_by_id(tmp[0].stable_id)
+            self.db.logger.debug('Found Entrez gene ID entry for %s: %s' % (gene,ensembl_gene.id))
+            return ensembl_gene, False
         elif len(tmp)>1:
 
             self.db.logger.error('Found too many Entrez gene ID entries for %s!' % gene)
@@ -204,28 +374,28 @@ class _Gene():
         else:
             self.db.logger.debug('Found no Entrez gene ID entry for %s' % gene)
 
-    def _search_by_refseq(self,gene):
+        return None
+
+    def _search_by_refseq(self, gene, transcripts):
 
 
         # if it is RefSeq ID
 
-        sqlite3_command = "SELECT * FROM " + self.db.build + "_refseq WHERE refseq_id==\"" + gene + "\""
-        self.db.logger.debug('SQLite - ' + sqlite3_command)
-        self.db.sqlite3_cursor.execute(
-            sqlite3_command
-        )
-        tmp = self.db.sqlite3_cursor.fetchall()
+        if gene in self._refseq_rows:
+            tmp = self._refseq_rows[gene]
+        else:
+            tmp = self.db.refseqs_by_id(gene)
 
         if len(tmp)==1:
-            self.transcripts[tmp[0][1]] = tmp[0][0]
+            transcripts[tmp[0].transcript_stable_id] = tmp[0].transcript_id
             self.db.logger.debug('Found RefSeq entry for %s' % gene)
-            self.gene_found = True
-            self.provided_transcript = True
 
             #fetch the gene
 
-            transcript = self.pyensembl_data.transcript_by_id(tmp[0][1])
-            self.gene = transcript.gene
+            transcript = self.pyensembl_data.transcript_by_id(
+                tmp[0].transcript_stable_id
+            )
+            return transcript.gene, True
 
         elif len(tmp)>1:
             self.db.logger.error('Found too many RefSeq entries for %s!' % gene)
@@ -235,8 +405,10 @@ class _Gene():
         else:
             self.db.logger.debug('Found no RefSeq entry for %s' % gene)
 
-    def _search_by_symbol(self,gene):
-        if gene in self.pyensembl_data.gene_names():
+        return None
+
+    def _search_by_symbol(self, gene):
+        if gene in self.ensembl_index.gene_names:
             temp = self.pyensembl_data.genes_by_name(gene)
 
             if len(temp) > 1:
@@ -244,21 +416,118 @@ class _Gene():
                 # if too many ensembl gene IDs returned
                 # use the one located on chromosomes
 
+                ensembl_gene = None
+
                 for tmp_gene in temp:
                     if tmp_gene.contig in STANDARD_CHROMOSOMES:
-                        self.gene = tmp_gene
-                        self.gene_found = True
+                        ensembl_gene = tmp_gene
 
-                if self.gene is None:
+                if ensembl_gene is None:
                     raise exceptions.TooManyGenesException(
                         gene,
                         [x.id for x in temp],
                         self.genome
                     )
+
+                return ensembl_gene, False
             else:
-                self.gene = temp[0]
-                self.gene_found = True
-                self.db.logger.debug('Found gene symbol entry for %s: %s' % (gene,self.gene.id))
+                self.db.logger.debug('Found gene symbol entry for %s: %s' % (gene,temp[0].id))
+                return temp[0], False
+
+        return None
+
+class _Gene():
+    """
+    Stores the necessary information to specify the architecture of either
+    wild-type genes or fusion gene.
+    """
+
+    def __init__(self, genes=None, junction=0, pyensembl_data=None,
+                 genome='', gene5prime=False, db=None, noncanonical=False):
+        """
+        genes : str or list
+            Provide one gene (str) or list of genes (list). In the case of a
+            list of genes, it will seach each gene until it finds a hit.
+
+        junction : int
+
+        pyensembl_data : None
+
+        genome : str
+
+        gene5prime : bool
+
+        db : None
+
+        noncanonical : bool
+        """
+
+        if type(genes)==str:
+            genes = [genes]
+        elif type(genes)!=list:
+            db.logger.error(
+                'parameter \'gene\' to _Gene is not string or list: {}'
+                .format(genes)
+            )
+            exit()
+        if type(junction)!=int:
+            db.logger.error(
+                'parameter \'junction\' to _Gene is not int: {}'
+                .format(junction)
+            )
+            exit()
+
+        self.gene_found = False
+        self.provided_transcript = False # indicates user if user provided transcript
+
+        self.domains = []
+        self.transcripts = {} # stores transcripts and their DB keys
+        self.gene = None
+        self.pyensembl_data = pyensembl_data
+        self.genome = genome
+        self.gene5prime = gene5prime
+        self.db = db
+        self.noncanonical = noncanonical
+
+        # find the appropriate Ensembl gene ID
+
+        resolver = GeneResolver.get(db, pyensembl_data, genome)
+
+        self.gene, self.provided_transcript, self.transcripts = \
+            resolver.resolve(genes)
+        self.gene_found = True
+
+        # continue with processing
+
+        self.junction = junction
+
+        if not self.gene.contains(self.gene.contig,self.junction,self.junction):
+            raise exceptions.JunctionException(self.gene.name, self.junction)
+
+        # fetch the entrez gene id and canonical transcript id
+
+        gene_row = resolver.gene_row(self.gene)
+
+        self.gene_id = gene_row.gene_id
+        self.entrez_id = gene_row.entrez_id
+        self.canonical_transcript_id = gene_row.canonical_transcript_id
+
+        # get the transcripts that will be processed and annotated
+
+        if not noncanonical and not self.provided_transcript:
+
+            # if only want the canonical and did not specify a certain transcript
+
+            self.transcripts.update(resolver.canonical_transcripts(gene_row))
+        elif not noncanonical and self.provided_transcript:
+            pass
+        else:
+            if self.provided_transcript and noncanonical:
+                self.db.logger.warn("You provided a transcript ID as well as specified --noncanonical flag. Will process all the gene's transcripts.")
+
+            # fetch transcript ids
+
+            self.transcripts.update(resolver.transcripts(gene_row))
 
 class Fusion():
     """
@@ -812,6 +1081,253 @@ class Fusion():
         fout.close()
 
 
+    def save_annotation(self, out_dir='.'):
+        """
+        Save what is needed to draw the images of the fusion isoforms to a
+        JSON file, so that the images can be drawn later with SavedFusion
+        """
+
+        def ensembl_transcript(transcript):
+            return {
+                'id': transcript.id,
+                'gene_name': transcript.gene.gene_name,
+                'strand': transcript.strand,
+                'start': transcript.start,
+                'end': transcript.end,
+                'exon_intervals': transcript.exon_intervals,
+                'coding_sequence_length': len(transcript.coding_sequence)
+            }
+
+        transcripts = {}
+
+        for name, transcript in list(self.transcripts.items()):
+
+            if not transcript.has_coding_potential:
+                continue
+
+            transcripts[name] = {
+                'transcript1': ensembl_transcript(transcript.transcript1),
+                'transcript2': ensembl_transcript(transcript.transcript2),
+                'gene5prime_exon_intervals':
+                    transcript.gene5prime_exon_intervals,
+                'gene3prime_exon_intervals':
+                    transcript.gene3prime_exon_intervals,
+                'protein_length': transcript.protein_length,
+                'transcript_protein_junction_5prime':
+                    transcript.transcript_protein_junction_5prime,
+                'domains': transcript.domains
+            }
+
+        annotation = {
+            'name': self.name,
+            'gene5prime': {
+                'gene_name': self.gene5prime.gene.gene_name,
+                'junction': self.gene5prime.junction
+            },
+            'gene3prime': {
+                'gene_name': self.gene3prime.gene.gene_name,
+                'junction': self.gene3prime.junction
+            },
+            'transcripts': transcripts
+        }
+
+        if not os.path.exists(out_dir):
+            os.mkdir(out_dir)
+
+        with open(os.path.join(out_dir, self.name + ANNOTATION_SUFFIX),
+                  'w') as fout:
+            json.dump(annotation, fout)
+
+
+class _Record(object):
+    """
+    Holds the attributes of a gene or transcript read from a saved
+    annotation
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class SavedFusion(Fusion):
+    """
+    A fusion read from the annotation saved by Fusion.save_annotation.
+    Holds only what is needed to draw its images with save_images.
+    """
+
+    def __init__(self, filename=None):
+        """
+        filename : str
+        """
+
+        with open(filename, 'r') as fin:
+            annotation = json.load(fin)
+
+        self.name = annotation['name']
+
+        self.gene5prime = _Record(
+            gene=_Record(gene_name=annotation['gene5prime']['gene_name']),
+            junction=annotation['gene5prime']['junction']
+        )
+        self.gene3prime = _Record(
+            gene=_Record(gene_name=annotation['gene3prime']['gene_name']),
+            junction=annotation['gene3prime']['junction']
+        )
+
+        self.transcripts = {}
+
+        for name, transcript in annotation['transcripts'].items():
+            transcript1 = transcript['transcript1']
+            transcript2 = transcript['transcript2']
+
+            self.transcripts[name] = _Record(
+                transcript1=_Record(
+                    gene=_Record(gene_name=transcript1.pop('gene_name')),
+                    **transcript1
+                ),
+                transcript2=_Record(
+                    gene=_Record(gene_name=transcript2.pop('gene_name')),
+                    **transcript2
+                ),
+                gene5prime=self.gene5prime,
+                gene3prime=self.gene3prime,
+                gene5prime_exon_intervals=
+                    transcript['gene5prime_exon_intervals'],
+                gene3prime_exon_intervals=
+                    transcript['gene3prime_exon_intervals'],
+                protein_length=transcript['protein_length'],
+                transcript_protein_junction_5prime=
+                    transcript['transcript_protein_junction_5prime'],
+                domains=transcript['domains'],
+                has_coding_potential=True
+            )
+
+
+class _Intervals(object):
+    """
+    The (start, end) exon or CDS intervals of a transcript, in the order
+    they are transcribed, with the length of the transcript before each
+    interval. The interval a junction falls in is found with a binary search
+    """
+
+    def __init__(self, intervals=None, strand='+'):
+        """
+        intervals : list of (start, end) tuples
+        strand : '+' or '-'
+        """
+
+        self.intervals = intervals
+        self.offsets = [0]
+
+        for start, end in intervals:
+            self.offsets.append(self.offsets[-1] + end - start + 1)
+
+        self.length = self.offsets[-1]
+
+        # the keys increase along the transcript: the ends of the intervals
+        # on the plus strand and the negated starts on the minus strand
+
+        self._sign = 1 if strand == '+' else -1
+
+        if strand == '+':
+            self._keys = [end for start, end in intervals]
+            ordered = all(
+                i[1] < j[0] for i, j in zip(intervals, intervals[1:])
+            )
+        else:
+            self._keys = [-start for start, end in intervals]
+            ordered = all(
+                i[0] > j[1] for i, j in zip(intervals, intervals[1:])
+            )
+
+        # binary searches need ordered, non-overlapping intervals; anything
+        # else is left to the linear scans
+
+        if not ordered or any(start > end for start, end in intervals):
+            self._keys = None
+
+    def passed(self, junction):
+        """
+        The number of intervals the transcript has passed through in full
+        by the junction, i.e. that end at or before the junction (plus
+        strand) or start at or after it (minus strand)
+        """
+
+        if self._keys is None:
+            return 0
+
+        return bisect.bisect_right(self._keys, self._sign * junction)
+
+    def contains(self, junction):
+        """
+        Whether the junction is within one of the intervals
+        """
+
+        if self._keys is None:
+            return any(
+                start <= junction <= end for start, end in self.intervals
+            )
+
+        n = bisect.bisect_left(self._keys, self._sign * junction)
+
+        return n < len(self.intervals) and \
+            self.intervals[n][0] <= junction <= self.intervals[n][1]
+
+
+class TranscriptCoordinates(object):
+    """
+    The exon and CDS intervals of a transcript with their cumulative lengths,
+    so that a junction can be converted to cDNA and CDS positions without
+    walking every exon. Use TranscriptCoordinates.get to share one table per
+    transcript.
+    """
+
+    _tables = weakref.WeakKeyDictionary()
+
+    def __init__(self, transcript=None):
+        """
+        transcript : pyensembl.Transcript
+        """
+
+        self._transcript = weakref.ref(transcript)
+        self._exons = None
+        self._cds = None
+
+    @classmethod
+    def get(cls, transcript):
+        """
+        The table shared by everything using transcript
+        """
+
+        table = cls._tables.get(transcript)
+
+        if table is None:
+            table = cls(transcript)
+            cls._tables[transcript] = table
+
+        return table
+
+    @property
+    def exons(self):
+        if self._exons is None:
+            transcript = self._transcript()
+            self._exons = _Intervals(
+                transcript.exon_intervals,
+                transcript.strand
+            )
+        return self._exons
+
+    @property
+    def cds(self):
+        if self._cds is None:
+            transcript = self._transcript()
+            self._cds = _Intervals(
+                transcript.coding_sequence_position_ranges,
+                transcript.strand
+            )
+        return self._cds
+
+
 class FusionTranscript(object):
     """
     Generates the information needed for the gene fusion transctips
@@ -885,38 +1401,33 @@ class FusionTranscript(object):
 
         # fetch the translation ids
 
-        sqlite3_command = "SELECT * FROM " + self.db.build + "_transcript WHERE transcript_stable_id==\"" + self.transcript1.id + "\""
-        self.db.logger.debug('SQLite - ' + sqlite3_command)
-        self.db.sqlite3_cursor.execute(
-            sqlite3_command
+        gene5prime_translation_id = self.db.translation_id_for_transcript(
+            self.transcript1.id
         )
-        gene5prime_translation_id = self.db.sqlite3_cursor.fetchall()[0][3]
-
-        sqlite3_command = "SELECT * FROM " + self.db.build + "_transcript WHERE transcript_stable_id==\"" + self.transcript2.id + "\""
-        self.db.logger.debug('SQLite - ' + sqlite3_command)
-        self.db.sqlite3_cursor.execute(
-            sqlite3_command
+        gene3prime_translation_id = self.db.translation_id_for_transcript(
+            self.transcript2.id
         )
-        gene3prime_translation_id = self.db.sqlite3_cursor.fetchall()[0][3]
 
-        for protein_database in self.protein_databases:
+        # fetch the protein annotation of both proteins from all the
+        # protein databases at once
 
-            # fetch protein annotation
+        protein_features = self.db.fetch_protein_features(
+            [gene5prime_translation_id, gene3prime_translation_id],
+            self.protein_databases
+        )
 
-            sqlite3_command = "SELECT * FROM " + self.db.build + "_" + protein_database + " WHERE translation_id==\"" + gene5prime_translation_id + "\""
-            self.db.logger.debug('SQLite - ' + sqlite3_command)
-            self.db.sqlite3_cursor.execute(
-                sqlite3_command
-            )
-            tmp_domains += [list(x) for x in self.db.sqlite3_cursor.fetchall()]
+        for protein_database in self.protein_databases:
+            tmp_domains += protein_features[
+                (gene5prime_translation_id, protein_database)
+            ]
 
         for d in tmp_domains:
 
-            pfeature_ID = d[2]
-            pfeature_name = d[6]
-            pfeature_description = d[5]
-            pfeature_start = int(d[3])
-            pfeature_end = int(d[4])
+            pfeature_ID = d.hit_id
+            pfeature_name = d.hit_name
+            pfeature_description = d.hit_description
+            pfeature_start = int(d.seq_start)
+            pfeature_end = int(d.seq_end)
 
             gene5prime_domains.append([
                 pfeature_ID,
@@ -960,21 +1471,17 @@ class FusionTranscript(object):
             tmp_domains = []
 
             for database in self.protein_databases:
-
-                sqlite3_command = "SELECT * FROM " + self.db.build + "_" + database + " WHERE translation_id==\"" + gene3prime_translation_id + "\""
-                self.db.logger.debug('SQLite - ' + sqlite3_command)
-                self.db.sqlite3_cursor.execute(
-                    sqlite3_command
-                )
-                tmp_domains += [list(x) for x in self.db.sqlite3_cursor.fetchall()]
+                tmp_domains += protein_features[
+                    (gene3prime_translation_id, database)
+                ]
 
             for d in tmp_domains:
 
-                pfeature_ID = d[2]
-                pfeature_name = d[6]
-                pfeature_description = d[5]
-                pfeature_start = int(d[3])
-                pfeature_end = int(d[4])
+                pfeature_ID = d.hit_id
+                pfeature_name = d.hit_name
+                pfeature_description = d.hit_description
+                pfeature_start = int(d.seq_start)
+                pfeature_end = int(d.seq_end)
 
                 gene3prime_domains.append([
                     pfeature_ID,
@@ -1088,13 +1595,20 @@ class FusionTranscript(object):
         Predict the potential nucleotide sequence
         """
 
-        self.transcript_cds_junction_5prime = 0
-        self.transcript_cds_junction_3prime = 0
+        # skip the CDS regions the junctions are past in full, the
+        # coordinate tables give their total length
+
+        cds_5prime = TranscriptCoordinates.get(self.transcript1).cds
+        cds_3prime = TranscriptCoordinates.get(self.transcript2).cds
+
+        n = cds_5prime.passed(self.gene5prime.junction)
+        self.transcript_cds_junction_5prime = cds_5prime.offsets[n]
+        ranges = cds_5prime.intervals[n:]
 
         #5prime transcript
 
         if self.transcript1.strand=="+":
-            for cds in self.transcript1.coding_sequence_position_ranges:
+            for cds in ranges:
                 if self.gene5prime.junction >= cds[1]:
                     self.transcript_cds_junction_5prime += (cds[1] - cds[0] + 1)
                 elif self.gene5prime.junction <= cds[0]:
@@ -1103,7 +1617,7 @@ class FusionTranscript(object):
                     self.transcript_cds_junction_5prime += (self.gene5prime.junction - cds[0] + 1)
                     break
         else:
-            for cds in self.transcript1.coding_sequence_position_ranges:
+            for cds in ranges:
                 if self.gene5prime.junction <= cds[0]:
                     self.transcript_cds_junction_5prime += (cds[1] - cds[0] + 1)
                 elif self.gene5prime.junction >= cds[1]:
@@ -1113,8 +1627,12 @@ class FusionTranscript(object):
 
         self.cds_5prime = self.transcript1.coding_sequence[0:self.transcript_cds_junction_5prime]
 
+        n = cds_3prime.passed(self.gene3prime.junction)
+        self.transcript_cds_junction_3prime = cds_3prime.offsets[n]
+        ranges = cds_3prime.intervals[n:]
+
         if self.transcript2.strand=="+":
-            for cds in self.transcript2.coding_sequence_position_ranges:
+            for cds in ranges:
                 if self.gene3prime.junction >= cds[1]:
                     self.transcript_cds_junction_3prime += (cds[1] - cds[0] + 1)
                 elif self.gene3prime.junction <= cds[0]:
@@ -1122,7 +1640,7 @@ class FusionTranscript(object):
                 else:
                     self.transcript_cds_junction_3prime += (self.gene3prime.junction - cds[0])
         else:
-            for cds in self.transcript2.coding_sequence_position_ranges:
+            for cds in ranges:
                 if self.gene3prime.junction <= cds[0]:
                     self.transcript_cds_junction_3prime += (cds[1] - cds[0] + 1)
                 elif self.gene3prime.junction >= cds[1]:
@@ -1155,22 +1673,28 @@ class FusionTranscript(object):
         Predict the potential nucleotide sequence
         """
 
-        self.transcript_cdna_junction_5prime = 0
-        self.transcript_cdna_junction_3prime = 0
+        exons_5prime = TranscriptCoordinates.get(self.transcript1).exons
+        exons_3prime = TranscriptCoordinates.get(self.transcript2).exons
 
         # get the 5prime transcript sequence and determine if junction is
-        # within intron
+        # within intron. The exons the junction is past in full are skipped,
+        # except for the last one, which is checked for the junction being
+        # in the intron after it
 
-        n = 0
+        exons = exons_5prime.intervals
+        n_max = len(exons)
+        n = max(exons_5prime.passed(self.gene5prime.junction) - 1, 0)
 
-        n_max = len(self.transcript1.exon_intervals)
-        exons = self.transcript1.exon_intervals
+        self.transcript_cdna_junction_5prime = exons_5prime.offsets[n]
+        self.gene5prime_exon_intervals.extend(
+            [exon[0], exon[1], i + 1] for i, exon in enumerate(exons[:n])
+        )
 
         if self.transcript1.strand == "+":
 
-            exon_count = 0
+            exon_count = n
 
-            for exon in exons:
+            for exon in exons[n:]:
 
                 exon_count += 1
 
@@ -1207,9 +1731,9 @@ class FusionTranscript(object):
                     break
         else:
 
-            exon_count = 0
+            exon_count = n
 
-            for exon in exons:
+            for exon in exons[n:]:
 
                 exon_count += 1
 
@@ -1260,17 +1784,20 @@ class FusionTranscript(object):
         # get the 3prime transcript sequence and determine if junction is
         # within intron
 
-        n = 0
-        n_max = len(self.transcript2.exon_intervals)
-        exons = self.transcript2.exon_intervals
+        exons = exons_3prime.intervals
+        n_max = len(exons)
+        passed = exons_3prime.passed(self.gene3prime.junction)
+        n = max(passed - 1, 0)
+
+        self.transcript_cdna_junction_3prime = exons_3prime.offsets[n]
 
         if self.transcript2.strand == "+":
 
-            exon_count = 0
+            exon_count = passed
 
             # get the exons in the fusion
 
-            for exon in exons:
+            for exon in exons[passed:]:
                 exon_count += 1
                 if self.gene3prime.junction >= exon[1]:
                     continue
@@ -1287,7 +1814,7 @@ class FusionTranscript(object):
                         exon_count
                     ])
 
-            for exon in exons:
+            for exon in exons[n:]:
 
                 # is in intron?
 
@@ -1311,11 +1838,11 @@ class FusionTranscript(object):
                     self.transcript_cdna_junction_3prime += (self.gene3prime.junction - exon[0])
         else:
 
-            exon_count = 0
+            exon_count = passed
 
             # get the exons in the fusion
 
-            for exon in exons:
+            for exon in exons[passed:]:
                 exon_count += 1
                 if self.gene3prime.junction <= exon[0]:
                     continue
@@ -1332,7 +1859,7 @@ class FusionTranscript(object):
                         exon_count
                     ])
 
-            for exon in exons:
+            for exon in exons[n:]:
 
                 # is in intron?
 
@@ -1400,10 +1927,10 @@ class FusionTranscript(object):
                 self.effect_5prime='5UTR (end)'
 
             if self.transcript1.complete and \
-                    (len(self.transcript1)-self.transcript_cdna_junction_5prime) < len(self.transcript1.three_prime_utr_sequence):
+                    (exons_5prime.length-self.transcript_cdna_junction_5prime) < len(self.transcript1.three_prime_utr_sequence):
                 self.effect_5prime='3UTR'
             elif self.transcript1.complete and \
-                    (len(self.transcript1)-self.transcript_cdna_junction_5prime) == len(self.transcript1.three_prime_utr_sequence):
+                    (exons_5prime.length-self.transcript_cdna_junction_5prime) == len(self.transcript1.three_prime_utr_sequence):
                 self.effect_5prime='3UTR (start)'
 
         #the 3' gene
@@ -1418,10 +1945,10 @@ class FusionTranscript(object):
                 self.effect_3prime='5UTR (end)'
 
             if self.transcript2.complete and \
-                    (len(self.transcript2)-self.transcript_cdna_junction_3prime) < len(self.transcript2.three_prime_utr_sequence):
+                    (exons_3prime.length-self.transcript_cdna_junction_3prime) < len(self.transcript2.three_prime_utr_sequence):
                 self.effect_3prime='3UTR'
             elif self.transcript2.complete and \
-                    (len(self.transcript2)-self.transcript_cdna_junction_3prime) == len(self.transcript2.three_prime_utr_sequence):
+                    (exons_3prime.length-self.transcript_cdna_junction_3prime) == len(self.transcript2.three_prime_utr_sequence):
                 self.effect_3prime='3UTR (start)'
 
         self.effect = self.effect_5prime + '-' + self.effect_3prime
@@ -1480,11 +2007,9 @@ class FusionTranscript(object):
 
                     n += 1
             else:
-                for cds in self.transcript1.coding_sequence_position_ranges:
-
-                    if self.gene5prime.junction >= cds[0] and self.gene5prime.junction <= cds[1]:
-                        self.effect_5prime = 'CDS'
-                        break
+                if TranscriptCoordinates.get(self.transcript1).cds.contains(
+                        self.gene5prime.junction):
+                    self.effect_5prime = 'CDS'
 
                 if self.transcript1.strand == "+":
                     if self.gene5prime.junction==self.transcript1.coding_sequence_position_ranges[0][0]:
@@ -1536,10 +2061,9 @@ class FusionTranscript(object):
                     n += 1
 
             else:
-                for cds in self.transcript2.coding_sequence_position_ranges:
-                    if self.gene3prime.junction >= cds[0] and self.gene3prime.junction <= cds[1]:
-                        self.effect_3prime='CDS'
-                        break
+                if TranscriptCoordinates.get(self.transcript2).cds.contains(
+                        self.gene3prime.junction):
+                    self.effect_3prime='CDS'
 
                 if self.transcript2.strand == "+":
                     if self.gene3prime.junction==self.transcript2.coding_sequence_position_ranges[0][0]:
@@ -8,23 +8,54 @@ import csv
 
 
 class _Parser(object):
-    def __init__(self, logger):
+    """
+    Base class of the parsers. Subclasses implement _parse, a generator
+    yielding each fusion in the input file. By default the whole file is
+    read when the parser is created. With stream=True the fusions are read
+    while the parser is iterated over, so the first fusions can be
+    annotated before the rest of the file is parsed.
+    """
+
+    def __init__(self, infile, logger, stream=False):
+        self.infile = infile
         self.fusions = []
         self.iterator = 0
         self.logger = logger
+        self.stream = stream
+
+        if stream:
+            self._fusions = self._stream()
+        else:
+            self.fusions = list(self._parse())
+            self._check_data(len(self.fusions))
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if self.iterator >= len(self.fusions):
+        if self.stream:
+            fusion = next(self._fusions)
+            self.iterator += 1
+            return fusion
+        elif self.iterator >= len(self.fusions):
             raise StopIteration
         else:
             self.iterator += 1
             return self.fusions[self.iterator-1]
 
-    def _check_data(self):
-        if len(self.fusions) == 0:
+    def _parse(self):
+        return iter([])
+
+    def _stream(self):
+        n_fusions = 0
+        for fusion in self._parse():
+            n_fusions += 1
+            yield fusion
+
+        self._check_data(n_fusions)
+
+    def _check_data(self, n_fusions):
+        if n_fusions == 0:
             #self.logger.error("Read 0 fusions from the file! Exiting...")
             if not os.path.exists("agfusion_results"):
                 os.mkdir("agfusion_results")
@@ -34,16 +65,17 @@ class _Parser(object):
             pass
         else:
             self.logger.info(
-                "Read {} fusions from the file.".format(len(self.fusions))
+                "Read {} fusions from the file.".format(n_fusions)
             )
     next = __next__
 
 
 class STARFusion(_Parser):
-    def __init__(self, infile, logger):
-        super(STARFusion, self).__init__(logger)
+    def __init__(self, infile, logger, stream=False):
+        super(STARFusion, self).__init__(infile, logger, stream)
 
-        with open(infile, 'r') as fin:
+    def _parse(self):
+        with open(self.infile, 'r') as fin:
             reader = csv.DictReader(fin, delimiter="\t")
             if not ('#FusionName' in reader.fieldnames or '#fusion_name' in reader.fieldnames):
                 raise AssertionError(
@@ -72,26 +104,23 @@ class STARFusion(_Parser):
                     gene_3prime = line['RightGene'].split('.')[0]
                     gene_3prime_name = gene_3prime
                 gene_3prime_junction = int(line['RightBreakpoint'].split(':')[1])
-                self.fusions.append(
-                    {
-                        'gene5prime': gene_5prime,
-                        'gene3prime': gene_3prime,
-                        'alternative_name_5prime': gene_5prime_name,
-                        'alternative_name_3prime': gene_3prime_name,
-                        'gene5prime_junction': gene_5prime_junction,
-                        'gene3prime_junction': gene_3prime_junction
-                    }
-                )
-
-        self._check_data()
+                yield {
+                    'gene5prime': gene_5prime,
+                    'gene3prime': gene_3prime,
+                    'alternative_name_5prime': gene_5prime_name,
+                    'alternative_name_3prime': gene_3prime_name,
+                    'gene5prime_junction': gene_5prime_junction,
+                    'gene3prime_junction': gene_3prime_junction
+                }
 
 
 class EricScript(_Parser):
-    def __init__(self, allinfile, logger):
-        super(EricScript, self).__init__(logger)
+    def __init__(self, infile, logger, stream=False):
+        super(EricScript, self).__init__(infile, logger, stream)
 
-        fin = open(infile, 'r')
-        for line in fin.readlines():
+    def _parse(self):
+        fin = open(self.infile, 'r')
+        for line in fin:
             if re.findall('^GeneName1', line):
                 line = line.strip().split('\t')
                 for i, j in zip(
@@ -107,27 +136,24 @@ class EricScript(_Parser):
                 gene_5prime_junction = int(line[3])
                 gene_3prime_name = line[9]
                 gene_3prime_junction = int(line[6])
-                self.fusions.append(
-                    {
-                        'gene5prime': None,
-                        'gene3prime': None,
-                        'alternative_name_5prime': gene_5prime_name,
-                        'alternative_name_3prime': gene_3prime_name,
-                        'gene5prime_junction': gene_5prime_junction,
-                        'gene3prime_junction': gene_3prime_junction
-                    }
-                )
+                yield {
+                    'gene5prime': None,
+                    'gene3prime': None,
+                    'alternative_name_5prime': gene_5prime_name,
+                    'alternative_name_3prime': gene_3prime_name,
+                    'gene5prime_junction': gene_5prime_junction,
+                    'gene3prime_junction': gene_3prime_junction
+                }
         fin.close()
 
-        self._check_data()
-
 
 class FusionCatcher(_Parser):
-    def __init__(self, infile, logger):
-        super(FusionCatcher, self).__init__(logger)
+    def __init__(self, infile, logger, stream=False):
+        super(FusionCatcher, self).__init__(infile, logger, stream)
 
-        fin = open(infile, 'r')
-        for line in fin.readlines():
+    def _parse(self):
+        fin = open(self.infile, 'r')
+        for line in fin:
             if re.findall('^Gene_1_symbol', line):
                 line = line.rstrip().split('\t')
                 assert line[8] == 'Fusion_point_for_gene_1(5end_fusion_partner)', 'Unrecognized FusionCatcher input'
@@ -137,44 +163,39 @@ class FusionCatcher(_Parser):
                 continue
 
             line = line.strip().split('\t')
-            self.fusions.append(
-                {
-                    'gene5prime': line[10],
-                    'gene3prime': line[11],
-                    'alternative_name_5prime': line[0],
-                    'alternative_name_3prime': line[1],
-                    'gene5prime_junction': int(line[8].split(':')[1]),
-                    'gene3prime_junction': int(line[9].split(':')[1])
-                }
-            )
+            yield {
+                'gene5prime': line[10],
+                'gene3prime': line[11],
+                'alternative_name_5prime': line[0],
+                'alternative_name_3prime': line[1],
+                'gene5prime_junction': int(line[8].split(':')[1]),
+                'gene3prime_junction': int(line[9].split(':')[1])
+            }
         fin.close()
 
-        self._check_data()
-
 
 class FusionHunter(_Parser):
-    def __init__(self, infile,logger):
-        super(FusionHunter, self).__init__(logger)
+    def __init__(self, infile, logger, stream=False):
+        super(FusionHunter, self).__init__(infile, logger, stream)
 
+    def _parse(self):
         gene1 = gene2 = None
         gene1_junction = gene2_junction = None
 
-        fin = open(infile, 'r')
-        for line in fin.readlines():
+        fin = open(self.infile, 'r')
+        for line in fin:
 
             if re.findall('^# Fusion:', line):
 
                 if gene1 is not None and gene2 is not None:
-                    self.fusions.append(
-                        {
-                            'gene5prime': None,
-                            'gene3prime': None,
-                            'alternative_name_5prime': gene1,
-                            'alternative_name_3prime': gene2,
-                            'gene5prime_junction': int(gene1_junction),
-                            'gene3prime_junction': int(gene2_junction)
-                        }
-                    )
+                    yield {
+                        'gene5prime': None,
+                        'gene3prime': None,
+                        'alternative_name_5prime': gene1,
+                        'alternative_name_3prime': gene2,
+                        'gene5prime_junction': int(gene1_junction),
+                        'gene3prime_junction': int(gene2_junction)
+                    }
 
                 strands = re.findall("(?<=\[)(.*)(?=\])", line)
                 assert len(strands) == 1, "Unrecognized FusionHunter input. Incorrect strand information."
@@ -184,16 +205,14 @@ class FusionHunter(_Parser):
             elif re.findall('^--', line):
                 # new breakpoint
                 if gene1 is not None and gene2 is not None:
-                    self.fusions.append(
-                        {
-                            'gene5prime': None,
-                            'gene3prime': None,
-                            'alternative_name_5prime': gene1,
-                            'alternative_name_3prime': gene2,
-                            'gene5prime_junction': int(gene1_junction),
-                            'gene3prime_junction': int(gene2_junction)
-                        }
-                    )
+                    yield {
+                        'gene5prime': None,
+                        'gene3prime': None,
+                        'alternative_name_5prime': gene1,
+                        'alternative_name_3prime': gene2,
+                        'gene5prime_junction': int(gene1_junction),
+                        'gene3prime_junction': int(gene2_junction)
+                    }
 
             elif re.findall('^->', line):
                 junctions = re.findall("(chr[0-9]*):([0-9]*)-([0-9]*)", line)
@@ -219,26 +238,23 @@ class FusionHunter(_Parser):
         fin.close()
 
         if gene1 is not None and gene2 is not None:
-            self.fusions.append(
-                {
-                    'gene5prime': None,
-                    'gene3prime': None,
-                    'alternative_name_5prime': gene1,
-                    'alternative_name_3prime': gene2,
-                    'gene5prime_junction': int(gene1_junction),
-                    'gene3prime_junction': int(gene2_junction)
-                }
-            )
-
-        self._check_data()
+            yield {
+                'gene5prime': None,
+                'gene3prime': None,
+                'alternative_name_5prime': gene1,
+                'alternative_name_3prime': gene2,
+                'gene5prime_junction': int(gene1_junction),
+                'gene3prime_junction': int(gene2_junction)
+            }
 
 
 class FusionMap(_Parser):
-    def __init__(self, infile, logger):
-        super(FusionMap, self).__init__(logger)
+    def __init__(self, infile, logger, stream=False):
+        super(FusionMap, self).__init__(infile, logger, stream)
 
-        fin = open(infile, 'r')
-        for line in fin.readlines():
+    def _parse(self):
+        fin = open(self.infile, 'r')
+        for line in fin:
             if re.findall('^FusionID', line):
                 line = line.strip().split('\t')
                 for i, j in zip([6, 8, 9, 13],
@@ -253,27 +269,24 @@ class FusionMap(_Parser):
                 gene_5prime_junction = int(line[6])
                 gene_3prime_name = line[13]
                 gene_3prime_junction = int(line[8])
-                self.fusions.append(
-                    {
-                        'gene5prime': None,
-                        'gene3prime': None,
-                        'alternative_name_5prime': gene_5prime_name,
-                        'alternative_name_3prime': gene_3prime_name,
-                        'gene5prime_junction': gene_5prime_junction,
-                        'gene3prime_junction': gene_3prime_junction
-                    }
-                )
+                yield {
+                    'gene5prime': None,
+                    'gene3prime': None,
+                    'alternative_name_5prime': gene_5prime_name,
+                    'alternative_name_3prime': gene_3prime_name,
+                    'gene5prime_junction': gene_5prime_junction,
+                    'gene3prime_junction': gene_3prime_junction
+                }
         fin.close()
 
-        self._check_data()
-
 
 class MapSplice(_Parser):
-    def __init__(self, infile, logger):
-        super(MapSplice, self).__init__(logger)
+    def __init__(self, infile, logger, stream=False):
+        super(MapSplice, self).__init__(infile, logger, stream)
 
-        fin = open(infile, 'r')
-        for line in fin.readlines():
+    def _parse(self):
+        fin = open(self.infile, 'r')
+        for line in fin:
             if re.findall('^chrom', line):
                 line = line.strip().split('\t')
                 for i, j in zip([1, 2, 60, 61], ['doner_end',
@@ -288,27 +301,24 @@ class MapSplice(_Parser):
                 gene_5prime_junction = int(line[1])
                 gene_3prime_name = line[61]
                 gene_3prime_junction = int(line[2])
-                self.fusions.append(
-                    {
-                        'gene5prime': None,
-                        'gene3prime': None,
-                        'alternative_name_5prime': gene_5prime_name,
-                        'alternative_name_3prime': gene_3prime_name,
-                        'gene5prime_junction': gene_5prime_junction,
-                        'gene3prime_junction': gene_3prime_junction
-                    }
-                )
+                yield {
+                    'gene5prime': None,
+                    'gene3prime': None,
+                    'alternative_name_5prime': gene_5prime_name,
+                    'alternative_name_3prime': gene_3prime_name,
+                    'gene5prime_junction': gene_5prime_junction,
+                    'gene3prime_junction': gene_3prime_junction
+                }
         fin.close()
 
-        self._check_data()
-
 
 class TopHatFusion(_Parser):
-    def __init__(self, infile, logger):
-        super(TopHatFusion, self).__init__(logger)
+    def __init__(self, infile, logger, stream=False):
+        super(TopHatFusion, self).__init__(infile, logger, stream)
 
-        fin = open(infile, 'r')
-        for line in fin.readlines():
+    def _parse(self):
+        fin = open(self.infile, 'r')
+        for line in fin:
             line = line.strip().split('\t')
 
             gene_5prime = line[1]
@@ -317,25 +327,22 @@ class TopHatFusion(_Parser):
             gene_3prime = line[4]
             gene_3prime_name = line[4]
             gene_3prime_junction = int(line[6])
-            self.fusions.append(
-                {
-                    'gene5prime': gene_5prime,
-                    'gene3prime': gene_3prime,
-                    'alternative_name_5prime': gene_5prime_name,
-                    'alternative_name_3prime': gene_3prime_name,
-                    'gene5prime_junction': gene_5prime_junction,
-                    'gene3prime_junction': gene_3prime_junction
-                }
-            )
+            yield {
+                'gene5prime': gene_5prime,
+                'gene3prime': gene_3prime,
+                'alternative_name_5prime': gene_5prime_name,
+                'alternative_name_3prime': gene_3prime_name,
+                'gene5prime_junction': gene_5prime_junction,
+                'gene3prime_junction': gene_3prime_junction
+            }
         fin.close()
 
-        self._check_data()
-
 
 class DeFuse(_Parser):
-    def __init__(self, infile, logger):
-        super(DeFuse, self).__init__(logger)
+    def __init__(self, infile, logger, stream=False):
+        super(DeFuse, self).__init__(infile, logger, stream)
 
+    def _parse(self):
         data_indices = {
             'gene5prime': None,
             'gene3prime': None,
@@ -343,15 +350,15 @@ class DeFuse(_Parser):
             'gene3prime_junction': None
         }
 
-        fin = open(infile, 'r')
-        for line in fin.readlines():
+        fin = open(self.infile, 'r')
+        for line in fin:
             if re.findall('^cluster_id', line):
                 line = line.strip().split('\t')
                 for column in data_indices.keys():
                     try:
                         data_indices[column] = line.index(column)
                     except ValueError:
-                        logger.error(
+                        self.logger.error(
                             "Unrecognized {} input! Cannot find {} column."
                             .format(
                                 self.__class__.__name__,
@@ -362,25 +369,22 @@ class DeFuse(_Parser):
                 continue
             if not any([i is None for i in data_indices.keys()]):
                 line = line.strip().split('\t')
-                self.fusions.append(
-                    {
-                        'gene5prime': line[data_indices['gene5prime']],
-                        'gene3prime': line[data_indices['gene3prime']],
-                        'gene5prime_junction': int(line[
-                            data_indices['gene5prime_junction']]),
-                        'gene3prime_junction': int(line[data_indices[
-                            'gene3prime_junction']])
-                    }
-                )
+                yield {
+                    'gene5prime': line[data_indices['gene5prime']],
+                    'gene3prime': line[data_indices['gene3prime']],
+                    'gene5prime_junction': int(line[
+                        data_indices['gene5prime_junction']]),
+                    'gene3prime_junction': int(line[data_indices[
+                        'gene3prime_junction']])
+                }
         fin.close()
 
-        self._check_data()
-
 
 class Chimerascan(_Parser):
-    def __init__(self, infile, logger):
-        super(Chimerascan, self).__init__(logger)
+    def __init__(self, infile, logger, stream=False):
+        super(Chimerascan, self).__init__(infile, logger, stream)
 
+    def _parse(self):
         data_indices = {
             'genes5p': 12,
             'genes3p': 13,
@@ -392,15 +396,15 @@ class Chimerascan(_Parser):
             'strand3p': 9
         }
 
-        fin = open(infile, 'r')
-        for line in fin.readlines():
+        fin = open(self.infile, 'r')
+        for line in fin:
             if re.findall('#chrom5p', line):
                 line = line.strip().split('\t')
                 for column in data_indices.keys():
                     try:
                         data_indices[column] = line.index(column)
                     except ValueError:
-                        logger.error(
+                        self.logger.error(
                             "Unrecognized {} input! Cannot find {} column."
                             .format(
                                 self.__class__.__name__,
@@ -422,23 +426,20 @@ class Chimerascan(_Parser):
             else:
                 gene2_junction = line[data_indices['end3p']]
 
-            self.fusions.append(
-                {
-                    'gene5prime': line[data_indices['genes5p']].split(','),
-                    'gene3prime': line[data_indices['genes3p']].split(','),
-                    'gene5prime_junction': int(gene1_junction),
-                    'gene3prime_junction': int(gene2_junction)
-                }
-            )
+            yield {
+                'gene5prime': line[data_indices['genes5p']].split(','),
+                'gene3prime': line[data_indices['genes3p']].split(','),
+                'gene5prime_junction': int(gene1_junction),
+                'gene3prime_junction': int(gene2_junction)
+            }
         fin.close()
 
-        self._check_data()
-
 
 class ChimeRScope(_Parser):
-    def __init__(self, infile, logger):
-        super(ChimeRScope, self).__init__(logger)
+    def __init__(self, infile, logger, stream=False):
+        super(ChimeRScope, self).__init__(infile, logger, stream)
 
+    def _parse(self):
         data_indices = {
             'Gene1': 2,
             'Gene2': 4,
@@ -446,15 +447,15 @@ class ChimeRScope(_Parser):
             'Gene2_fusionPoint': 9
         }
 
-        fin = open(infile, 'r')
-        for line in fin.readlines():
+        fin = open(self.infile, 'r')
+        for line in fin:
             if re.findall('^ConfidentScore', line):
                 line = line.strip().split('\t')
                 for column in data_indices.keys():
                     try:
                         data_indices[column] = line.index(column)
                     except ValueError:
-                        logger.error(
+                        self.logger.error(
                             "Unrecognized {} input! Cannot find {} column."
                             .format(
                                 self.__class__.__name__,
@@ -465,40 +466,37 @@ class ChimeRScope(_Parser):
                 continue
 
             line = line.strip().split('\t')
-            self.fusions.append(
-                {
-                    'gene5prime': line[data_indices['Gene1']],
-                    'gene3prime': line[data_indices['Gene2']],
-                    'gene5prime_junction': line[
-                        data_indices['Gene1_fusionPoint']],
-                    'gene3prime_junction': line[
-                        data_indices['Gene2_fusionPoint']]
-                }
-            )
+            yield {
+                'gene5prime': line[data_indices['Gene1']],
+                'gene3prime': line[data_indices['Gene2']],
+                'gene5prime_junction': line[
+                    data_indices['Gene1_fusionPoint']],
+                'gene3prime_junction': line[
+                    data_indices['Gene2_fusionPoint']]
+            }
         fin.close()
 
-        self._check_data()
-
 
 class JAFFA(_Parser):
-    def __init__(self, infile, logger):
-        super(JAFFA, self).__init__(logger)
+    def __init__(self, infile, logger, stream=False):
+        super(JAFFA, self).__init__(infile, logger, stream)
 
+    def _parse(self):
         data_indices = {
             'base1': 7,
             'base2': 9,
             'fusion genes': 1
         }
 
-        fin = open(infile, 'r')
-        for line in fin.readlines():
+        fin = open(self.infile, 'r')
+        for line in fin:
             if re.findall('sample', line):
                 line = line.strip().replace('"', '').split(',')
                 for column in data_indices.keys():
                     try:
                         data_indices[column] = line.index(column)
                     except ValueError:
-                        logger.error(
+                        self.logger.error(
                             "Unrecognized {} input! Cannot find {} column."
                             .format(
                                 self.__class__.__name__,
@@ -509,64 +507,58 @@ class JAFFA(_Parser):
                 continue
 
             line = line.strip().replace('"', '').split(',')
-            self.fusions.append(
-                {
-                    'gene5prime': line[
-                        data_indices['fusion genes']].split(':')[0],
-                    'gene3prime': line[
-                        data_indices['fusion genes']].split(':')[1],
-                    'gene5prime_junction': int(line[data_indices['base1']]),
-                    'gene3prime_junction': int(line[data_indices['base2']])
-                }
-            )
+            yield {
+                'gene5prime': line[
+                    data_indices['fusion genes']].split(':')[0],
+                'gene3prime': line[
+                    data_indices['fusion genes']].split(':')[1],
+                'gene5prime_junction': int(line[data_indices['base1']]),
+                'gene3prime_junction': int(line[data_indices['base2']])
+            }
         fin.close()
 
-        self._check_data()
-
 
 class Bellerophontes(_Parser):
-    def __init__(self, infile, logger):
-        super(Bellerophontes, self).__init__(logger)
+    def __init__(self, infile, logger, stream=False):
+        super(Bellerophontes, self).__init__(infile, logger, stream)
 
-        fin = open(infile, 'r')
-        for line in fin.readlines():
+    def _parse(self):
+        fin = open(self.infile, 'r')
+        for line in fin:
 
             line = line.strip().split('\t')
             if len(line) <= 2:
                 continue
 
-            self.fusions.append(
-                {
-                    'gene5prime': line[0],
-                    'gene3prime': line[4],
-                    'gene5prime_junction': int(line[9]),
-                    'gene3prime_junction': int(line[11])
-                }
-            )
+            yield {
+                'gene5prime': line[0],
+                'gene3prime': line[4],
+                'gene5prime_junction': int(line[9]),
+                'gene3prime_junction': int(line[11])
+            }
         fin.close()
 
-        self._check_data()
-
 
 class BreakFusion(_Parser):
-    def __init__(self, infile,logger):
-        super(BreakFusion, self).__init__(logger)
+    def __init__(self, infile, logger, stream=False):
+        super(BreakFusion, self).__init__(infile, logger, stream)
 
+    def _parse(self):
         data_indices = {
             'POS1': 1,
             'POS2': 4,
             'RefseqGene': 11
         }
 
-        fin = open(infile, 'r')
-        for line in fin.readlines():
+        fin = open(self.infile, 'r')
+        for line in fin:
             if re.findall('CHR1', line):
                 line = line.strip().split('\t')
                 for column in data_indices.keys():
                     try:
                         data_indices[column] = line.index(column)
                     except ValueError:
-                        logger.error(
+                        self.logger.error(
                             "Unrecognized {} input! Cannot find {} column."
                             .format(
                                 self.__class__.__name__,
@@ -590,23 +582,20 @@ class BreakFusion(_Parser):
                                        'BreakFusion input line: {}').format(
                                            '\t'.join(line)))
 
-                self.fusions.append(
-                    {
-                        'gene5prime': genes[0],
-                        'gene3prime': genes[1],
-                        'gene5prime_junction': int(line[data_indices['POS1']]),
-                        'gene3prime_junction': int(line[data_indices['POS2']])
-                    }
-                )
+                yield {
+                    'gene5prime': genes[0],
+                    'gene3prime': genes[1],
+                    'gene5prime_junction': int(line[data_indices['POS1']]),
+                    'gene3prime_junction': int(line[data_indices['POS2']])
+                }
         fin.close()
 
-        self._check_data()
-
 
 class InFusion(_Parser):
-    def __init__(self, infile, logger):
-        super(InFusion, self).__init__(logger)
+    def __init__(self, infile, logger, stream=False):
+        super(InFusion, self).__init__(infile, logger, stream)
 
+    def _parse(self):
         data_indices = {
             'break_pos1': 2,
             'break_pos2': 5,
@@ -614,9 +603,9 @@ class InFusion(_Parser):
             'genes_2': 10
         }
 
-        fin = open(infile, 'r')
+        fin = open(self.infile, 'r')
         n = 0
-        for line in fin.readlines():
+        for line in fin:
             n += 1
             if re.findall('#id', line):
                 line = line.strip().split('\t')
@@ -624,7 +613,7 @@ class InFusion(_Parser):
                     try:
                         data_indices[column] = line.index(column)
                     except ValueError:
-                        logger.error(
+                        self.logger.error(
                             "Unrecognized {} input! Cannot find {} column."
                             .format(
                                 self.__class__.__name__,
@@ -646,27 +635,24 @@ class InFusion(_Parser):
                 )
                 continue
 
-            self.fusions.append(
-                {
-                    'gene5prime': line[data_indices['genes_1']].split(';'),
-                    'gene3prime': line[data_indices['genes_2']].split(';'),
-                    'gene5prime_junction': int(
-                        line[data_indices['break_pos1']]),
-                    'gene3prime_junction': int(
-                        line[data_indices['break_pos2']])
-                }
-            )
+            yield {
+                'gene5prime': line[data_indices['genes_1']].split(';'),
+                'gene3prime': line[data_indices['genes_2']].split(';'),
+                'gene5prime_junction': int(
+                    line[data_indices['break_pos1']]),
+                'gene3prime_junction': int(
+                    line[data_indices['break_pos2']])
+            }
         fin.close()
 
-        self._check_data()
-
 
 class FusionInspector(_Parser):
-    def __init__(self, infile, logger):
-        super(FusionInspector, self).__init__(logger)
+    def __init__(self, infile, logger, stream=False):
+        super(FusionInspector, self).__init__(infile, logger, stream)
 
-        fin = open(infile, 'r')
-        for line in fin.readlines():
+    def _parse(self):
+        fin = open(self.infile, 'r')
+        for line in fin:
             if re.findall('^#', line):
                 line = line.rstrip().split('\t')
                 if line[0] != '#FusionName' and line[0] != '#fusion_name':
@@ -692,33 +678,25 @@ class FusionInspector(_Parser):
             gene_3prime = line[6].split('^')[1].split('.')[0]
             gene_3prime_name = line[6].split('^')[0]
             gene_3prime_junction = int(line[8].split(':')[1])
-            self.fusions.append(
-                {
-                    'gene5prime': gene_5prime,
-                    'gene3prime': gene_3prime,
-                    'alternative_name_5prime': gene_5prime_name,
-                    'alternative_name_3prime': gene_3prime_name,
-                    'gene5prime_junction': gene_5prime_junction,
-                    'gene3prime_junction': gene_3prime_junction
-                }
-            )
+            yield {
+                'gene5prime': gene_5prime,
+                'gene3prime': gene_3prime,
+                'alternative_name_5prime': gene_5prime_name,
+                'alternative_name_3prime': gene_3prime_name,
+                'gene5prime_junction': gene_5prime_junction,
+                'gene3prime_junction': gene_3prime_junction
+            }
         fin.close()
 
-        self._check_data()
-
 
 class NFuse(_Parser):
-    def __init__(self, infile, logger):
-        super(NFuse, self).__init__(logger)
-
-        self._check_data()
+    def __init__(self, infile, logger, stream=False):
+        super(NFuse, self).__init__(infile, logger, stream)
 
 
 class SOAPfuse(_Parser):
-    def __init__(self, infile, logger):
-        super(SOAPfuse, self).__init__(logger)
-
-        self._check_data()
+    def __init__(self, infile, logger, stream=False):
+        super(SOAPfuse, self).__init__(infile, logger, stream)
 
 
 class FusionEntry():
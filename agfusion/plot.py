@@ -1,16 +1,62 @@
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-import matplotlib.pyplot
 from itertools import cycle
+import threading
 
-# this is so I can plot graphics on a headless server
+# draw on figures with the Agg canvas directly rather than through pyplot,
+# so no global figure manager is involved and images can be drawn by
+# several threads at once (this also works on a headless server)
 
-matplotlib.pyplot.ioff()
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
+import matplotlib.patches as patches
 
 HORIZONTAL_LEVELS = [1,2,3,4]
 
+# creating a figure and its axes is expensive, so plots of the same size
+# clear and redraw one pooled figure (and reuse its renderer to measure text)
+# instead of each creating their own. Each thread has its own pool.
+
+_FIGURES = {}
+_FIGURES_LOCK = threading.Lock()
+
+
+def _get_figure(width, height, dpi):
+    """
+    Return a figure of the given size and its cleared axes from the
+    current thread's figure pool
+    """
+
+    thread = threading.current_thread()
+    pool = _FIGURES.get(thread)
+
+    if pool is None:
+        with _FIGURES_LOCK:
+            pool = _FIGURES.setdefault(thread, {})
+
+    key = (width, height, dpi)
+
+    if key not in pool:
+        fig = Figure(figsize=(width, height), dpi=dpi, frameon=False)
+        FigureCanvasAgg(fig)
+        pool[key] = (fig, fig.add_subplot(111))
+        return pool[key]
+
+    fig, ax = pool[key]
+    ax.clear()
+    ax.set_axis_on()
+
+    return fig, ax
+
+
+def close_figures():
+    """
+    Release the pooled figures of every thread, including threads that
+    have finished. Only call it while no images are being drawn.
+    """
+
+    with _FIGURES_LOCK:
+        _FIGURES.clear()
+
 
 class _Plot(object):
     def __init__(self, filename='', height=0, width=0, dpi=0, fontsize=12,
@@ -23,10 +69,7 @@ class _Plot(object):
         self.dpi = dpi
         self.fontsize = fontsize
 
-        self.fig = plt.figure(
-            figsize=(self.width, self.height), dpi=self.dpi, frameon=False
-        )
-        self.ax = self.fig.add_subplot(111)
+        self.fig, self.ax = _get_figure(self.width, self.height, self.dpi)
         self.rr = self.fig.canvas.get_renderer()
 
     def save(self):
@@ -37,9 +80,6 @@ class _Plot(object):
             bbox_inches='tight'
         )
 
-        plt.close(self.fig)
-        plt.clf()
-
     def _scale(self, seq_length):
         """
         scale the sequence (protein or DNA)
@@ -75,7 +115,7 @@ class _PlotExons(_Plot):
             fontsize=self.fontsize
         )
 
-        self.ax.add_line(plt.Line2D(
+        self.ax.add_line(Line2D(
             (
                 self.offset,
                 self.offset+self.basepair_length
@@ -87,7 +127,7 @@ class _PlotExons(_Plot):
 
         # left marker
 
-        self.left_marker_line = self.ax.add_line(plt.Line2D(
+        self.left_marker_line = self.ax.add_line(Line2D(
             (
                 self.offset,
                 self.offset
@@ -108,7 +148,7 @@ class _PlotExons(_Plot):
 
         for i in range(1, basepair_length+1):
             if (i % 10000) == 0:
-                self.left_marker_line = self.ax.add_line(plt.Line2D(
+                self.left_marker_line = self.ax.add_line(Line2D(
                     (
                         self.offset+(i/float(self.normalize)*0.9),
                         self.offset+(i/float(self.normalize)*0.9)
@@ -120,7 +160,7 @@ class _PlotExons(_Plot):
 
         # right marker
 
-        self.right_marker_line = self.ax.add_line(plt.Line2D(
+        self.right_marker_line = self.ax.add_line(Line2D(
             (
                 self.offset+self.basepair_length,
                 self.offset+self.basepair_length
@@ -150,7 +190,7 @@ class PlotWTExons(_PlotExons):
 
         length = (self.ensembl_transcript.end-self.ensembl_transcript.start)/float(self.normalize)*0.9
 
-        self.ax.add_line(plt.Line2D(
+        self.ax.add_line(Line2D(
             (
                 self.offset,
                 self.offset+length
@@ -228,7 +268,7 @@ class PlotFusionExons(_PlotExons):
 
         junction_location_norm = junction_location/float(self.normalize)*0.9
 
-        self.ax.add_line(plt.Line2D(
+        self.ax.add_line(Line2D(
             (
                 self.offset+junction_location_norm,
                 self.offset+junction_location_norm
@@ -341,7 +381,7 @@ class PlotFusionExons(_PlotExons):
                                  self.transcript.transcript2.start) \
                                  / float(self.normalize)*0.9
 
-        self.ax.add_line(plt.Line2D(
+        self.ax.add_line(Line2D(
             (
                 self.offset,
                 self.offset + gene5prime_length
@@ -350,7 +390,7 @@ class PlotFusionExons(_PlotExons):
             color='black'
             )
         )
-        self.ax.add_line(plt.Line2D(
+        self.ax.add_line(Line2D(
             (
                 self.offset + gene5prime_length,
                 self.offset + gene5prime_length + gene3prime_length
@@ -618,7 +658,7 @@ class _PlotProtein(_Plot):
             fontsize=self.fontsize
         )
 
-        self.ax.add_line(plt.Line2D(
+        self.ax.add_line(Line2D(
             (
                 self.offset,
                 self.offset+self.protein_frame_length
@@ -633,7 +673,7 @@ class _PlotProtein(_Plot):
 
         # left marker
 
-        self.left_marker_line = self.ax.add_line(plt.Line2D(
+        self.left_marker_line = self.ax.add_line(Line2D(
             (
                 self.offset,
                 self.offset
@@ -658,7 +698,7 @@ class _PlotProtein(_Plot):
 
         for i in range(1, protein_length+1):
             if (i % 100) == 0:
-                self.left_marker_line = self.ax.add_line(plt.Line2D(
+                self.left_marker_line = self.ax.add_line(Line2D(
                     (
                         self.offset+(i/float(self.normalize)*0.9),
                         self.offset+(i/float(self.normalize)*0.9)
@@ -673,7 +713,7 @@ class _PlotProtein(_Plot):
 
         # right marker
 
-        self.right_marker_line = self.ax.add_line(plt.Line2D(
+        self.right_marker_line = self.ax.add_line(Line2D(
             (
                 self.offset+self.protein_frame_length,
                 self.offset+self.protein_frame_length
@@ -733,7 +773,7 @@ class PlotFusionProtein(_PlotProtein):
     def _draw_junction(self):
         # add the junction
 
-        self.ax.add_line(plt.Line2D(
+        self.ax.add_line(Line2D(
             (
                 (self.transcript.transcript_protein_junction_5prime/float(self.normalize))*0.9 + self.offset,
                 (self.transcript.transcript_protein_junction_5prime/float(self.normalize))*0.9 + self.offset
@@ -760,7 +800,7 @@ class PlotFusionProtein(_PlotProtein):
 
             # middle_marker_line_1/2/3 are to draw angled line
 
-            middle_marker_line_1 = self.ax.add_line(plt.Line2D(
+            middle_marker_line_1 = self.ax.add_line(Line2D(
                 (
                     (self.transcript.transcript_protein_junction_5prime/float(self.normalize))*0.9 + self.offset,
                     (self.transcript.transcript_protein_junction_5prime/float(self.normalize))*0.9 + self.offset
@@ -773,7 +813,7 @@ class PlotFusionProtein(_PlotProtein):
                 )
             )
 
-            middle_marker_line_2 = self.ax.add_line(plt.Line2D(
+            middle_marker_line_2 = self.ax.add_line(Line2D(
                 (
                     line_offset,
                     (self.transcript.transcript_protein_junction_5prime/float(self.normalize))*0.9 + self.offset
@@ -786,7 +826,7 @@ class PlotFusionProtein(_PlotProtein):
                 )
             )
 
-            middle_marker_line_3 = self.ax.add_line(plt.Line2D(
+            middle_marker_line_3 = self.ax.add_line(Line2D(
                 (
                     line_offset,
                     line_offset
@@ -866,11 +906,20 @@ class PlotWTProtein(_PlotProtein):
         super(PlotWTProtein, self).__init__(*args, **kwargs)
         self.ensembl_transcript = ensembl_transcript
 
+        # saved annotations only hold the length of the coding sequence
+
+        if hasattr(ensembl_transcript, 'coding_sequence_length'):
+            self.coding_sequence_length = \
+                ensembl_transcript.coding_sequence_length
+        else:
+            self.coding_sequence_length = \
+                len(ensembl_transcript.coding_sequence)
+
     def draw(self):
-        self._scale(len(self.ensembl_transcript.coding_sequence)/3)
-        self.protein_frame_length = len(self.ensembl_transcript.coding_sequence)/3/float(self.normalize)*0.9
+        self._scale(self.coding_sequence_length/3)
+        self.protein_frame_length = self.coding_sequence_length/3/float(self.normalize)*0.9
         self._draw_domains(self.transcript.domains[self.ensembl_transcript.id])
-        self._draw_protein_length_markers(int(len(self.ensembl_transcript.coding_sequence)/3))
+        self._draw_protein_length_markers(int(self.coding_sequence_length/3))
         self._draw_main_body(
             self.ensembl_transcript.gene.gene_name,
             self.ensembl_transcript.id
@@ -12,6 +12,23 @@ agfusion_db = os.path.join(
 
 AGFUSION_DB_URL = "https://s3.amazonaws.com/agfusion/agfusion."
 
+# size of the chunks the database is downloaded in, and how often a dropped
+# download is resumed, waiting DOWNLOAD_RETRY_WAIT seconds more each time
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_RETRY_WAIT = 5
+DOWNLOAD_TIMEOUT = 60
+
+# checkpoint manifest written to the output directory of a batch run
+
+BATCH_MANIFEST = 'agfusion.manifest.jsonl'
+
+# suffix of the files Fusion.save_annotation writes the data needed to draw a
+# fusion's images to
+
+ANNOTATION_SUFFIX = '.annotation.json'
+
 # this is mostly contigent on the maximum ensembl release supported
 # by pyensembl
 
@@ -66,6 +83,15 @@ for i in range(67,MAX_ENSEMBL_RELEASE+1):
     else:
         ENSEMBL_MYSQL_TABLES['mus_musculus'][i] = 'mus_musculus_core_' + str(i) + '_39'
 
+# the tables of an Ensembl core database that AGFusion builds its database
+# from (releases before 65 keep the stable IDs in separate tables)
+
+ENSEMBL_DUMP_TABLES = [
+    'gene', 'gene_stable_id', 'transcript', 'transcript_stable_id',
+    'translation', 'translation_stable_id', 'xref', 'object_xref',
+    'external_db', 'analysis', 'analysis_description', 'protein_feature'
+]
+
 # min amino acid length of domain to plot it
 
 MIN_DOMAIN_LENGTH = 5
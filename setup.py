@@ -31,7 +31,6 @@ setup(
     scripts=['bin/agfusion'],
     install_requires=[
         'matplotlib>=1.5.0',
-        'pandas>=0.18.1',
         'biopython>=1.67',
         'future>=0.16.0',
         'pyensembl>=1.1.0'
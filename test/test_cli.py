@@ -0,0 +1,226 @@
+from os.path import join, exists
+from os import mkdir, listdir, remove
+import gzip
+import hashlib
+import shutil
+import tempfile
+import threading
+import unittest
+from future.standard_library import install_aliases
+install_aliases()
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import agfusion
+from agfusion import cli
+from agfusion.cli import _BatchManifest, _DatabaseDownload, \
+    _resolve_batch_genes
+from test_database import BUILD, create_test_database
+from test_model import EnsemblData
+
+FUSION = {
+    'gene5prime': 'ENSMUSG00000022770',
+    'gene5prime_junction': 32883184,
+    'gene3prime': 'ENSMUSG00000002413',
+    'gene3prime_junction': 39627784
+}
+
+
+class TestBatchManifest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outdir = join(self.directory, 'Dlg1-32883184_Braf-39627784')
+        mkdir(self.outdir)
+        with open(join(self.outdir, 'Dlg1_Braf_cdna.fa'), 'w') as fout:
+            fout.write('>Dlg1_Braf\nATG\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_1(self):
+        """
+        test that a resumed run skips finished fusions only if they were
+        annotated with the same options and their output is complete
+        """
+
+        manifest = _BatchManifest(self.directory, {'type': 'png'})
+        manifest.record(FUSION, self.outdir)
+        manifest.close()
+
+        # a killed run can leave an incomplete line behind
+
+        with open(join(self.directory, 'agfusion.manifest.jsonl'), 'a') as f:
+            f.write('{"files": {')
+
+        manifest = _BatchManifest(self.directory, {'type': 'png'}, resume=True)
+        assert manifest.is_complete(FUSION), 'finished fusion not skipped'
+        manifest.close()
+
+        manifest = _BatchManifest(self.directory, {'type': 'pdf'}, resume=True)
+        assert not manifest.is_complete(FUSION), \
+            'fusion annotated with other options skipped'
+        manifest.close()
+
+        with open(join(self.outdir, 'Dlg1_Braf_cdna.fa'), 'a') as fout:
+            fout.write('ATG\n')
+
+        manifest = _BatchManifest(self.directory, {'type': 'png'}, resume=True)
+        assert not manifest.is_complete(FUSION), 'changed output skipped'
+        manifest.close()
+
+        manifest = _BatchManifest(self.directory, {'type': 'png'})
+        assert not manifest.is_complete(FUSION), 'skipped without --resume'
+        manifest.close()
+
+
+class TestResolveBatchGenes(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = agfusion.AGFusionDB(create_test_database(self.directory))
+        self.db.build = BUILD
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_1(self):
+        """
+        test that only the fusions of unresolvable genes are skipped when
+        parsers give lists of candidate genes
+        """
+
+        fusions = [
+            {'gene5prime': ['Dlg1', 'NOTAGENE'], 'gene3prime': 'Braf'},
+            {'gene5prime': 'NOTAGENE', 'gene3prime': 'Braf'},
+            {'gene5prime': 'Dlg1', 'gene3prime': ['Braf']}
+        ]
+
+        resolved = _resolve_batch_genes(fusions, self.db, EnsemblData())
+
+        assert resolved == [fusions[0], fusions[2]], \
+            'wrong fusions resolved: %s' % str(resolved)
+
+
+class DatabaseHandler(BaseHTTPRequestHandler):
+    """
+    Serves a gzipped database with support for Range requests, dropping
+    the connection half way through the first response
+    """
+
+    def do_GET(self):
+        server = self.server
+        server.ranges.append(self.headers.get('Range'))
+
+        if not self.path.endswith('.db.gz'):
+            self.send_error(404)
+            return
+
+        start = 0
+        if self.headers.get('Range') is not None:
+            start = int(self.headers.get('Range')[6:-1])
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(server.data) - start))
+        self.send_header('ETag', '"' + server.md5 + '"')
+        self.end_headers()
+
+        if server.drop:
+            server.drop = False
+            self.wfile.write(server.data[start:len(server.data) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self.wfile.write(server.data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = b''.join([b'%d\tENSG%011d\n' % (i, i)
+                                  for i in range(100000)])
+        self.data = gzip.compress(self.database)
+
+        self.retry_wait = cli.DOWNLOAD_RETRY_WAIT
+        cli.DOWNLOAD_RETRY_WAIT = 0
+
+        self.server = HTTPServer(('127.0.0.1', 0), DatabaseHandler)
+        self.server.data = self.data
+        self.server.md5 = hashlib.md5(self.data).hexdigest()
+        self.server.ranges = []
+        self.server.drop = True
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = 'http://127.0.0.1:{}/agfusion.homo_sapiens.87.db.gz' \
+            .format(self.server.server_port)
+
+    def tearDown(self):
+        cli.DOWNLOAD_RETRY_WAIT = self.retry_wait
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_1(self):
+        """
+        test that a dropped download is resumed where it stopped and that
+        the decompressed database is verified
+        """
+
+        file_path = join(self.directory, 'agfusion.homo_sapiens.87.db')
+        error = _DatabaseDownload(self.url, file_path).run()
+
+        assert error is None, error
+        assert open(file_path, 'rb').read() == self.database, \
+            'wrong database'
+        assert self.server.ranges[::2] == \
+            [None, 'bytes={}-'.format(len(self.data) // 2)], \
+            'wrong requests: %s' % str(self.server.ranges)
+        assert listdir(self.directory) == ['agfusion.homo_sapiens.87.db'], \
+            'files left behind'
+
+    def test_2(self):
+        """
+        test that a download is resumed from the .gz.part file of an earlier
+        run and that a corrupt download is discarded
+        """
+
+        file_path = join(self.directory, 'agfusion.homo_sapiens.87.db')
+
+        with open(file_path + '.gz.part', 'wb') as fout:
+            fout.write(self.data[:1000])
+
+        self.server.drop = False
+        error = _DatabaseDownload(self.url, file_path).run()
+
+        assert error is None, error
+        assert open(file_path, 'rb').read() == self.database, \
+            'wrong database'
+        assert self.server.ranges[:1] == ['bytes=1000-'], \
+            'wrong requests: %s' % str(self.server.ranges)
+
+        # a corrupt .gz.part file is downloaded again
+
+        remove(file_path)
+        with open(file_path + '.gz.part', 'wb') as fout:
+            fout.write(self.data[:1000][::-1])
+
+        error = _DatabaseDownload(self.url, file_path).run()
+
+        assert error is None, error
+        assert open(file_path, 'rb').read() == self.database, \
+            'wrong database'
+        assert self.server.ranges[2] is None, \
+            'wrong requests: %s' % str(self.server.ranges)
+
+        remove(file_path)
+        self.server.md5 = hashlib.md5(b'').hexdigest()
+
+        error = _DatabaseDownload(self.url, file_path).run()
+
+        assert error is not None and 'corrupt' in error, error
+        assert listdir(self.directory) == [], 'corrupt download kept'
+
+
+if __name__ == "__main__":
+    unittest.main()
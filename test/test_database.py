@@ -0,0 +1,1041 @@
+from os.path import join
+from os import listdir, mkdir, remove
+import re
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import agfusion
+from agfusion import database
+from agfusion.utils import PROTEIN_ANNOTATIONS
+
+BUILD = 'mus_musculus_84'
+
+ENSEMBL_DUMP = './data/EnsemblDump/'
+
+
+def create_test_database(directory, annotations=PROTEIN_ANNOTATIONS):
+    """
+    Create a small AGFusion database with the schema of the databases
+    released before the tables were indexed
+    """
+
+    database = join(directory, 'agfusion.mus_musculus.84.db')
+
+    db = sqlite3.connect(database)
+    cursor = db.cursor()
+    cursor.execute(
+        "CREATE TABLE " + BUILD + " (gene_id text,stable_id text," +
+        "entrez_id text,gene_name text,canonical_transcript_id text);")
+    cursor.execute(
+        "CREATE TABLE " + BUILD + "_transcript (transcript_id text," +
+        "gene_id text,transcript_stable_id text,translation_id text);")
+    cursor.execute(
+        "CREATE TABLE " + BUILD + "_refseq (transcript_id text," +
+        "transcript_stable_id text,refseq_id text);")
+    for annotation in annotations:
+        cursor.execute(
+            "CREATE TABLE " + BUILD + "_" + annotation + " (" +
+            "translation_id text,stable_id text,hit_id text," +
+            "seq_start integer,seq_end integer,hit_description text," +
+            "hit_name text);")
+
+    cursor.executemany(
+        'INSERT INTO ' + BUILD + ' VALUES (?,?,?,?,?)',
+        [
+            ['1', 'ENSMUSG00000022770', '13383', 'Dlg1', '10'],
+            ['2', 'ENSMUSG00000002413', '109880', 'Braf', '20']
+        ]
+    )
+    cursor.executemany(
+        'INSERT INTO ' + BUILD + '_transcript VALUES (?,?,?,?)',
+        [
+            ['10', '1', 'ENSMUST00000064477', '100'],
+            ['11', '1', 'ENSMUST00000023454', '101'],
+            ['20', '2', 'ENSMUST00000002487', '200']
+        ]
+    )
+    cursor.executemany(
+        'INSERT INTO ' + BUILD + '_refseq VALUES (?,?,?)',
+        [['20', 'ENSMUST00000002487', 'NM_139294']]
+    )
+    if 'pfam' in annotations:
+        cursor.executemany(
+            'INSERT INTO ' + BUILD + '_pfam VALUES (?,?,?,?,?,?,?)',
+            [
+                ['100', 'ENSMUSP00000064477', 'PF09058', 5, 66,
+                 'L27_1 domain', 'L27_1'],
+                ['200', 'ENSMUSP00000002487', 'PF07714', 457, 717,
+                 'Protein tyrosine kinase', 'Pkinase_Tyr']
+            ]
+        )
+    db.commit()
+    db.close()
+
+    return database
+
+
+class TestOptimize(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_1(self):
+        """
+        test that optimize indexes every lookup column of an existing
+        database
+        """
+
+        db = agfusion.AGFusionDB(create_test_database(self.directory))
+        db.build = BUILD
+        db.optimize()
+
+        db.sqlite3_cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type=='index'"
+        )
+        indexes = set([i[0] for i in db.sqlite3_cursor.fetchall()])
+
+        for index in [BUILD + '_stable_id', BUILD + '_entrez_id',
+                      BUILD + '_canonical_transcript_id',
+                      BUILD + '_transcript_transcript_stable_id',
+                      BUILD + '_refseq_refseq_id',
+                      BUILD + '_pfam_translation_id']:
+            assert index in indexes, 'missing index %s' % index
+
+        db.sqlite3_cursor.execute(
+            "SELECT name FROM sqlite_master WHERE name=='sqlite_stat1'"
+        )
+
+        assert len(db.sqlite3_cursor.fetchall()) == 1, 'database not analyzed'
+
+    def test_2(self):
+        """
+        test that optimize skips protein annotation tables the database
+        does not have and can be run more than once
+        """
+
+        db = agfusion.AGFusionDB(
+            create_test_database(self.directory, annotations=['pfam'])
+        )
+        db.build = BUILD
+        db.optimize()
+        db.optimize()
+
+        db.sqlite3_cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type=='index'"
+        )
+        indexes = set([i[0] for i in db.sqlite3_cursor.fetchall()])
+
+        assert BUILD + '_pfam_translation_id' in indexes, 'missing pfam index'
+        assert BUILD + '_smart_translation_id' not in indexes, \
+            'index created for a missing table'
+
+
+class TestQueries(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = agfusion.AGFusionDB(create_test_database(self.directory))
+        self.db.build = BUILD
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_1(self):
+        """
+        test that genes and transcripts are returned as typed rows
+        """
+
+        gene = self.db.gene_by_stable_id('ENSMUSG00000022770')
+
+        assert gene.gene_name == 'Dlg1', 'wrong gene: %s' % str(gene)
+        assert gene.canonical_transcript_id == '10', 'wrong canonical transcript'
+
+        transcripts = self.db.transcripts_by_gene_id(gene.gene_id)
+
+        assert sorted([i.transcript_stable_id for i in transcripts]) == \
+            ['ENSMUST00000023454', 'ENSMUST00000064477'], 'wrong transcripts'
+        assert self.db.translation_id_for_transcript('ENSMUST00000002487') \
+            == '200', 'wrong translation id'
+        assert self.db.refseqs_by_id('NM_139294')[0].transcript_stable_id \
+            == 'ENSMUST00000002487', 'wrong RefSeq transcript'
+
+        features = self.db.protein_features('200', 'pfam')
+
+        assert [(i.hit_name, i.seq_start, i.seq_end) for i in features] == \
+            [('Pkinase_Tyr', 457, 717)], 'wrong protein features'
+
+    def test_2(self):
+        """
+        test that identifiers with quotes are looked up rather than breaking
+        the query
+        """
+
+        assert self.db.gene_by_stable_id('ENSMUSG"00000022770') is None
+        assert self.db.genes_by_entrez_id("13383' OR '1'='1") == []
+        assert self.db.translation_id_for_transcript('"') is None
+
+    def test_3(self):
+        """
+        test that unknown protein databases are rejected
+        """
+
+        self.assertRaises(
+            agfusion.exceptions.DataBaseError,
+            self.db.protein_features,
+            '200',
+            'pfam; DROP TABLE mus_musculus_84'
+        )
+
+    def test_4(self):
+        """
+        test fetching the features of several proteins from several
+        protein databases at once
+        """
+
+        features = self.db.fetch_protein_features(
+            ['100', '200', '101'],
+            ['smart', 'pfam']
+        )
+
+        assert list(features.keys()) == [
+            ('100', 'smart'), ('100', 'pfam'),
+            ('200', 'smart'), ('200', 'pfam'),
+            ('101', 'smart'), ('101', 'pfam')
+        ], 'wrong keys: %s' % str(list(features.keys()))
+        assert [i.hit_name for i in features[('100', 'pfam')]] == ['L27_1'], \
+            'wrong features for 100'
+        assert [i.hit_name for i in features[('200', 'pfam')]] == \
+            ['Pkinase_Tyr'], 'wrong features for 200'
+        assert features[('101', 'pfam')] == [], 'features for 101'
+        assert features[('200', 'smart')] == [], 'smart features for 200'
+        assert self.db.fetch_protein_features([], ['pfam']) == {}, \
+            'features for no proteins'
+
+    def test_5(self):
+        """
+        test fetching the rows of many identifiers at once
+        """
+
+        genes = self.db.genes_by_stable_ids(
+            ['ENSMUSG00000002413', 'ENSMUSG00000022770', 'ENSMUSG0']
+        )
+
+        assert [[j.gene_name for j in i] for i in genes.values()] == \
+            [['Braf'], ['Dlg1'], []], 'wrong genes: %s' % str(genes)
+
+        transcripts = self.db.transcripts_by_stable_ids(
+            ['ENSMUST%011d' % i for i in range(3000)] + ['ENSMUST00000064477']
+        )
+
+        assert len(transcripts) == 3001, 'wrong number of transcripts'
+        assert transcripts['ENSMUST00000002487'][0].transcript_id == '20', \
+            'wrong transcript'
+        assert transcripts['ENSMUST00000064477'][0].transcript_id == '10', \
+            'wrong transcript'
+
+
+class TestProteinFeatureCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = agfusion.AGFusionDB(
+            create_test_database(self.directory),
+            feature_cache_size=4
+        )
+        self.db.build = BUILD
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_1(self):
+        """
+        test that repeated lookups, including of proteins without features,
+        are answered from the cache
+        """
+
+        cache = self.db.protein_feature_cache
+
+        self.db.fetch_protein_features(['200', '101'], ['pfam'])
+
+        assert (cache.hits, cache.misses) == (0, 2), \
+            'wrong counters: %d hits, %d misses' % (cache.hits, cache.misses)
+
+        # drop the table so a second query would fail
+
+        self.db.sqlite3_cursor.execute('DROP TABLE ' + BUILD + '_pfam')
+
+        features = self.db.fetch_protein_features(['200', '101'], ['pfam'])
+
+        assert (cache.hits, cache.misses) == (2, 2), \
+            'wrong counters: %d hits, %d misses' % (cache.hits, cache.misses)
+        assert [i.hit_name for i in features[('200', 'pfam')]] == \
+            ['Pkinase_Tyr'], 'wrong cached features'
+        assert features[('101', 'pfam')] == [], 'wrong cached features'
+
+    def test_2(self):
+        """
+        test that the cache evicts the least recently used entries
+        """
+
+        cache = self.db.protein_feature_cache
+
+        self.db.fetch_protein_features(['100', '200'], ['pfam', 'smart'])
+        self.db.protein_features('100', 'pfam')
+        self.db.protein_features('101', 'pfam')
+
+        assert len(cache) == 4, 'cache holds %d entries' % len(cache)
+        assert ('100', 'pfam') in cache, 'recently used entry evicted'
+        assert ('100', 'smart') not in cache, 'oldest entry not evicted'
+
+
+class TestReadOnly(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='agfusion db?#')
+        self.db = agfusion.AGFusionDB(
+            create_test_database(self.directory),
+            read_only=True,
+            cache_size=-1024
+        )
+        self.db.build = BUILD
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_1(self):
+        """
+        test that a read-only database is memory-mapped, answers queries
+        and cannot be written to
+        """
+
+        assert self.db.gene_by_stable_id('ENSMUSG00000022770').gene_name \
+            == 'Dlg1', 'wrong gene'
+
+        self.db.sqlite3_cursor.execute('PRAGMA mmap_size')
+        mmap_size = self.db.sqlite3_cursor.fetchone()[0]
+
+        assert mmap_size == agfusion.database.SQLITE_MMAP_SIZE, \
+            'mmap_size is %d' % mmap_size
+
+        self.db.sqlite3_cursor.execute('PRAGMA cache_size')
+        cache_size = self.db.sqlite3_cursor.fetchone()[0]
+
+        assert cache_size == -1024, 'cache_size is %d' % cache_size
+
+        self.assertRaises(
+            sqlite3.OperationalError,
+            self.db.sqlite3_cursor.execute,
+            'DROP TABLE ' + BUILD
+        )
+
+
+class TestInMemory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_1(self):
+        """
+        test that a database loaded into memory answers queries without
+        the database file
+        """
+
+        database = create_test_database(self.directory)
+        db = agfusion.AGFusionDB(database, read_only=True, in_memory=True)
+        db.build = BUILD
+
+        remove(database)
+
+        assert db.gene_by_stable_id('ENSMUSG00000022770').gene_name == \
+            'Dlg1', 'wrong gene'
+        assert [i.hit_name for i in db.protein_features('200', 'pfam')] == \
+            ['Pkinase_Tyr'], 'wrong protein features'
+
+        db.sqlite3_cursor.execute('PRAGMA database_list')
+
+        assert db.sqlite3_cursor.fetchone()[2] == '', 'database not in memory'
+
+    def test_2(self):
+        """
+        test loading the database into memory without the backup API of
+        Python 3.7+
+        """
+
+        class Connection(sqlite3.Connection):
+            @property
+            def backup(self):
+                raise AttributeError('backup')
+
+        database = create_test_database(self.directory)
+        db = agfusion.AGFusionDB(database)
+        db.build = BUILD
+        db.sqlite3_db.close()
+        db.sqlite3_db = sqlite3.connect(database, factory=Connection)
+        db._load_into_memory()
+        db.sqlite3_cursor = db.sqlite3_db.cursor()
+
+        remove(database)
+
+        assert db.gene_by_stable_id('ENSMUSG00000022770').gene_name == \
+            'Dlg1', 'wrong gene'
+        assert [i.hit_name for i in db.protein_features('200', 'pfam')] == \
+            ['Pkinase_Tyr'], 'wrong protein features'
+
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        database = create_test_database(self.directory)
+
+        # rows with NULL values and a second transcript of Braf that shares
+        # its RefSeq ID
+
+        db = sqlite3.connect(database)
+        db.execute(
+            'INSERT INTO ' + BUILD + ' VALUES (?,?,?,?,?)',
+            ['3', 'ENSMUSG00000000003', None, 'Braf2', '30']
+        )
+        db.execute(
+            'INSERT INTO ' + BUILD + '_refseq VALUES (?,?,?)',
+            ['21', 'ENSMUST00000002488', 'NM_139294']
+        )
+        db.execute(
+            'INSERT INTO ' + BUILD + '_pfam VALUES (?,?,?,?,?,?,?)',
+            ['200', 'ENSMUSP00000002487', 'PF00001', 10, 20, None, 'X']
+        )
+        db.commit()
+        db.close()
+
+        self.db = agfusion.AGFusionDB(database)
+        self.db.build = BUILD
+        self.db.convert(join(self.directory, 'agfusion.mus_musculus.84.index'))
+
+        self.index = agfusion.AGFusionDB(
+            join(self.directory, 'agfusion.mus_musculus.84.index')
+        )
+        self.index.build = BUILD
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_1(self):
+        """
+        test that the index answers every lookup like the database
+        """
+
+        lookups = [
+            ('gene_by_stable_id', 'ENSMUSG00000022770'),
+            ('gene_by_stable_id', 'ENSMUSG00000000003'),
+            ('gene_by_stable_id', 'ENSMUSG"00000022770'),
+            ('genes_by_entrez_id', '13383'),
+            ('genes_by_entrez_id', 13383),
+            ('genes_by_entrez_id', None),
+            ('transcript_by_id', '20'),
+            ('transcript_by_stable_id', 'ENSMUST00000064477'),
+            ('transcripts_by_gene_id', '1'),
+            ('refseqs_by_id', 'NM_139294'),
+            ('translation_id_for_transcript', 'ENSMUST00000002487'),
+            ('translation_id_for_transcript', 'ENSMUST0'),
+            ('genes_by_stable_ids', ['ENSMUSG00000002413', 'X', None]),
+            ('genes_by_entrez_ids', ['109880', '13383']),
+            ('transcripts_by_ids', ['11', '10', '10']),
+            ('transcripts_by_stable_ids', ['ENSMUST00000002487']),
+            ('refseqs_by_ids', ['NM_139294', 'NM_0'])
+        ]
+
+        for method, value in lookups:
+            expected = getattr(self.db, method)(value)
+            found = getattr(self.index, method)(value)
+
+            assert found == expected, '%s(%s): %s instead of %s' % (
+                method, str(value), str(found), str(expected))
+            if isinstance(expected, dict):
+                assert list(found.keys()) == list(expected.keys()), \
+                    '%s(%s): wrong order' % (method, str(value))
+
+        features = self.index.fetch_protein_features(
+            ['100', '200', '101', None],
+            ['smart', 'pfam']
+        )
+
+        assert features == self.db.fetch_protein_features(
+            ['100', '200', '101', None],
+            ['smart', 'pfam']
+        ), 'wrong protein features: %s' % str(features)
+        assert [i.seq_start for i in features[('200', 'pfam')]] == \
+            [457, 10], 'wrong protein features'
+
+    def test_2(self):
+        """
+        test that the index cannot be optimized or converted
+        """
+
+        self.assertRaises(
+            agfusion.exceptions.DataBaseError,
+            self.index.optimize
+        )
+        self.assertRaises(
+            agfusion.exceptions.DataBaseError,
+            self.index.convert,
+            join(self.directory, 'other.index')
+        )
+
+
+DUMP_BUILD = 'homo_sapiens_87'
+
+
+def dump_builder(directory, dumps=None,
+                 manager=agfusion.AGFusionDumpDBBManager, **kwargs):
+    """
+    A builder of the database of the Ensembl table dumps in
+    data/EnsemblDump
+    """
+
+    return manager(
+        directory,
+        'homo_sapiens',
+        87,
+        ENSEMBL_DUMP + 'pfam.txt',
+        dumps or ENSEMBL_DUMP + 'homo_sapiens_core_87_38',
+        **kwargs
+    )
+
+
+def build_from_dumps(agfusion_db):
+    """
+    Fetch every table and finish the build
+    """
+
+    agfusion_db.fetch_gene_names()
+    agfusion_db.fetch_transcript_table()
+    agfusion_db.fetch_refseq_table()
+    agfusion_db.fetch_protein_annotation()
+    agfusion_db.finish()
+
+
+def table_rows(database, table):
+    """
+    The rows of a table of a built database
+    """
+
+    db = sqlite3.connect(database)
+    rows = db.execute('SELECT * FROM ' + table + ' ORDER BY rowid').fetchall()
+    db.close()
+
+    return rows
+
+
+def completed_tables(database):
+    """
+    The tables the provenance table of a built database records as
+    completed
+    """
+
+    db = sqlite3.connect(database)
+    tables = set([
+        i[0] for i in
+        db.execute('SELECT table_name FROM ' + DUMP_BUILD + '_provenance')
+    ])
+    db.close()
+
+    return tables
+
+
+def open_connections(connections):
+    """
+    The SQLite connections that have not been closed
+    """
+
+    open_connections = []
+
+    for connection in connections:
+        try:
+            connection.total_changes
+        except sqlite3.ProgrammingError:
+            continue
+        open_connections.append(connection)
+
+    return open_connections
+
+
+class FlakyDumpDBBManager(agfusion.AGFusionDumpDBBManager):
+    """
+    A builder from the Ensembl table dumps whose queries of the protein
+    annotations in drop lose their connection after the first chunk of
+    rows and are run again, and whose queries of the protein annotations
+    in fail raise an error. The connections to the Ensembl tables it opens
+    are kept in connections.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.drop = kwargs.pop('drop', [])
+        self.fail = kwargs.pop('fail', [])
+        self.queried = []
+        self.connections = []
+
+        agfusion.AGFusionDumpDBBManager.__init__(self, *args, **kwargs)
+
+    def _connect_ensembl(self):
+        agfusion.AGFusionDumpDBBManager._connect_ensembl(self)
+
+        if hasattr(self._ensembl, 'db'):
+            self.connections.append(self._ensembl.db)
+
+    def _stream_ensembl(self, mysql_command, on_retry=None):
+        annotation = re.search("logic_name = '(\\w+)'", mysql_command)
+        annotation = annotation.group(1) if annotation else None
+
+        self.queried.append(annotation)
+
+        if annotation in self.fail:
+            raise IOError('lost the query of ' + annotation)
+
+        rows = agfusion.AGFusionDumpDBBManager._stream_ensembl(
+            self, mysql_command, on_retry
+        )
+
+        if annotation in self.drop:
+            yield next(rows)
+            on_retry()
+            rows = agfusion.AGFusionDumpDBBManager._stream_ensembl(
+                self, mysql_command, on_retry
+            )
+
+        for i in rows:
+            yield i
+
+
+class TestStreamRetry(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.chunk_size = database.BUILD_CHUNK_SIZE
+        database.BUILD_CHUNK_SIZE = 2
+
+    def tearDown(self):
+        database.BUILD_CHUNK_SIZE = self.chunk_size
+        shutil.rmtree(self.directory)
+
+    def test_1(self):
+        """
+        test that a table whose query loses its connection mid-stream is
+        cleared and streamed again without duplicate rows
+        """
+
+        agfusion_db = dump_builder(
+            self.directory,
+            manager=FlakyDumpDBBManager,
+            drop=['ncoils', 'pfscan', 'seg']
+        )
+        agfusion_db.fetch_protein_annotation()
+        agfusion_db.close()
+
+        for annotation, n_rows in [('ncoils', 5), ('pfscan', 4), ('seg', 3)]:
+            rows = table_rows(
+                agfusion_db.database,
+                DUMP_BUILD + '_' + annotation
+            )
+
+            assert len(rows) == n_rows, \
+                'wrong number of %s rows: %s' % (annotation, str(rows))
+            assert len(set(rows)) == n_rows, \
+                'duplicate %s rows: %s' % (annotation, str(rows))
+
+
+class TestConcurrentFetch(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.chunk_size = database.BUILD_CHUNK_SIZE
+        database.BUILD_CHUNK_SIZE = 1
+
+    def tearDown(self):
+        database.BUILD_CHUNK_SIZE = self.chunk_size
+        shutil.rmtree(self.directory)
+
+    def test_1(self):
+        """
+        test that protein annotations fetched over several connections,
+        some of them rerun after losing their connection, have the rows of
+        a serial build
+        """
+
+        mkdir(join(self.directory, 'serial'))
+        serial_db = dump_builder(join(self.directory, 'serial'))
+        serial_db.fetch_protein_annotation()
+        serial_db.close()
+
+        agfusion_db = dump_builder(
+            self.directory,
+            manager=FlakyDumpDBBManager,
+            drop=['ncoils', 'pfscan', 'pirsf']
+        )
+        agfusion_db.fetch_protein_annotation(connections=3)
+        agfusion_db.close()
+
+        assert sorted(agfusion_db.queried) == sorted(PROTEIN_ANNOTATIONS), \
+            'wrong queries: %s' % str(agfusion_db.queried)
+
+        for annotation in PROTEIN_ANNOTATIONS:
+            table = DUMP_BUILD + '_' + annotation
+            rows = table_rows(agfusion_db.database, table)
+
+            assert sorted(rows) == \
+                sorted(table_rows(serial_db.database, table)), \
+                'wrong %s rows: %s' % (annotation, str(rows))
+
+        assert completed_tables(agfusion_db.database) == \
+            set([DUMP_BUILD + '_' + i for i in PROTEIN_ANNOTATIONS]), \
+            'tables not recorded as completed'
+
+    def test_2(self):
+        """
+        test that a failed query is raised by the thread writing to SQLite,
+        and that the protein annotations queued behind it are not queried
+        """
+
+        agfusion_db = dump_builder(
+            self.directory,
+            manager=FlakyDumpDBBManager,
+            fail=['pfam']
+        )
+
+        self.assertRaises(
+            IOError,
+            agfusion_db.fetch_protein_annotation,
+            connections=2
+        )
+        agfusion_db.close()
+
+        assert 'pfam' in agfusion_db.queried, 'pfam not queried'
+        assert open_connections(agfusion_db.connections) == [], \
+            'connections left open'
+        assert len(agfusion_db.queried) < len(PROTEIN_ANNOTATIONS), \
+            'every protein annotation queried after the error'
+        assert DUMP_BUILD + '_pfam' not in \
+            completed_tables(agfusion_db.database), \
+            'failed table recorded as completed'
+
+    def test_3(self):
+        """
+        test that a build fetching the protein annotations over several
+        connections leaves none of them open
+        """
+
+        agfusion_db = dump_builder(
+            self.directory,
+            manager=FlakyDumpDBBManager
+        )
+        agfusion_db.fetch_gene_names()
+        agfusion_db.fetch_transcript_table()
+        agfusion_db.fetch_refseq_table()
+        agfusion_db.fetch_protein_annotation(connections=3)
+        agfusion_db.finish()
+
+        assert len(agfusion_db.connections) > 1, 'only one connection opened'
+        assert open_connections(agfusion_db.connections) == [], \
+            '%d of %d connections left open' % (
+                len(open_connections(agfusion_db.connections)),
+                len(agfusion_db.connections)
+            )
+        assert listdir(self.directory) == ['agfusion.homo_sapiens.87.db'], \
+            'temporary files left behind: %s' % str(listdir(self.directory))
+
+
+class TestBulkLoad(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def indexes(self, database):
+        db = sqlite3.connect(database)
+        indexes = set([
+            i[0] for i in
+            db.execute("SELECT name FROM sqlite_master WHERE type=='index'")
+        ])
+        db.close()
+
+        return indexes
+
+    def test_1(self):
+        """
+        test that a bulk load builds the database a normal build does
+        without a journal, with its indexes created when it finishes and
+        the default journal restored
+        """
+
+        mkdir(join(self.directory, 'normal'))
+        normal_db = dump_builder(join(self.directory, 'normal'))
+        build_from_dumps(normal_db)
+
+        agfusion_db = dump_builder(self.directory, bulk_load=True)
+
+        agfusion_db.fetch_gene_names()
+        agfusion_db.fetch_transcript_table()
+        agfusion_db.fetch_refseq_table()
+        agfusion_db.fetch_protein_annotation()
+
+        assert [i for i in listdir(self.directory)
+                if i.startswith('agfusion.homo_sapiens.87.db-')] == [], \
+            'journal written during the bulk load: %s' % \
+            str(listdir(self.directory))
+        assert [i for i in self.indexes(agfusion_db.database)
+                if not i.startswith('sqlite_autoindex')] == [], \
+            'indexes created before the bulk load finished'
+
+        agfusion_db.finish()
+
+        for table in [DUMP_BUILD, DUMP_BUILD + '_transcript',
+                      DUMP_BUILD + '_refseq'] + \
+                [DUMP_BUILD + '_' + i for i in PROTEIN_ANNOTATIONS]:
+            assert table_rows(agfusion_db.database, table) == \
+                table_rows(normal_db.database, table), \
+                'rows of %s differ' % table
+
+        indexes = self.indexes(agfusion_db.database)
+
+        assert indexes == self.indexes(normal_db.database), \
+            'wrong indexes: %s' % str(indexes)
+        assert DUMP_BUILD + '_stable_id' in indexes, 'missing gene index'
+        assert DUMP_BUILD + '_pfam_translation_id' in indexes, \
+            'missing pfam index'
+
+        db = sqlite3.connect(agfusion_db.database)
+        journal_mode = db.execute('PRAGMA journal_mode').fetchone()[0]
+        db.close()
+
+        assert journal_mode == 'delete', \
+            'journal mode not restored: %s' % journal_mode
+
+
+class TestIncrementalBuild(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tables = set(
+            [DUMP_BUILD, DUMP_BUILD + '_transcript', DUMP_BUILD + '_refseq'] +
+            [DUMP_BUILD + '_' + i for i in PROTEIN_ANNOTATIONS]
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def rebuild(self):
+        """
+        Rebuild the database incrementally, recording the queries run
+        """
+
+        agfusion_db = dump_builder(
+            self.directory,
+            manager=FlakyDumpDBBManager,
+            incremental=True
+        )
+        build_from_dumps(agfusion_db)
+
+        return agfusion_db
+
+    def test_1(self):
+        """
+        test that rebuilding a complete database skips every table
+        """
+
+        agfusion_db = dump_builder(self.directory)
+        build_from_dumps(agfusion_db)
+
+        rows = dict([
+            (i, table_rows(agfusion_db.database, i)) for i in self.tables
+        ])
+
+        agfusion_db = self.rebuild()
+
+        assert agfusion_db.completed_tables == self.tables, \
+            'tables not skipped: %s' % \
+            str(self.tables - agfusion_db.completed_tables)
+        assert agfusion_db.queried == [], \
+            'queries run: %s' % str(agfusion_db.queried)
+
+        for table in self.tables:
+            assert table_rows(agfusion_db.database, table) == rows[table], \
+                'rows of %s changed' % table
+
+    def test_2(self):
+        """
+        test that a table whose rows no longer match the recorded checksum,
+        or that was completed for another release, is rebuilt
+        """
+
+        agfusion_db = dump_builder(self.directory)
+        build_from_dumps(agfusion_db)
+
+        db = sqlite3.connect(agfusion_db.database)
+        db.execute(
+            'DELETE FROM ' + DUMP_BUILD + '_ncoils WHERE rowid IN ' +
+            '(SELECT min(rowid) FROM ' + DUMP_BUILD + '_ncoils)'
+        )
+        db.execute(
+            'UPDATE ' + DUMP_BUILD + '_provenance SET release=86 ' +
+            'WHERE table_name=?',
+            [DUMP_BUILD + '_pfam']
+        )
+        db.commit()
+        db.close()
+
+        agfusion_db = self.rebuild()
+
+        assert sorted(agfusion_db.queried) == ['ncoils', 'pfam'], \
+            'wrong queries: %s' % str(agfusion_db.queried)
+        assert agfusion_db.completed_tables == self.tables - set(
+            [DUMP_BUILD + '_ncoils', DUMP_BUILD + '_pfam']
+        ), 'wrong tables skipped'
+        assert len(table_rows(agfusion_db.database,
+                              DUMP_BUILD + '_ncoils')) == 5, \
+            'ncoils not rebuilt'
+        assert completed_tables(agfusion_db.database) == self.tables, \
+            'rebuilt tables not recorded as completed'
+
+    def test_3(self):
+        """
+        test that a table whose fetch was interrupted is not recorded as
+        completed, and is rebuilt by the next incremental build
+        """
+
+        agfusion_db = dump_builder(
+            self.directory,
+            manager=FlakyDumpDBBManager,
+            fail=['seg']
+        )
+        agfusion_db.fetch_gene_names()
+        agfusion_db.fetch_transcript_table()
+        agfusion_db.fetch_refseq_table()
+
+        self.assertRaises(IOError, agfusion_db.fetch_protein_annotation)
+        agfusion_db.close()
+
+        assert DUMP_BUILD + '_seg' not in \
+            completed_tables(agfusion_db.database), \
+            'interrupted table recorded as completed'
+        assert DUMP_BUILD + '_tmhmm' in \
+            completed_tables(agfusion_db.database), \
+            'table fetched before the interruption not recorded'
+
+        agfusion_db = self.rebuild()
+
+        assert agfusion_db.queried == ['seg', 'ncoils', 'prints', 'pirsf',
+                                       'signalp'], \
+            'wrong queries: %s' % str(agfusion_db.queried)
+        assert len(table_rows(agfusion_db.database, DUMP_BUILD + '_seg')) \
+            == 3, 'seg not rebuilt'
+        assert completed_tables(agfusion_db.database) == self.tables, \
+            'rebuilt tables not recorded as completed'
+
+
+class TestDumpBuild(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_1(self):
+        """
+        test that a database built from Ensembl table dumps has the rows
+        read off the dumps
+        """
+
+        agfusion_db = dump_builder(self.directory, processes=2)
+        build_from_dumps(agfusion_db)
+
+        assert listdir(self.directory) == ['agfusion.homo_sapiens.87.db'], \
+            'temporary files left behind: %s' % str(listdir(self.directory))
+
+        def rows(table):
+            return table_rows(agfusion_db.database, DUMP_BUILD + table)
+
+        # gene 1 has no HGNC name, gene 2 has an escaped backslash in its
+        # name (GENE\\1 in gene.txt.gz)
+
+        genes = rows('')
+
+        assert len(genes) == 8, 'wrong number of genes'
+        assert genes[:2] == [
+            ('1', 'ENSG00000000001', '1001', '', '1'),
+            ('2', 'ENSG00000000002', '1002', 'GENE\\1', '4')
+        ], 'wrong genes: %s' % str(genes[:2])
+
+        # transcript 8 has no translation
+
+        transcripts = rows('_transcript')
+
+        assert len(transcripts) == 18, 'wrong number of transcripts'
+        assert transcripts[6:8] == [
+            ('7', '3', 'ENST00000000007', '3'),
+            ('8', '4', 'ENST00000000008', '')
+        ], 'wrong transcripts: %s' % str(transcripts[6:8])
+
+        refseqs = rows('_refseq')
+
+        assert len(refseqs) == 11, 'wrong number of RefSeq IDs'
+        assert refseqs[0] == ('1', 'ENST00000000001', 'NM_000001'), \
+            'wrong RefSeq ID'
+
+        # Pfam hits are named from pfam.txt, and descriptions keep their
+        # escaped tabs, newlines and backslashes or are NULL
+
+        assert rows('_pfam') == [
+            ('1', 'ENSP00000000001', 'PF00015', 431, 563, 'Domain 15 family',
+             'Domain15')
+        ], 'wrong Pfam rows'
+        assert rows('_superfamily')[0] == (
+            '1', 'ENSP00000000001', 'superfamily_48', 58, 303,
+            'two\nlines \\ and a backslash\\', None
+        ), 'wrong superfamily row'
+        assert rows('_tigrfam')[0][5] is None, 'NULL description not kept'
+
+        for annotation, n_rows in [
+                ('smart', 2), ('superfamily', 2), ('tigrfam', 3),
+                ('pfscan', 4), ('tmhmm', 1), ('seg', 3), ('ncoils', 5),
+                ('prints', 2), ('pirsf', 4), ('signalp', 2)]:
+            assert len(rows('_' + annotation)) == n_rows, \
+                'wrong number of %s rows' % annotation
+
+    def test_2(self):
+        """
+        test that an incremental build whose tables are all complete does
+        not parse the dumps
+        """
+
+        build_from_dumps(dump_builder(self.directory))
+
+        agfusion_db = dump_builder(
+            self.directory,
+            dumps=join(self.directory, 'missing'),
+            incremental=True
+        )
+        build_from_dumps(agfusion_db)
+
+        assert agfusion_db.ensembl_database is None, 'dumps parsed'
+
+    def test_3(self):
+        """
+        test that the temporary copy of the Ensembl tables is removed when
+        parsing the dumps fails
+        """
+
+        dumps = join(self.directory, 'homo_sapiens_core_87_38')
+        shutil.copytree(ENSEMBL_DUMP + 'homo_sapiens_core_87_38', dumps)
+        remove(join(dumps, 'xref.txt.gz'))
+
+        agfusion_db = dump_builder(self.directory, dumps=dumps)
+
+        self.assertRaises(IOError, agfusion_db.fetch_gene_names)
+        agfusion_db.close()
+
+        assert sorted(listdir(self.directory)) == \
+            ['agfusion.homo_sapiens.87.db', 'homo_sapiens_core_87_38'], \
+            'temporary files left behind: %s' % str(listdir(self.directory))
+
+
+if __name__ == "__main__":
+    unittest.main()
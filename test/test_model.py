@@ -0,0 +1,429 @@
+from os import listdir
+from os.path import exists, join
+import json
+import shutil
+import tempfile
+import unittest
+
+import agfusion
+from agfusion import plot
+from agfusion.model import EnsemblIndex, GeneResolver, SavedFusion, \
+    TranscriptCoordinates, _Gene
+from test_database import BUILD, create_test_database
+
+
+class Gene():
+    def __init__(self, gene_id, name):
+        self.id = self.gene_id = gene_id
+        self.name = self.gene_name = name
+        self.contig = '16'
+        self.strand = '+'
+
+    def contains(self, contig, start, end):
+        return contig == self.contig and 1000 <= start and end <= 2000
+
+
+class EnsemblData():
+    """
+    Stands in for the pyensembl data of the test database, counting the
+    gene name lookups
+    """
+
+    def __init__(self):
+        self.genes = {
+            'ENSMUSG00000022770': Gene('ENSMUSG00000022770', 'Dlg1'),
+            'ENSMUSG00000002413': Gene('ENSMUSG00000002413', 'Braf')
+        }
+        self.name_lookups = 0
+
+    def gene_names(self):
+        self.name_lookups += 1
+        return [i.name for i in self.genes.values()]
+
+    def genes_by_name(self, name):
+        return [i for i in self.genes.values() if i.name == name]
+
+    def gene_ids(self):
+        return list(self.genes.keys())
+
+    def gene_by_id(self, gene_id):
+        return self.genes[gene_id]
+
+    def transcript_ids(self):
+        return []
+
+    def transcript_by_id(self, transcript_id):
+        return Transcript(self.genes['ENSMUSG00000002413'])
+
+
+class Transcript():
+    def __init__(self, gene):
+        self.gene = gene
+
+
+class CodingTranscript():
+    def __init__(self, strand, exon_intervals, cds_intervals):
+        self.strand = strand
+        self.exon_intervals = exon_intervals
+        self.coding_sequence_position_ranges = cds_intervals
+
+
+class EnsemblTranscript(CodingTranscript):
+    """
+    Stands in for a complete pyensembl transcript with two exons on the
+    plus strand
+    """
+
+    def __init__(self, transcript_id, gene):
+        CodingTranscript.__init__(
+            self,
+            '+',
+            [(1000, 1300), (1500, 2000)],
+            [(1100, 1300), (1500, 1898)]
+        )
+        self.id = self.transcript_id = transcript_id
+        self.protein_id = transcript_id.replace('MUST', 'MUSP')
+        self.gene = gene
+        self.contig = gene.contig
+        self.start = 1000
+        self.end = 2000
+        self.coding_sequence = 'ATG' + 'GCA' * 198 + 'TAA'
+        self.five_prime_utr_sequence = 'C' * 100
+        self.three_prime_utr_sequence = 'C' * 102
+        self.sequence = self.five_prime_utr_sequence + \
+            self.coding_sequence + self.three_prime_utr_sequence
+        self.complete = True
+        self.contains_start_codon = True
+        self.contains_stop_codon = True
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def contains(self, contig, start, end):
+        return contig == self.contig and self.start <= start and \
+            end <= self.end
+
+
+class FusionEnsemblData(EnsemblData):
+    """
+    Stands in for the pyensembl data of the test database, with the
+    canonical transcripts of Dlg1 and Braf
+    """
+
+    def transcript_by_id(self, transcript_id):
+        if transcript_id == 'ENSMUST00000064477':
+            gene = self.genes['ENSMUSG00000022770']
+        else:
+            gene = self.genes['ENSMUSG00000002413']
+
+        return EnsemblTranscript(transcript_id, gene)
+
+
+class TestGeneResolver(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = agfusion.AGFusionDB(create_test_database(self.directory))
+        self.db.build = BUILD
+        self.pyensembl_data = EnsemblData()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_1(self):
+        """
+        test that a gene recurring across fusions is only resolved once
+        """
+
+        for i in range(3):
+            gene = _Gene(
+                genes='DLG1',
+                junction=1500,
+                pyensembl_data=self.pyensembl_data,
+                db=self.db,
+                noncanonical=True
+            )
+
+            assert gene.gene.name == 'Dlg1', 'wrong gene %s' % gene.gene.name
+            assert sorted(gene.transcripts.keys()) == \
+                ['ENSMUST00000023454', 'ENSMUST00000064477'], \
+                'wrong transcripts'
+
+        # the gene names are only fetched from pyensembl once
+
+        assert self.pyensembl_data.name_lookups == 1, \
+            'gene names looked up %d times' % self.pyensembl_data.name_lookups
+        assert GeneResolver.get(self.db, self.pyensembl_data) is \
+            GeneResolver.get(self.db, self.pyensembl_data), \
+            'resolver not shared'
+        assert EnsemblIndex.get(self.pyensembl_data).gene_names == \
+            frozenset(['Dlg1', 'Braf']), 'wrong gene name index'
+
+    def test_2(self):
+        """
+        test that genes that cannot be resolved keep raising
+        GeneIDException and that junctions are still checked per fusion
+        """
+
+        for i in range(2):
+            self.assertRaises(
+                agfusion.exceptions.GeneIDException,
+                _Gene,
+                genes='NOTAGENE',
+                pyensembl_data=self.pyensembl_data,
+                db=self.db
+            )
+
+        self.assertRaises(
+            agfusion.exceptions.JunctionException,
+            _Gene,
+            genes='ENSMUSG00000002413',
+            junction=5000,
+            pyensembl_data=self.pyensembl_data,
+            db=self.db
+        )
+
+        gene = _Gene(
+            genes='ENSMUSG00000002413',
+            junction=1500,
+            pyensembl_data=self.pyensembl_data,
+            db=self.db
+        )
+
+        assert list(gene.transcripts.keys()) == ['ENSMUST00000002487'], \
+            'wrong canonical transcript'
+
+
+class TestResolveAll(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = agfusion.AGFusionDB(create_test_database(self.directory))
+        self.db.build = BUILD
+        self.db.sqlite3_cursor.execute(
+            'INSERT INTO ' + BUILD + ' VALUES (?,?,?,?,?)',
+            ['3', 'ENSMUSG00000000003', '109880', 'Braf2', '30']
+        )
+        self.pyensembl_data = EnsemblData()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_1(self):
+        """
+        test that resolving genes in bulk reports the unresolvable and
+        ambiguous ones and answers later lookups from memory
+        """
+
+        resolver = GeneResolver.get(self.db, self.pyensembl_data)
+        errors = resolver.resolve_all(
+            ['Dlg1', '13383', 'NM_139294', 'NOTAGENE', '109880', 'Dlg1']
+        )
+
+        assert list(errors.keys()) == ['NOTAGENE', '109880'], \
+            'wrong errors: %s' % str(errors)
+
+        # drop the tables so further queries would fail
+
+        for table in ['', '_transcript', '_refseq']:
+            self.db.sqlite3_cursor.execute('DROP TABLE ' + BUILD + table)
+
+        for genes, transcripts in [
+                ('13383', ['ENSMUST00000064477']),
+                ('Dlg1', ['ENSMUST00000064477'])]:
+            gene = _Gene(
+                genes=genes,
+                junction=1500,
+                pyensembl_data=self.pyensembl_data,
+                db=self.db
+            )
+
+            assert gene.gene.name == 'Dlg1', 'wrong gene %s' % gene.gene.name
+            assert list(gene.transcripts.keys()) == transcripts, \
+                'wrong transcripts for %s' % genes
+
+
+class TestSavedFusion(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_1(self):
+        """
+        test drawing the images of a fusion from its saved annotation
+        """
+
+        def transcript(transcript_id, gene_name, start, end):
+            return {
+                'id': transcript_id,
+                'gene_name': gene_name,
+                'strand': '+',
+                'start': start,
+                'end': end,
+                'exon_intervals': [[start, start + 300], [end - 300, end]],
+                'coding_sequence_length': 450
+            }
+
+        annotation = join(self.directory, 'Dlg1_Braf.annotation.json')
+
+        with open(annotation, 'w') as fout:
+            json.dump({
+                'name': 'Dlg1_Braf',
+                'gene5prime': {'gene_name': 'Dlg1', 'junction': 1200},
+                'gene3prime': {'gene_name': 'Braf', 'junction': 5800},
+                'transcripts': {
+                    'ENSMUST00000064477_ENSMUST00000002487': {
+                        'transcript1': transcript(
+                            'ENSMUST00000064477', 'Dlg1', 1000, 2000),
+                        'transcript2': transcript(
+                            'ENSMUST00000002487', 'Braf', 5000, 6000),
+                        'gene5prime_exon_intervals': [[1000, 1200]],
+                        'gene3prime_exon_intervals': [[5800, 6000]],
+                        'protein_length': 130,
+                        'transcript_protein_junction_5prime': 66,
+                        'domains': {
+                            'fusion': [['PF09058', 'L27_1', 'L27_1 domain',
+                                        5, 66]],
+                            'ENSMUST00000064477': [['PF09058', 'L27_1',
+                                                    'L27_1 domain', 5, 66]],
+                            'ENSMUST00000002487': []
+                        }
+                    }
+                }
+            }, fout)
+
+        fusion = SavedFusion(annotation)
+        fusion.save_images(
+            out_dir=self.directory,
+            plot_WT=True,
+            no_domain_labels=False,
+            exclude=[]
+        )
+
+        for filename in [
+                'ENSMUST00000064477_ENSMUST00000002487.png',
+                'ENSMUST00000064477_ENSMUST00000002487.exon.png',
+                'Dlg1/ENSMUST00000064477.png',
+                'Braf/ENSMUST00000002487.exon.png']:
+            assert exists(join(self.directory, filename)), \
+                '%s not drawn' % filename
+
+        assert plot._FIGURES, 'figures not pooled'
+
+        agfusion.close_figures()
+
+        assert not plot._FIGURES, 'pooled figures not released'
+
+    def test_2(self):
+        """
+        test that the images drawn from a saved annotation match the images
+        drawn from the fusion itself
+        """
+
+        db = agfusion.AGFusionDB(create_test_database(self.directory))
+        db.build = BUILD
+
+        fusion = agfusion.Fusion(
+            gene5prime='Dlg1',
+            gene5primejunction=1200,
+            gene3prime='Braf',
+            gene3primejunction=1600,
+            db=db,
+            pyensembl_data=FusionEnsemblData(),
+            protein_databases=['pfam']
+        )
+
+        def draw(fusion, out_dir):
+            fusion.save_images(
+                out_dir=out_dir,
+                plot_WT=True,
+                no_domain_labels=False,
+                exclude=[]
+            )
+
+            images = {}
+
+            for directory in [out_dir, join(out_dir, 'Dlg1'),
+                              join(out_dir, 'Braf')]:
+                for filename in listdir(directory):
+                    if filename.endswith('.png'):
+                        with open(join(directory, filename), 'rb') as fin:
+                            images[filename] = fin.read()
+
+            return images
+
+        fusion_images = draw(fusion, join(self.directory, 'fusion'))
+
+        fusion.save_annotation(out_dir=join(self.directory, 'saved'))
+        saved_images = draw(
+            SavedFusion(join(self.directory, 'saved',
+                             'Dlg1_Braf.annotation.json')),
+            join(self.directory, 'saved')
+        )
+
+        assert len(fusion_images) == 6, \
+            'wrong images drawn: %s' % str(sorted(fusion_images))
+        assert sorted(fusion_images) == sorted(saved_images), \
+            'wrong images drawn from the annotation'
+
+        for filename in fusion_images:
+            assert fusion_images[filename] == saved_images[filename], \
+                '%s differs from the direct render' % filename
+
+        with open(join(self.directory, 'saved',
+                       'Dlg1_Braf.annotation.json')) as fin:
+            transcript = list(json.load(fin)['transcripts'].values())[0]
+
+        assert 'coding_sequence' not in transcript['transcript1'], \
+            'coding sequence saved'
+        assert transcript['transcript1']['coding_sequence_length'] == 600, \
+            'wrong coding sequence length'
+
+
+class TestTranscriptCoordinates(unittest.TestCase):
+    def test_1(self):
+        """
+        test that the binary searches agree with walking the exons
+        """
+
+        exons = [(100, 200), (300, 350), (500, 600)]
+
+        for strand in ['+', '-']:
+            if strand == '-':
+                exons = exons[::-1]
+
+            transcript = CodingTranscript(strand, exons, exons[1:])
+            coordinates = TranscriptCoordinates.get(transcript)
+
+            assert coordinates is TranscriptCoordinates.get(transcript), \
+                'coordinates not shared'
+            assert coordinates.exons.length == 253, 'wrong transcript length'
+            assert coordinates.cds.offsets == [0, 51, 152], \
+                'wrong CDS offsets'
+
+            for junction in range(90, 610):
+                if strand == '+':
+                    passed = len([i for i in exons if junction >= i[1]])
+                else:
+                    passed = len([i for i in exons if junction <= i[0]])
+
+                assert coordinates.exons.passed(junction) == passed, \
+                    'wrong number of exons passed by %d' % junction
+                assert coordinates.exons.contains(junction) == \
+                    any(i[0] <= junction <= i[1] for i in exons), \
+                    'wrong exon lookup for %d' % junction
+
+    def test_2(self):
+        """
+        test that overlapping intervals are left to the linear scans
+        """
+
+        transcript = CodingTranscript('+', [(100, 200), (150, 300)], [])
+        coordinates = TranscriptCoordinates.get(transcript)
+
+        assert coordinates.exons.passed(250) == 0, 'skipped unordered exons'
+        assert coordinates.exons.contains(250), 'exon not found'
+
+
+if __name__ == "__main__":
+    unittest.main()
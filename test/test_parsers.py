@@ -0,0 +1,34 @@
+import logging
+import unittest
+
+import agfusion
+
+STARFUSION = './data/FusionsFindingAlgorithms/STARFusion/' + \
+    'star-fusion.fusion_candidates.final.abridged'
+
+
+class TestStreaming(unittest.TestCase):
+    def test_1(self):
+        """
+        test that a streaming parser yields the same fusions as a parser
+        that reads the whole file first
+        """
+
+        logger = logging.getLogger('AGFusion')
+
+        fusions = list(agfusion.parsers['starfusion'](STARFUSION, logger))
+        parser = agfusion.parsers['starfusion'](
+            STARFUSION,
+            logger,
+            stream=True
+        )
+
+        assert parser.fusions == [], 'streaming parser read the whole file'
+        assert next(parser) == fusions[0], 'wrong first fusion'
+        assert [fusions[0]] + list(parser) == fusions, 'wrong fusions'
+        assert parser.iterator == len(fusions), \
+            'counted %d fusions' % parser.iterator
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import subprocess
+import sys
+import unittest
+
+HEAVY_MODULES = ['matplotlib', 'pandas', 'Bio', 'pyensembl']
+
+SCRIPT = """
+import sys
+
+from agfusion import cli
+import agfusion
+agfusion.parsers['starfusion']
+print(','.join([i for i in %s if i in sys.modules]))
+""" % str(HEAVY_MODULES)
+
+
+class TestStartup(unittest.TestCase):
+    def test_1(self):
+        """
+        test that the command line interface and the parsers start without
+        importing the plotting, sequence or Ensembl packages
+        """
+
+        output = subprocess.check_output([sys.executable, '-c', SCRIPT])
+        modules = output.decode().split('\n')[0]
+
+        assert modules == '', 'imported %s at startup' % modules
+
+    def test_2(self):
+        """
+        test that the lazily imported names are still exported
+        """
+
+        import agfusion
+
+        assert agfusion.Fusion.__module__ == 'agfusion.model'
+        assert agfusion.PlotWTExons.__module__ == 'agfusion.plot'
+        assert callable(agfusion.cli.main)
+        assert isinstance(agfusion.parsers, dict), 'parsers dict shadowed'
+        assert 'Fusion' in dir(agfusion)
+        self.assertRaises(AttributeError, getattr, agfusion, 'NotAName')
+
+
+if __name__ == "__main__":
+    unittest.main()